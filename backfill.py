@@ -0,0 +1,228 @@
+"""
+Import of the existing history of the groups added to the watchlist, in the background and resumable.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from telethon.errors import FloodWaitError
+
+from dialog_index import normalize_username
+from ingestion import IngestionWriter
+from metrics import BACKFILL_MESSAGES
+from outbound import TokenBucket
+from storage import Storage
+from telegrambot import raise_flood_waits
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillManager:
+    """
+    Pulls the history of a group from the newest message to the oldest, a chunk (one GetHistory request) at a time.
+    Each chunk is inserted with its checkpoint, the id of the oldest message fetched so far, in a single transaction,
+    so a backfill interrupted by a restart resumes where it stopped. The messages captured live meanwhile are the
+    same rows (chat_id, message_id) and are ignored.
+
+    Several groups are backfilled concurrently, all sharing a budget of history requests per second.
+    """
+
+    def __init__(self, storage: Storage, owner: str, concurrency: int = 3, rpc_rate: float = 2.0, rpc_burst: int = 5,
+                 chunk_size: int = 100):
+        """
+        :param storage: The storage of the database
+        :param owner: The account running the backfills, several accounts share the database
+        :param concurrency: The number of groups backfilled at the same time
+        :param rpc_rate: The number of history requests per second, for all the groups
+        :param rpc_burst: The number of history requests that can be made at once after a quiet period
+        :param chunk_size: The number of messages per request, at most 100
+        """
+        self.storage = storage
+        self.owner = owner
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+
+        self.rpc_bucket = TokenBucket(rpc_rate, rpc_burst)
+        # Monotonic time before which no request is made, after a flood wait
+        self.paused_until = 0.0
+
+        self.client = None
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore = None
+        self._rpc_lock = None
+
+    async def start(self, client) -> None:
+        """
+        Resumes the backfills of the owner that didn't finish.
+        :param client: The connected Telethon client
+        """
+        self.client = client
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._rpc_lock = asyncio.Lock()
+
+        rows = self.storage.execute("SELECT group_username FROM backfill_state WHERE owner = ? "
+                                    "AND status IN ('pending', 'running')", (self.owner,))
+        for row in rows:
+            self._spawn(row[0])
+
+        if rows:
+            logger.info("Resuming the backfill of %s groups", len(rows))
+
+    async def stop(self) -> None:
+        """
+        Interrupts the backfills, they resume from their checkpoint at the next start.
+        """
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks.clear()
+        self.client = None
+
+    def add(self, group_username: str, max_messages: int) -> None:
+        """
+        Starts the backfill of a group, or extends a running or finished one to max_messages.
+
+        :param group_username: The username or id of the group
+        :param max_messages: The maximal number of messages imported
+        """
+        group_username = normalize_username(group_username)
+        now = int(time.time())
+        self.storage.execute('INSERT INTO backfill_state (group_username, owner, status, checkpoint_id, '
+                             'messages_fetched, max_messages, timestamp_started, timestamp_updated) '
+                             'VALUES (?, ?, ?, 0, 0, ?, ?, ?) ON CONFLICT (owner, group_username) DO UPDATE SET '
+                             "status = CASE status WHEN 'running' THEN status ELSE excluded.status END, error = NULL, "
+                             'max_messages = MAX(max_messages, excluded.max_messages), '
+                             'timestamp_updated = excluded.timestamp_updated',
+                             (group_username, self.owner, 'pending', max_messages, now, now))
+
+        if self.client is not None:
+            self._spawn(group_username)
+
+    def progress(self) -> List[Dict[str, Any]]:
+        """
+        :return: The state of the backfills, the running ones first
+        """
+        rows = self.storage.execute('SELECT group_username, status, messages_fetched, max_messages, oldest_date, '
+                                    'error, timestamp_updated FROM backfill_state WHERE owner = ? '
+                                    "ORDER BY status = 'running' DESC, timestamp_updated DESC", (self.owner,))
+        return [{'group': row[0], 'status': row[1], 'messages_fetched': row[2], 'max_messages': row[3],
+                 'oldest_message_date': row[4], 'error': row[5], 'updated': row[6]} for row in rows]
+
+    def _spawn(self, group_username: str) -> None:
+        if group_username in self.tasks and not self.tasks[group_username].done():
+            return
+
+        self.tasks[group_username] = asyncio.create_task(self._backfill(group_username))
+
+    async def _backfill(self, group_username: str) -> None:
+        async with self._semaphore:
+            row = self.storage.execute('SELECT checkpoint_id, messages_fetched FROM backfill_state '
+                                       'WHERE owner = ? AND group_username = ?', (self.owner, group_username))
+            if not row:
+                return
+            checkpoint_id, fetched = row[0]
+
+            self.storage.execute('UPDATE backfill_state SET status = ? WHERE owner = ? AND group_username = ?',
+                                 ('running', self.owner, group_username))
+            logger.info("Backfilling %s from message %s (%s fetched)", group_username, checkpoint_id or 'latest',
+                        fetched)
+
+            entity = int(group_username) if group_username.lstrip('-').isdigit() else group_username
+            loop = asyncio.get_running_loop()
+            try:
+                while True:
+                    # Read before every chunk, add() can raise the limit while the backfill runs
+                    max_messages = self._get_state(group_username)[1]
+                    if fetched >= max_messages:
+                        # Unless the limit was raised since it was read
+                        if await loop.run_in_executor(None, self._finish, group_username, fetched):
+                            break
+                        continue
+
+                    messages = await self._fetch(entity, checkpoint_id, min(self.chunk_size, max_messages - fetched))
+                    if messages:
+                        checkpoint_id = messages[-1].id
+                        fetched += len(messages)
+
+                    # Service messages (joins, pins...) have no text
+                    rows = [(message.chat_id, message.id, message.sender_id, group_username, message.message,
+                             int(message.date.timestamp()))
+                            for message in messages if getattr(message, 'message', None) is not None]
+                    oldest_date = int(messages[-1].date.timestamp()) if messages else None
+
+                    # The beginning of the history is reached
+                    done = not messages
+                    await loop.run_in_executor(None, self._write_chunk, group_username, rows, checkpoint_id, fetched,
+                                               oldest_date, done)
+                    BACKFILL_MESSAGES.inc(len(rows))
+                    if done:
+                        break
+
+                logger.info("Backfilled %s messages of %s", fetched, group_username)
+            except Exception as e:
+                logger.error("Backfill of %s failed: %s", group_username, e)
+                self.storage.execute('UPDATE backfill_state SET status = ?, error = ?, timestamp_updated = ? '
+                                     'WHERE owner = ? AND group_username = ?',
+                                     ('failed', str(e), int(time.time()), self.owner, group_username))
+            finally:
+                if self.tasks.get(group_username) is asyncio.current_task():
+                    del self.tasks[group_username]
+                    # add() found this task still running after its last chunk
+                    if self.client is not None and self._get_state(group_username)[0] == 'pending':
+                        self._spawn(group_username)
+
+    def _get_state(self, group_username: str) -> tuple:
+        """
+        :return: The status and the max_messages of a backfill
+        """
+        return self.storage.execute('SELECT status, max_messages FROM backfill_state WHERE owner = ? '
+                                    'AND group_username = ?', (self.owner, group_username))[0]
+
+    def _finish(self, group_username: str, fetched: int) -> bool:
+        """
+        Marks a backfill done if fetched reaches its limit. Runs in a worker thread.
+        :return: False if the limit was raised meanwhile
+        """
+        with self.storage.connection() as conn:
+            cursor = conn.execute('UPDATE backfill_state SET status = ?, timestamp_updated = ? WHERE owner = ? '
+                                  'AND group_username = ? AND max_messages <= ?',
+                                  ('done', int(time.time()), self.owner, group_username, fetched))
+            return cursor.rowcount > 0
+
+    async def _fetch(self, entity, offset_id: int, limit: int) -> List[Any]:
+        """
+        Gets the messages older than offset_id (0 for the latest), newest first, within the request budget.
+        Flood waits pause all the backfills and the request is tried again.
+        """
+        while True:
+            async with self._rpc_lock:
+                while True:
+                    now = time.monotonic()
+                    delay = max(self.paused_until - now, self.rpc_bucket.delay(now))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.rpc_bucket.take(time.monotonic())
+
+            try:
+                with raise_flood_waits():
+                    return list(await self.client.get_messages(entity, limit=limit, offset_id=offset_id))
+            except FloodWaitError as e:
+                logger.warning("Backfill hit a flood wait of %ss", e.seconds)
+                self.paused_until = max(self.paused_until, time.monotonic() + e.seconds)
+
+    def _write_chunk(self, group_username: str, rows: List[tuple], checkpoint_id: int, fetched: int,
+                     oldest_date: Optional[int], done: bool) -> None:
+        """
+        Runs in a worker thread.
+        """
+        with self.storage.connection() as conn:
+            conn.executemany(IngestionWriter.INSERT_SQL, rows)
+            conn.execute('UPDATE backfill_state SET checkpoint_id = ?, messages_fetched = ?, '
+                         'oldest_date = COALESCE(?, oldest_date), status = ?, timestamp_updated = ? '
+                         'WHERE owner = ? AND group_username = ?',
+                         (checkpoint_id, fetched, oldest_date, 'done' if done else 'running', int(time.time()),
+                          self.owner, group_username))
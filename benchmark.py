@@ -0,0 +1,681 @@
+"""
+End-to-end benchmark of the assistant without Telegram or OpenAI accounts. Synthetic NewMessage events are fed to
+TelegramAssistant.event_handler at configurable rates (watched groups, DMs and the service group), and the
+Assistants endpoints used by the bot are served by a local stand-in with a configurable run latency and tool calls.
+
+The bot runs in a temporary folder with its own assistant.db, the real database is never touched.
+
+    python benchmark.py --duration 30 --dm-rate 2 --group-rate 1 --watch-rate 200 --run-latency 0.5
+    python benchmark.py --tool-script '[[{"name": "get_groups_to_watch", "arguments": {}}]]' --stream
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WHITELISTED_USER = 'benchmark_user'
+SERVICE_GROUP_ID = -1000000000001
+WATCHED_GROUP_ID = -1000000001000
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """
+    :param values: The samples
+    :param q: The percentile, between 0 and 100
+    :return: The nearest-rank percentile, None without samples
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, Any]:
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class FakeOpenAIServer:
+    """
+    Local stand-in for the OpenAI endpoints used by the bot: threads, messages, runs (polled or streamed), tool
+    outputs and cancellation for the Assistants engine, and chat completions for the Chat Completions engine. Every
+    run or completion takes run_latency seconds per step, and asks for the tool calls of tool_script before
+    answering: tool_script[i] is the list of {"name": ..., "arguments": {...}} calls of round i.
+    """
+
+    ROUTES = [
+        ('POST', re.compile(r'^/v1/threads$'), '_create_thread'),
+        ('POST', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/messages$'), '_create_message'),
+        ('GET', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/messages$'), '_list_messages'),
+        ('POST', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/runs$'), '_create_run'),
+        ('GET', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/runs$'), '_list_runs'),
+        ('GET', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)$'), '_retrieve_run'),
+        ('POST', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)/cancel$'), '_cancel_run'),
+        ('POST', re.compile(r'^/v1/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)/submit_tool_outputs$'),
+         '_submit_tool_outputs'),
+        ('POST', re.compile(r'^/v1/chat/completions$'), '_chat_completion'),
+    ]
+
+    def __init__(self, run_latency: float = 0.5, tool_script: List[List[Dict[str, Any]]] = None,
+                 reply: str = 'This is a benchmark answer from the local stand-in.', chunk_size: int = 16,
+                 host: str = '127.0.0.1', port: int = 0):
+        """
+        :param run_latency: The time a run takes before each tool call round and before the answer, in seconds
+        :param tool_script: The tool call rounds of every run
+        :param reply: The answer of every run
+        :param chunk_size: The number of characters of each delta of a streamed answer
+        :param host: The interface to listen on
+        :param port: The port to listen on, 0 for a free port
+        """
+        self.run_latency = run_latency
+        self.tool_script = tool_script or []
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.host = host
+        self.port = port
+
+        self.runs: Dict[str, Dict[str, Any]] = {}
+        self.messages: Dict[str, List[Dict[str, Any]]] = {}
+        self.requests: Dict[str, int] = {}
+
+        self._ids = itertools.count(1)
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _new_id(self, prefix: str) -> str:
+        return f'{prefix}_{next(self._ids)}'
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Connections are kept alive, like the OpenAI client expects
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method, target = request_line.decode('latin-1').split()[:2]
+                url = urlsplit(target)
+
+                payload = json.loads(body) if body else {}
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+                if payload.get('stream'):
+                    await self._stream(writer, method, url.path, payload)
+                    break
+
+                status, response = await self._dispatch(method, url.path, payload, query)
+                data = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # The client went away, or the loop is shutting down with the connection still kept alive
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, payload: Dict[str, Any], query: Dict[str, str]):
+        for route_method, pattern, handler_name in self.ROUTES:
+            match = pattern.match(path)
+            if match and route_method == method:
+                self.requests[handler_name[1:]] = self.requests.get(handler_name[1:], 0) + 1
+                response = getattr(self, handler_name)(payload=payload, query=query, **match.groupdict())
+                if asyncio.iscoroutine(response):
+                    response = await response
+                return '200 OK', response
+
+        return '404 Not Found', {'error': {'message': f'Unknown endpoint {method} {path}', 'type': 'invalid_request'}}
+
+    def _create_thread(self, payload, query):
+        thread_id = self._new_id('thread')
+        self.messages[thread_id] = []
+        return {'id': thread_id, 'object': 'thread', 'created_at': int(time.time()), 'metadata': {}}
+
+    def _message_object(self, thread_id: str, role: str, text: str, run_id: str = None) -> Dict[str, Any]:
+        return {'id': self._new_id('msg'), 'object': 'thread.message', 'created_at': int(time.time()),
+                'thread_id': thread_id, 'role': role, 'run_id': run_id, 'assistant_id': None, 'attachments': [],
+                'metadata': {}, 'status': 'completed',
+                'content': [{'type': 'text', 'text': {'value': text, 'annotations': []}}]}
+
+    def _create_message(self, payload, query, thread_id):
+        message = self._message_object(thread_id, payload.get('role', 'user'), str(payload.get('content', '')))
+        self.messages.setdefault(thread_id, []).append(message)
+        return message
+
+    def _list_messages(self, payload, query, thread_id):
+        messages = [message for message in reversed(self.messages.get(thread_id, []))
+                    if 'run_id' not in query or message['run_id'] == query['run_id']]
+        messages = messages[:int(query.get('limit', 20))]
+        return {'object': 'list', 'data': messages, 'has_more': False,
+                'first_id': messages[0]['id'] if messages else None,
+                'last_id': messages[-1]['id'] if messages else None}
+
+    def _run_object(self, run: Dict[str, Any]) -> Dict[str, Any]:
+        required_action = None
+        if run['status'] == 'requires_action':
+            tool_calls = [{'id': self._new_id('call'), 'type': 'function',
+                           'function': {'name': call['name'], 'arguments': json.dumps(call.get('arguments', {}))}}
+                          for call in self.tool_script[run['round']]]
+            required_action = {'type': 'submit_tool_outputs', 'submit_tool_outputs': {'tool_calls': tool_calls}}
+
+        return {'id': run['id'], 'object': 'thread.run', 'created_at': run['created_at'],
+                'assistant_id': run['assistant_id'], 'thread_id': run['thread_id'], 'status': run['status'],
+                'required_action': required_action, 'last_error': None, 'instructions': '', 'model': 'benchmark',
+                'tools': [], 'metadata': {}, 'parallel_tool_calls': True}
+
+    def _advance(self, run: Dict[str, Any], force: bool = False) -> None:
+        """
+        Moves a run to its next status once its step latency is over.
+        """
+        if run['status'] not in ('queued', 'in_progress'):
+            return
+        if not force and time.monotonic() < run['ready_at']:
+            return
+
+        if run['round'] < len(self.tool_script):
+            run['status'] = 'requires_action'
+        else:
+            run['status'] = 'completed'
+            self.messages.setdefault(run['thread_id'], []).append(
+                self._message_object(run['thread_id'], 'assistant', self.reply, run['id']))
+
+    def _new_run(self, payload: Dict[str, Any], thread_id: str) -> Dict[str, Any]:
+        run = {'id': self._new_id('run'), 'thread_id': thread_id, 'assistant_id': payload.get('assistant_id'),
+               'created_at': int(time.time()), 'status': 'queued', 'round': 0,
+               'ready_at': time.monotonic() + self.run_latency}
+        self.runs[run['id']] = run
+        return run
+
+    def _create_run(self, payload, query, thread_id):
+        return self._run_object(self._new_run(payload, thread_id))
+
+    def _list_runs(self, payload, query, thread_id):
+        runs = [run for run in self.runs.values() if run['thread_id'] == thread_id][::-1]
+        runs = [self._run_object(run) for run in runs[:int(query.get('limit', 20))]]
+        return {'object': 'list', 'data': runs, 'has_more': False,
+                'first_id': runs[0]['id'] if runs else None, 'last_id': runs[-1]['id'] if runs else None}
+
+    def _retrieve_run(self, payload, query, thread_id, run_id):
+        run = self.runs[run_id]
+        self._advance(run)
+        return self._run_object(run)
+
+    def _cancel_run(self, payload, query, thread_id, run_id):
+        run = self.runs[run_id]
+        if run['status'] not in ('completed', 'failed', 'expired', 'cancelled', 'incomplete'):
+            run['status'] = 'cancelled'
+        return self._run_object(run)
+
+    def _submit_tool_outputs(self, payload, query, thread_id, run_id):
+        run = self.runs[run_id]
+        run['round'] += 1
+        run['status'] = 'in_progress'
+        run['ready_at'] = time.monotonic() + self.run_latency
+        return self._run_object(run)
+
+    def _chat_round(self, payload: Dict[str, Any]) -> int:
+        """
+        :return: The number of tool call rounds already answered since the last user message
+        """
+        rounds = 0
+        for message in reversed(payload.get('messages', [])):
+            if message.get('role') == 'user':
+                break
+            if message.get('role') == 'assistant' and message.get('tool_calls'):
+                rounds += 1
+        return rounds
+
+    def _chat_tool_calls(self, round_index: int) -> List[Dict[str, Any]]:
+        return [{'id': self._new_id('call'), 'type': 'function',
+                 'function': {'name': call['name'], 'arguments': json.dumps(call.get('arguments', {}))}}
+                for call in self.tool_script[round_index]]
+
+    async def _chat_completion(self, payload, query):
+        await asyncio.sleep(self.run_latency)
+
+        round_index = self._chat_round(payload)
+        if round_index < len(self.tool_script):
+            message = {'role': 'assistant', 'content': None, 'tool_calls': self._chat_tool_calls(round_index)}
+            finish_reason = 'tool_calls'
+        else:
+            message = {'role': 'assistant', 'content': self.reply}
+            finish_reason = 'stop'
+
+        return {'id': self._new_id('chatcmpl'), 'object': 'chat.completion', 'created': int(time.time()),
+                'model': payload.get('model', 'benchmark'),
+                'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}]}
+
+    async def _stream_chat_completion(self, writer: asyncio.StreamWriter, payload: Dict[str, Any]) -> None:
+        self.requests['chat_completion'] = self.requests.get('chat_completion', 0) + 1
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n')
+
+        completion_id = self._new_id('chatcmpl')
+
+        async def send(delta: Dict[str, Any], finish_reason: str = None) -> None:
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': payload.get('model', 'benchmark'),
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            writer.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await writer.drain()
+
+        await asyncio.sleep(self.run_latency)
+
+        round_index = self._chat_round(payload)
+        if round_index < len(self.tool_script):
+            tool_calls = self._chat_tool_calls(round_index)
+            await send({'role': 'assistant', 'tool_calls': [dict(call, index=index)
+                                                            for index, call in enumerate(tool_calls)]})
+            await send({}, 'tool_calls')
+        else:
+            for start in range(0, len(self.reply), self.chunk_size):
+                await send({'content': self.reply[start:start + self.chunk_size]})
+            await send({}, 'stop')
+
+        writer.write(b'data: [DONE]\n\n')
+        await writer.drain()
+
+    async def _stream(self, writer: asyncio.StreamWriter, method: str, path: str, payload: Dict[str, Any]) -> None:
+        """
+        Streams a run or a chat completion as server-sent events, for the requests made with stream=True.
+        """
+        if method == 'POST' and path == '/v1/chat/completions':
+            await self._stream_chat_completion(writer, payload)
+            return
+
+        match = re.match(r'^/v1/threads/(?P<thread_id>[^/]+)/runs(?:/(?P<run_id>[^/]+)/submit_tool_outputs)?$', path)
+        if method != 'POST' or match is None:
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+            return
+
+        thread_id, run_id = match.group('thread_id'), match.group('run_id')
+        if run_id is None:
+            self.requests['create_run'] = self.requests.get('create_run', 0) + 1
+            run = self._new_run(payload, thread_id)
+        else:
+            self.requests['submit_tool_outputs'] = self.requests.get('submit_tool_outputs', 0) + 1
+            run = self.runs[run_id]
+            run['round'] += 1
+            run['status'] = 'in_progress'
+
+        # The body ends when the connection is closed
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n')
+
+        async def send(event: str, data: Any) -> None:
+            writer.write(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode())
+            await writer.drain()
+
+        await send('thread.run.created' if run_id is None else 'thread.run.in_progress', self._run_object(run))
+        await asyncio.sleep(self.run_latency)
+        self._advance(run, force=True)
+
+        if run['status'] == 'requires_action':
+            await send('thread.run.requires_action', self._run_object(run))
+        else:
+            message_id = self.messages[run['thread_id']][-1]['id']
+            for start in range(0, len(self.reply), self.chunk_size):
+                await send('thread.message.delta', {
+                    'id': message_id, 'object': 'thread.message.delta',
+                    'delta': {'content': [{'index': 0, 'type': 'text',
+                                           'text': {'value': self.reply[start:start + self.chunk_size]}}]}})
+            await send('thread.run.completed', self._run_object(run))
+
+        writer.write(b'event: done\ndata: [DONE]\n\n')
+        await writer.drain()
+
+
+class FakeUser:
+    def __init__(self, user_id: int, username: str):
+        self.id = user_id
+        self.username = username
+        self.first_name = username
+        self.last_name = None
+
+
+class FakeMessage:
+    def __init__(self, event: 'FakeEvent', message_id: int, text: str):
+        self.event = event
+        self.id = message_id
+        self.text = text
+        self.date = datetime.now(timezone.utc)
+
+    async def edit(self, text: str) -> 'FakeMessage':
+        self.text = text
+        self.event.last_output = time.perf_counter()
+        return self
+
+
+class FakeEvent:
+    """
+    The subset of a Telethon NewMessage event used by the handlers. The replies are recorded instead of sent.
+    """
+
+    def __init__(self, chat_id: int, message_id: int, sender: FakeUser, text: str, is_private: bool):
+        self.chat_id = chat_id
+        self.sender_id = sender.id
+        self.sender = sender
+        self.is_private = is_private
+        self.raw_text = text
+        self.message = FakeMessage(self, message_id, text)
+
+        self.created = time.perf_counter()
+        self.first_output = None
+        self.last_output = None
+
+    async def get_sender(self) -> FakeUser:
+        return self.sender
+
+    async def respond(self, text: str) -> FakeMessage:
+        now = time.perf_counter()
+        if self.first_output is None:
+            self.first_output = now
+        self.last_output = now
+        return FakeMessage(self, self.message.id + 1, text)
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task sleeping interval seconds, i.e. how long callbacks are delayed
+    by the code blocking the loop.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+
+class Benchmark:
+    """
+    Runs a TelegramAssistant against the stand-in and generated events, and collects the latencies.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.server = FakeOpenAIServer(args.run_latency, args.tool_script, chunk_size=args.chunk_size)
+
+        self.bot = None
+        self.tasks = set()
+        self.message_ids = itertools.count(1)
+        self.event_counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.reply_latencies: List[float] = []
+        self.first_output_latencies: List[float] = []
+        self.handler_latencies: List[float] = []
+
+    def make_event(self, kind: str) -> FakeEvent:
+        message_id = next(self.message_ids)
+        user = FakeUser(1000 + self.random.randrange(self.args.dm_chats), WHITELISTED_USER)
+
+        if kind == 'dm':
+            return FakeEvent(user.id, message_id, user, f'Benchmark command {message_id}', is_private=True)
+        if kind == 'service_group':
+            return FakeEvent(SERVICE_GROUP_ID, message_id, user, f'Benchmark command {message_id}', is_private=False)
+
+        chat_id = WATCHED_GROUP_ID - self.random.randrange(self.args.watched_groups)
+        sender = FakeUser(100000 + self.random.randrange(10000), f'member_{message_id % 10000}')
+        return FakeEvent(chat_id, message_id, sender, f'Benchmark message {message_id} ' + 'lorem ipsum ' * 8,
+                         is_private=False)
+
+    async def handle(self, kind: str, event: FakeEvent) -> None:
+        try:
+            await self.bot.event_handler(event)
+        except Exception as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            return
+
+        done = time.perf_counter()
+        if kind == 'watched':
+            self.handler_latencies.append(done - event.created)
+        elif event.last_output is not None:
+            self.reply_latencies.append(event.last_output - event.created)
+            self.first_output_latencies.append(event.first_output - event.created)
+
+    async def generate(self, kind: str, rate: float, stop_at: float) -> None:
+        """
+        Emits events of a kind as a Poisson process of the given rate, until stop_at.
+        """
+        if rate <= 0:
+            return
+
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.random.expovariate(rate))
+            if loop.time() >= stop_at:
+                return
+
+            self.event_counts[kind] = self.event_counts.get(kind, 0) + 1
+            # Telethon runs every handler in its own task
+            task = asyncio.create_task(self.handle(kind, self.make_event(kind)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def create_bot(self):
+        from telegram_assistant import TelegramAssistant
+
+        args = self.args
+        bot = TelegramAssistant('benchmark.session', '.', 0, '', [WHITELISTED_USER], 'benchmark_service_group',
+                                'asst_benchmark', 'thread_benchmark', stream_responses=args.stream,
+                                max_action_rounds=args.max_action_rounds, tool_timeout=args.tool_timeout,
+                                engine=args.engine, outbound_global_rate=args.outbound_global_rate,
+                                outbound_chat_rate=args.outbound_chat_rate, openai_api_key='benchmark')
+        bot.prepare_storage()
+
+        # What start() would find after logging in and indexing the dialogs
+        bot.service_group_id = SERVICE_GROUP_ID
+        bot.thread_manager.set_default(SERVICE_GROUP_ID)
+        bot.watched_chats = {WATCHED_GROUP_ID - index: f'benchmark_group_{index}'
+                             for index in range(args.watched_groups)}
+        return bot
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        await self.server.start()
+
+        # The OpenAI client reads its base url from the environment
+        os.environ['OPENAI_BASE_URL'] = self.server.base_url
+
+        self.bot = self.create_bot()
+        await self.bot.ingestion_writer.start()
+
+        monitor = LoopLagMonitor()
+        monitor.start()
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        stop_at = loop.time() + args.duration
+
+        await asyncio.gather(self.generate('dm', args.dm_rate, stop_at),
+                             self.generate('service_group', args.group_rate, stop_at),
+                             self.generate('watched', args.watch_rate, stop_at))
+
+        # Let the pending replies finish, then write the queued messages
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=args.drain_timeout)
+        pending = len(self.tasks)
+
+        drain_started = time.perf_counter()
+        await self.bot.ingestion_writer.stop()
+        drain_seconds = time.perf_counter() - drain_started
+        elapsed = time.perf_counter() - started
+
+        await monitor.stop()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        await self.bot.outbound.stop()
+        self.bot.query_engine.close()
+        # Close the kept-alive connections from the client side before the server goes away
+        await self.bot.thread_manager.client.close()
+        await self.server.stop()
+
+        ingestion = self.bot.ingestion_writer.stats()
+        return {
+            'duration': elapsed,
+            'events': self.event_counts,
+            'errors': self.errors,
+            'unfinished': pending,
+            'reply_latency': summarize(self.reply_latencies),
+            'first_output_latency': summarize(self.first_output_latencies),
+            'watch_handler_latency': summarize(self.handler_latencies),
+            'ingest': {
+                'rows_written': ingestion['rows_written'],
+                'rows_per_second': ingestion['rows_written'] / elapsed if elapsed else 0.0,
+                'batches_written': ingestion['batches_written'],
+                'avg_flush_latency': ingestion['avg_flush_latency'],
+                'max_flush_latency': ingestion['max_flush_latency'],
+                'drain_seconds': drain_seconds,
+            },
+            'loop_lag': summarize(monitor.samples),
+            'openai_requests': self.server.requests,
+        }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return '-' if value is None else f'{value * 1000:.1f}ms'
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"Duration: {report['duration']:.1f}s, events: {report['events']}, errors: {report['errors']}, "
+          f"unfinished: {report['unfinished']}")
+
+    for name in ('reply_latency', 'first_output_latency', 'watch_handler_latency', 'loop_lag'):
+        stats = report[name]
+        print(f"{name}: n={stats['count']} p50={format_seconds(stats['p50'])} p99={format_seconds(stats['p99'])} "
+              f"max={format_seconds(stats['max'])}")
+
+    ingest = report['ingest']
+    print(f"ingest: {ingest['rows_written']} rows, {ingest['rows_per_second']:.0f} rows/s, "
+          f"{ingest['batches_written']} batches, avg flush {format_seconds(ingest['avg_flush_latency'])}, "
+          f"drain {format_seconds(ingest['drain_seconds'])}")
+    print(f"openai requests: {report['openai_requests']}")
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the Telegram Assistant.')
+    parser.add_argument('--duration', type=float, default=30.0, help='How long events are generated, in seconds')
+    parser.add_argument('--dm-rate', type=float, default=1.0, help='Commands per second in DMs')
+    parser.add_argument('--dm-chats', type=int, default=10, help='Number of whitelisted users sending DMs')
+    parser.add_argument('--group-rate', type=float, default=0.5, help='Commands per second in the service group')
+    parser.add_argument('--watch-rate', type=float, default=100.0, help='Messages per second in the watched groups')
+    parser.add_argument('--watched-groups', type=int, default=20, help='Number of watched groups')
+    parser.add_argument('--run-latency', type=float, default=0.5, help='Duration of every run step, in seconds')
+    parser.add_argument('--tool-script', type=json.loads, default=[],
+                        help='JSON list of tool call rounds, each a list of {"name": ..., "arguments": {...}}')
+    parser.add_argument('--chunk-size', type=int, default=16, help='Characters per delta of the streamed answers')
+    parser.add_argument('--stream', action='store_true', help='Stream the answers instead of polling the runs')
+    parser.add_argument('--engine', choices=['assistants', 'chat'], default='assistants',
+                        help='The conversation engine of the bot')
+    parser.add_argument('--outbound-global-rate', type=float, default=1000.0,
+                        help='Telegram actions per second, the replies wait behind it (1 in production)')
+    parser.add_argument('--outbound-chat-rate', type=float, default=1000.0,
+                        help='Telegram actions per second in a single chat (0.3 in production)')
+    parser.add_argument('--max-action-rounds', type=int, default=10)
+    parser.add_argument('--tool-timeout', type=float, default=30.0)
+    parser.add_argument('--drain-timeout', type=float, default=60.0,
+                        help='How long to wait for the pending replies after the generation, in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--max-reply-p99', type=float, default=None,
+                        help='Exit with status 1 if the p99 reply latency is higher, in seconds')
+    parser.add_argument('--max-loop-lag-p99', type=float, default=None,
+                        help='Exit with status 1 if the p99 event loop lag is higher, in seconds')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder with the benchmark database')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+
+    # The bot reads functions.json and assistant.db from the working directory
+    workdir = tempfile.mkdtemp(prefix='assistant-benchmark-')
+    shutil.copy(os.path.join(SCRIPT_DIR, 'functions.json'), workdir)
+
+    sys.path.insert(0, SCRIPT_DIR)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        report = asyncio.run(Benchmark(args).run())
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Benchmark files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    failures = []
+    if args.max_reply_p99 is not None and (report['reply_latency']['p99'] or 0) > args.max_reply_p99:
+        failures.append(f"p99 reply latency {format_seconds(report['reply_latency']['p99'])}")
+    if args.max_loop_lag_p99 is not None and (report['loop_lag']['p99'] or 0) > args.max_loop_lag_p99:
+        failures.append(f"p99 event loop lag {format_seconds(report['loop_lag']['p99'])}")
+    if report['errors'] or report['unfinished']:
+        failures.append(f"{sum(report['errors'].values())} errors, {report['unfinished']} unfinished events")
+
+    if failures:
+        print(f"Regression: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,34 @@
 """
-Cancel a run in a OpenAI thread. Use it when you get an error while using the bot and want to run the assistant
-again with another run.
+Cancel the runs stuck in OpenAI threads. The bot does it by itself before the first run of every thread and when a
+thread is locked (see OpenaiAssistant.recover_active_runs), use it to unlock threads while the bot is stopped.
 """
-from openai import OpenAI
-from data import OPENAI_API_KEY
+import argparse
+import asyncio
+import logging
+
+from openai import AsyncOpenAI
+
+from data import ASSISTANT_ID, OPENAI_API_KEY, THREAD_ID
+from openai_assistant import OpenaiAssistant
+
+
+async def main(thread_ids, policy: str) -> None:
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+    for thread_id in thread_ids:
+        assistant = OpenaiAssistant(client, ASSISTANT_ID, thread_id, stuck_run_policy=policy)
+        count = await assistant.recover_active_runs()
+        print(f"Thread {thread_id}: {count} active runs recovered")
+
 
 if __name__ == "__main__":
-    THREAD = ""
-
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    runs = client.beta.threads.runs.list(THREAD)
-
-    for run in runs:
-        # Cancel the run if it's still running
-        if run.status in ["running", "requires_action"]:
-            print(f"Canceling run {run.id}")
-            client.beta.threads.runs.cancel(
-                thread_id=THREAD,
-                run_id=run.id
-            )
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Cancel the runs stuck in OpenAI threads.')
+    parser.add_argument('threads', nargs='*', default=[THREAD_ID],
+                        help='The threads to unlock, the configured THREAD_ID by default')
+    parser.add_argument('--resume', action='store_true',
+                        help='Let the recent runs finish instead of cancelling them')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.threads, 'resume' if args.resume else 'cancel'))
@@ -0,0 +1,242 @@
+"""
+Conversation engine on Chat Completions with native tool calling. The conversation state lives in assistant.db
+instead of an OpenAI thread.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, Dict, List
+
+from metrics import run_id_var, span
+from openai_assistant import INSTRUCTIONS, SUMMARY_INSTRUCTIONS, estimate_tokens
+from storage import Storage
+from tool_registry import load_functions
+
+logger = logging.getLogger(__name__)
+
+
+class ChatCompletionsAssistant:
+    """
+    Drop-in replacement of OpenaiAssistant for a conversation stored locally: a reply is a single Chat Completions
+    request per tool call round, instead of creating a message and a run, polling the run and listing the messages.
+
+    The "thread" is the key of the conversation in the conversation_messages table and a "run" is a completion.
+    """
+
+    def __init__(self, client, assistant_id: str, thread_id: str, conversation_storage: Storage, model: str = 'gpt-4o',
+                 instructions: str = INSTRUCTIONS, functions_path: str = 'functions.json',
+                 max_history_messages: int = 50, run_timeout: float = 120.0, **kwargs):
+        """
+        :param client: An ``AsyncOpenAI`` client
+        :param assistant_id: Not used, the model and the instructions are sent with every request
+        :param thread_id: The key of the conversation
+        :param conversation_storage: The storage of the database holding the conversations
+        :param model: The chat model
+        :param instructions: The system prompt
+        :param functions_path: The path of the JSON file with the tools, parsed once and shared by all the threads
+        :param max_history_messages: The number of stored messages sent with every request
+        :param run_timeout: The maximal duration of a completion, in seconds
+        :param kwargs: The polling settings of OpenaiAssistant, not used
+        """
+        self.client = client
+        self.assistant_id = assistant_id
+        self.thread_id = thread_id
+        self.storage = conversation_storage
+        self.model = model
+        self.instructions = instructions
+        self.max_history_messages = max_history_messages
+        self.run_timeout = run_timeout
+
+        self.tools = load_functions(functions_path)
+
+        # Same size tracking as OpenaiAssistant
+        self.approx_tokens = 0
+        self.context_tokens = None
+
+    @staticmethod
+    async def create_thread(client) -> str:
+        """
+        :return: The key of a new conversation, nothing is created on the OpenAI side
+        """
+        return f'chat_{uuid.uuid4().hex}'
+
+    def _save(self, role: str, content: str = None, tool_calls: List[Dict[str, Any]] = None,
+              tool_call_id: str = None) -> None:
+        self.approx_tokens += estimate_tokens(content) + (estimate_tokens(json.dumps(tool_calls)) if tool_calls else 0)
+        self.storage.execute('INSERT INTO conversation_messages (thread_id, role, content, tool_calls, tool_call_id, '
+                             'timestamp_created) VALUES (?, ?, ?, ?, ?, ?)',
+                             (self.thread_id, role, content, json.dumps(tool_calls) if tool_calls else None,
+                              tool_call_id, int(time.time())))
+
+    def load_history(self) -> List[Dict[str, Any]]:
+        """
+        Loads the last max_history_messages messages of the conversation. Tool calls are only kept with all their
+        outputs, as the API refuses unanswered calls (e.g. of a cancelled run) and outputs without their call.
+
+        :return: The messages in the Chat Completions format, oldest first
+        """
+        rows = self.storage.execute('SELECT role, content, tool_calls, tool_call_id FROM conversation_messages '
+                                    'WHERE thread_id = ? ORDER BY id DESC LIMIT ?',
+                                    (self.thread_id, self.max_history_messages))
+        rows.reverse()
+
+        messages = []
+        index = 0
+        while index < len(rows):
+            role, content, tool_calls, _ = rows[index]
+            index += 1
+
+            if role == 'tool':
+                # An output whose call is out of the window
+                continue
+
+            if role == 'assistant' and tool_calls:
+                calls = json.loads(tool_calls)
+                outputs = []
+                while index < len(rows) and rows[index][0] == 'tool':
+                    outputs.append(rows[index])
+                    index += 1
+
+                call_ids = {call['id'] for call in calls}
+                if call_ids <= {row[3] for row in outputs}:
+                    messages.append({'role': 'assistant', 'content': content, 'tool_calls': calls})
+                    messages.extend({'role': 'tool', 'tool_call_id': row[3], 'content': row[1]}
+                                    for row in outputs if row[3] in call_ids)
+                continue
+
+            messages.append({'role': role, 'content': content or ''})
+
+        return messages
+
+    async def add_message_to_thread(self, message: str) -> None:
+        with span("message_add"):
+            self._save('user', message)
+        logger.info("Added message to conversation %s", self.thread_id)
+
+    async def start_run(self, on_delta=None):
+        """
+        Requests the next answer of the conversation.
+        :param on_delta: Optional coroutine function called with every new piece of the answer's text. If set, the
+        completion is streamed.
+        :return: The same dict as OpenaiAssistant.get_response
+        """
+        messages = [{'role': 'system', 'content': self.instructions}] + self.load_history()
+
+        try:
+            with span("completion"):
+                if on_delta is None:
+                    response = await asyncio.wait_for(self._complete(messages), self.run_timeout)
+                else:
+                    response = await asyncio.wait_for(self._stream(messages, on_delta), self.run_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"The completion did not finish within {self.run_timeout} seconds")
+
+        if response['tool_calls']:
+            self._save('assistant', response['message'], tool_calls=response['tool_calls'])
+            logger.info("Completion %s requires action", response['run_id'])
+            return {"message": None, "run_id": response['run_id'],
+                    "tool_calls": [{"call_id": call['id'], "function_name": call['function']['name'],
+                                    "function_args": call['function']['arguments']}
+                                   for call in response['tool_calls']]}
+
+        message = response['message'] or ''
+        self._save('assistant', message)
+        logger.info("Got response in conversation %s for completion %s", self.thread_id, response['run_id'])
+
+        return {"message": message, "run_id": response['run_id'], "tool_calls": None}
+
+    async def continue_run(self, run_id: str, tool_outputs: List[Dict[str, str]], on_delta=None):
+        """
+        Stores the outputs of the tool calls of a round and requests the next answer.
+        :param run_id: The id of the completion that asked for the tool calls
+        :param tool_outputs: A list of {"tool_call_id": ..., "output": ...} dicts
+        :param on_delta: Optional coroutine function called with every new piece of the answer's text
+        :return: The same dict as OpenaiAssistant.get_response
+        """
+        for tool_output in tool_outputs:
+            self._save('tool', tool_output['output'], tool_call_id=tool_output['tool_call_id'])
+
+        return await self.start_run(on_delta)
+
+    async def summarize(self, instructions: str = SUMMARY_INSTRUCTIONS) -> str:
+        """
+        Asks the model for a summary of the conversation, without tools. The summary is not stored.
+        :param instructions: What the summary must contain
+        :return: The summary
+        """
+        messages = ([{'role': 'system', 'content': self.instructions}] + self.load_history()
+                    + [{'role': 'user', 'content': instructions}])
+
+        with span("summary"):
+            completion = await asyncio.wait_for(
+                self.client.chat.completions.create(model=self.model, messages=messages), self.run_timeout)
+
+        return completion.choices[0].message.content or ''
+
+    async def cancel_run(self, run_id: str) -> None:
+        """
+        Nothing runs on the OpenAI side between two requests. The unanswered tool calls of the run are left out of
+        the next requests by load_history.
+        """
+        logger.info("Abandoned completion %s", run_id)
+
+    async def recover_active_runs(self) -> int:
+        """
+        A conversation has no runs to get stuck.
+        """
+        return 0
+
+    async def measure_context(self) -> None:
+        """
+        context_tokens is already set from the usage of every completion.
+        """
+
+    async def _complete(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        completion = await self.client.chat.completions.create(model=self.model, messages=messages,
+                                                                tools=self.tools)
+        run_id_var.set(completion.id)
+        if getattr(completion, 'usage', None) is not None:
+            self.context_tokens = completion.usage.total_tokens
+
+        message = completion.choices[0].message
+        tool_calls = [{'id': call.id, 'type': 'function',
+                       'function': {'name': call.function.name, 'arguments': call.function.arguments}}
+                      for call in message.tool_calls or []]
+
+        return {'message': message.content, 'run_id': completion.id, 'tool_calls': tool_calls}
+
+    async def _stream(self, messages: List[Dict[str, Any]], on_delta) -> Dict[str, Any]:
+        stream = await self.client.chat.completions.create(model=self.model, messages=messages, tools=self.tools,
+                                                            stream=True)
+
+        run_id = None
+        text_parts = []
+        # The calls arrive in pieces, identified by their index
+        tool_calls: Dict[int, Dict[str, Any]] = {}
+
+        async for chunk in stream:
+            if run_id is None:
+                run_id = chunk.id
+                run_id_var.set(chunk.id)
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+            if delta.content:
+                text_parts.append(delta.content)
+                await on_delta(delta.content)
+
+            for call in delta.tool_calls or []:
+                entry = tool_calls.setdefault(call.index, {'id': None, 'type': 'function',
+                                                           'function': {'name': '', 'arguments': ''}})
+                if call.id:
+                    entry['id'] = call.id
+                if call.function is not None:
+                    entry['function']['name'] += call.function.name or ''
+                    entry['function']['arguments'] += call.function.arguments or ''
+
+        return {'message': ''.join(text_parts) or None, 'run_id': run_id,
+                'tool_calls': [tool_calls[index] for index in sorted(tool_calls)]}
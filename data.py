@@ -18,6 +18,32 @@ OPENAI_API_KEY = config['OPENAI']['OPENAI_API_KEY']
 
 ASSISTANT_ID = config['ASSISTANT']['ASSISTANT_ID']
 THREAD_ID = config['ASSISTANT']['THREAD_ID']
+STREAM_RESPONSES = config['ASSISTANT'].getboolean('STREAM_RESPONSES', fallback=False)
+MAX_ACTION_ROUNDS = config['ASSISTANT'].getint('MAX_ACTION_ROUNDS', fallback=10)
+TOOL_TIMEOUT = config['ASSISTANT'].getfloat('TOOL_TIMEOUT', fallback=30.0)
+# 'assistants' (OpenAI threads and runs) or 'chat' (Chat Completions, conversations stored in assistant.db)
+ENGINE = config['ASSISTANT'].get('ENGINE', fallback='assistants')
+CHAT_MODEL = config['ASSISTANT'].get('CHAT_MODEL', fallback='gpt-4o')
+MAX_HISTORY_MESSAGES = config['ASSISTANT'].getint('MAX_HISTORY_MESSAGES', fallback=50)
+# Approximate size in tokens after which a thread is summarized into a new one, 0 to never rotate
+MAX_THREAD_TOKENS = config['ASSISTANT'].getint('MAX_THREAD_TOKENS', fallback=100000)
+# Seconds after which a run is cancelled, tool calls included, 0 for no limit
+MAX_RUN_AGE = config['ASSISTANT'].getfloat('MAX_RUN_AGE', fallback=600.0)
+# What to do with the runs a crash or a restart left active on a thread: 'cancel', or 'resume' the recent ones
+STUCK_RUN_POLICY = config['ASSISTANT'].get('STUCK_RUN_POLICY', fallback='cancel')
+
+# Telegram actions per second of an account and in a single chat, the excess waits in a queue
+OUTBOUND_GLOBAL_RATE = config.getfloat('OUTBOUND', 'GLOBAL_RATE', fallback=1.0)
+OUTBOUND_CHAT_RATE = config.getfloat('OUTBOUND', 'CHAT_RATE', fallback=0.3)
+# Groups whose history is imported at the same time, and history requests per second for all of them
+BACKFILL_CONCURRENCY = config.getint('BACKFILL', 'CONCURRENCY', fallback=3)
+BACKFILL_RPC_RATE = config.getfloat('BACKFILL', 'RPC_RATE', fallback=2.0)
+# Attachments of the watched groups stored in MEDIA_FOLDER, up to MAX_FILE_SIZE_MB each, downloaded and uploaded
+# within BANDWIDTH_KBPS (0 for no limit)
+MEDIA_DOWNLOAD = config.getboolean('MEDIA', 'DOWNLOAD', fallback=True)
+MEDIA_MAX_FILE_SIZE_MB = config.getfloat('MEDIA', 'MAX_FILE_SIZE_MB', fallback=20.0)
+MEDIA_BANDWIDTH_KBPS = config.getfloat('MEDIA', 'BANDWIDTH_KBPS', fallback=1024.0)
+MEDIA_CONCURRENCY = config.getint('MEDIA', 'CONCURRENCY', fallback=2)
 
 SESSION_FILE = config['SESSION']['SESSION_FILE']
 API_ID = config['SESSION']['API_ID']
@@ -27,3 +53,20 @@ IP = config['PROXY']['IP']
 PORT = config['PROXY']['PORT']
 USERNAME = config['PROXY']['USERNAME']
 PASSWORD = config['PROXY']['PASSWORD']
+
+SUPERVISOR_WORKERS = config.getint('SUPERVISOR', 'WORKERS', fallback=1)
+SUPERVISOR_HEALTH_INTERVAL = config.getfloat('SUPERVISOR', 'HEALTH_INTERVAL', fallback=30.0)
+
+# Port of the Prometheus /metrics endpoint, 0 to disable it
+METRICS_PORT = config.getint('METRICS', 'PORT', fallback=0)
+LOG_LEVEL = config.get('METRICS', 'LOG_LEVEL', fallback='INFO')
+
+# Days the raw messages of the watched groups are kept before being rolled up into daily aggregates, 0 forever.
+# [RETENTION_GROUPS] sets the days of single groups, as group_username = days.
+RETENTION_KEEP_DAYS = config.getint('RETENTION', 'KEEP_DAYS', fallback=0)
+RETENTION_GROUPS = {group: int(days) for group, days in config.items('RETENTION_GROUPS')} \
+    if config.has_section('RETENTION_GROUPS') else {}
+# SQLite database the removed messages are copied to, empty to delete them
+RETENTION_ARCHIVE_PATH = config.get('RETENTION', 'ARCHIVE_PATH', fallback='') or None
+RETENTION_INTERVAL = config.getfloat('RETENTION', 'INTERVAL', fallback=3600.0)
+RETENTION_CHUNK_SIZE = config.getint('RETENTION', 'CHUNK_SIZE', fallback=1000)
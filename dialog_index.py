@@ -0,0 +1,190 @@
+"""
+In-memory index of the dialogs of the account, for membership checks without RPCs.
+"""
+
+import json
+import logging
+from typing import Any, Callable, Dict, Optional, Union
+
+from telethon import utils
+
+from metrics import EVENTS
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_username(username: str) -> str:
+    """
+    :param username: A username, @username or t.me link
+    :return: The bare username in lower case
+    """
+    return username.replace('https://t.me/', '').replace('@', '').strip().lower()
+
+
+class DialogIndex:
+    """
+    Loads the dialogs once and indexes their entities by username and peer id. The index is kept current from the
+    account's own join and leave actions and from ChatAction updates, so membership checks are local lookups.
+
+    With a storage, every full scan is saved as a snapshot of the peer ids and usernames. At the next start the index
+    is loaded from the snapshot and usable at once, while a new scan runs in the background. The chats of the
+    snapshot have no entity until that scan is done.
+    """
+
+    def __init__(self, client, storage=None, owner: str = None):
+        """
+        :param client: The Telethon client
+        :param storage: The storage of the database keeping the snapshot, None for no snapshot
+        :param owner: The account the dialogs belong to, several accounts share the database
+        """
+        self.client = client
+        self.storage = storage
+        self.owner = owner
+
+        self.by_id: Dict[int, Any] = {}
+        self.by_username: Dict[str, int] = {}
+
+        self.me_id: Optional[int] = None
+        self.loaded = False
+
+        # Called without arguments after every change of the index
+        self.on_change: Optional[Callable[[], None]] = None
+
+    async def refresh(self) -> None:
+        """
+        Rebuilds the index from a full scan of the dialogs.
+        """
+        by_id = {}
+        by_username = {}
+
+        async for dialog in self.client.iter_dialogs():
+            by_id[dialog.id] = dialog.entity
+            for username in self._get_usernames(dialog.entity):
+                by_username[username] = dialog.id
+
+        self.by_id = by_id
+        self.by_username = by_username
+
+        if self.me_id is None:
+            self.me_id = (await self.client.get_me()).id
+
+        self.loaded = True
+        logger.info("Indexed %s dialogs", len(self.by_id))
+        self._changed()
+
+        if self.storage is not None:
+            self._save_snapshot()
+
+    async def ensure_loaded(self) -> None:
+        if not self.loaded:
+            await self.refresh()
+
+    def load_snapshot(self) -> bool:
+        """
+        Fills the index from the snapshot of the last full scan.
+        :return: False if there is no snapshot, the index is left empty
+        """
+        if self.storage is None:
+            return False
+
+        rows = self.storage.execute('SELECT peer_id, usernames FROM dialog_snapshot WHERE owner = ?', (self.owner,))
+        if not rows:
+            return False
+
+        self.by_id = {peer_id: None for peer_id, _ in rows}
+        self.by_username = {username: peer_id for peer_id, usernames in rows for username in json.loads(usernames)}
+
+        self.loaded = True
+        logger.info("Loaded %s dialogs from the snapshot", len(self.by_id))
+        self._changed()
+        return True
+
+    def _save_snapshot(self) -> None:
+        usernames = {peer_id: [] for peer_id in self.by_id}
+        for username, peer_id in self.by_username.items():
+            usernames[peer_id].append(username)
+
+        with self.storage.connection() as conn:
+            conn.execute('DELETE FROM dialog_snapshot WHERE owner = ?', (self.owner,))
+            conn.executemany('INSERT INTO dialog_snapshot (owner, peer_id, usernames) VALUES (?, ?, ?)',
+                             [(self.owner, peer_id, json.dumps(names)) for peer_id, names in usernames.items()])
+
+    def add(self, entity) -> None:
+        """
+        Adds a chat the account has joined.
+        :param entity: The Telethon entity of the chat
+        """
+        peer_id = utils.get_peer_id(entity)
+        self.by_id[peer_id] = entity
+        for username in self._get_usernames(entity):
+            self.by_username[username] = peer_id
+        self._changed()
+
+    def remove(self, peer_id: int) -> None:
+        """
+        Removes a chat the account has left.
+        :param peer_id: The marked peer id of the chat
+        """
+        if peer_id not in self.by_id:
+            return
+
+        del self.by_id[peer_id]
+        # The chats loaded from the snapshot have no entity to get the usernames from
+        for username in [username for username, username_peer_id in self.by_username.items()
+                         if username_peer_id == peer_id]:
+            del self.by_username[username]
+        self._changed()
+
+    def get_peer_id(self, entity: Union[str, int]) -> Optional[int]:
+        """
+        :param entity: The username, link or peer id of a chat
+        :return: The peer id of the chat if the account is in it, otherwise None
+        """
+        if isinstance(entity, int) or str(entity).lstrip('-').isdigit():
+            peer_id = int(entity)
+            return peer_id if peer_id in self.by_id else None
+
+        return self.by_username.get(normalize_username(entity))
+
+    def get(self, entity: Union[str, int]):
+        """
+        :param entity: The username, link or peer id of a chat
+        :return: The Telethon entity of the chat if the account is in it, otherwise None. Also None for a chat
+        loaded from the snapshot, until the next full scan.
+        """
+        peer_id = self.get_peer_id(entity)
+        return self.by_id.get(peer_id) if peer_id is not None else None
+
+    def __contains__(self, entity: Union[str, int]) -> bool:
+        return self.get_peer_id(entity) is not None
+
+    async def on_chat_action(self, event) -> None:
+        """
+        Event handler for ChatAction updates concerning the account itself.
+        :param event: The ChatAction event
+        """
+        EVENTS.inc(type='chat_action')
+        if self.me_id is None or self.me_id not in (event.user_ids or []):
+            return
+
+        if event.user_joined or event.user_added:
+            chat = await event.get_chat()
+            if chat is not None:
+                self.add(chat)
+        elif event.user_left or event.user_kicked:
+            self.remove(event.chat_id)
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change()
+
+    @staticmethod
+    def _get_usernames(entity):
+        usernames = []
+        if getattr(entity, 'username', None):
+            usernames.append(entity.username.lower())
+        # Collectible usernames
+        for username in getattr(entity, 'usernames', None) or []:
+            if username.active:
+                usernames.append(username.username.lower())
+        return usernames
@@ -6,11 +6,14 @@ import sqlite3
 
 
 def get_table_names(conn):
-    """Return a list of table names."""
+    """Return a list of table names, without the internal tables of the virtual tables (like the FTS index)."""
     table_names = []
-    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    for table in tables.fetchall():
-        table_names.append(table[0])
+    tables = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
+    tables = tables.fetchall()
+    virtual_tables = [name for name, sql in tables if sql and sql.upper().startswith('CREATE VIRTUAL TABLE')]
+    for name, _ in tables:
+        if not any(name.startswith(f'{virtual_table}_') for virtual_table in virtual_tables):
+            table_names.append(name)
     return table_names
 
 
@@ -32,19 +35,19 @@ def get_database_info(conn):
     return table_dicts
 
 
-def get_schema():
-    with sqlite3.connect('assistant.db') as conn:
-        # cursor = conn.cursor()
-        # cursor.execute(query)
-        # return {'success': True, 'info': cursor.fetchall(), 'error': None}
+def get_schema(conn=None):
+    """Return the schema of the database as text. Opens assistant.db if no connection is given."""
+    if conn is None:
+        with sqlite3.connect('assistant.db') as conn:
+            return get_schema(conn)
 
-        database_schema_dict = get_database_info(conn)
-        database_schema_string = "\n".join(
-            [
-                f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}"
-                for table in database_schema_dict
-            ]
-        )
+    database_schema_dict = get_database_info(conn)
+    database_schema_string = "\n".join(
+        [
+            f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}"
+            for table in database_schema_dict
+        ]
+    )
 
     return database_schema_string
 
@@ -0,0 +1,178 @@
+"""
+Batched writer for the messages captured in the watched groups.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Sequence
+
+from metrics import DB_WRITE_BATCH_SECONDS, DB_WRITE_ROWS, QUEUE_DEPTH
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionWriter:
+    """
+    Event handlers push rows onto a bounded asyncio queue and return immediately. A background task collects them
+    into batches, bounded by size and by time, and a dedicated writer thread inserts each batch with a single
+    executemany and commit, so the event loop never waits for SQLite.
+    """
+
+    # Messages already stored (same chat and message id) are skipped
+    INSERT_SQL = ('INSERT OR IGNORE INTO messages (chat_id, message_id, from_id, group_username, message, '
+                  'timestamp_sent) VALUES (?, ?, ?, ?, ?, ?)')
+
+    def __init__(self, storage: Storage, insert_sql: str = INSERT_SQL, max_queue_size: int = 10000,
+                 batch_size: int = 500, flush_interval: float = 1.0):
+        """
+        :param storage: The storage of the database, the writer thread gets its own connection
+        :param insert_sql: The statement executed for every row
+        :param max_queue_size: The number of rows waiting to be written after which put() waits
+        :param batch_size: The maximal number of rows written in a single transaction
+        :param flush_interval: The maximal time a row waits for its batch to fill up, in seconds
+        """
+        self.storage = storage
+        self.insert_sql = insert_sql
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+
+        self.rows_written = 0
+        self.batches_written = 0
+        self.failed_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+        self._executor = None
+        self._conn = None
+        self._task = None
+
+    async def start(self) -> None:
+        """
+        Starts the writer thread and the batching task.
+        """
+        if self._task is not None:
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingestion-writer')
+        QUEUE_DEPTH.set_function(self.queue.qsize, queue='ingestion')
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, row: Sequence[Any]) -> None:
+        """
+        Queues a row for writing. Waits only when the queue is full.
+        :param row: The values for insert_sql
+        """
+        await self.queue.put(tuple(row))
+
+    async def stop(self) -> None:
+        """
+        Writes all the queued rows, then stops the batching task and the writer thread.
+        """
+        if self._task is None:
+            return
+
+        await self.queue.join()
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: The queue depth and the flush statistics
+        """
+        return {
+            'queue_depth': self.queue.qsize(),
+            'rows_written': self.rows_written,
+            'batches_written': self.batches_written,
+            'failed_rows': self.failed_rows,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'avg_flush_latency': self.total_flush_latency / self.batches_written if self.batches_written else 0.0,
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+
+            # Fill the batch until it's full or the oldest row waited flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await loop.run_in_executor(self._executor, self._flush, batch)
+            except Exception as e:
+                self.failed_rows += len(batch)
+                logger.error("Could not write %s messages: %s", len(batch), e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _flush(self, batch: List[tuple]) -> None:
+        """
+        Runs in the writer thread.
+        """
+        started = time.perf_counter()
+        self._write(batch)
+        latency = time.perf_counter() - started
+
+        self.rows_written += len(batch)
+        self.batches_written += 1
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
+    def _write(self, batch: List[tuple]) -> None:
+        if self._conn is None:
+            self._conn = self.storage.connect()
+
+        with DB_WRITE_BATCH_SECONDS.time(), self._conn:
+            self._conn.executemany(self.insert_sql, batch)
+        DB_WRITE_ROWS.inc(len(batch))
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RemoteIngestionWriter(IngestionWriter):
+    """
+    Ingestion writer for the worker processes of the supervisor: the batches are sent to the process owning the
+    database writer through a multiprocessing queue instead of being written here.
+    """
+
+    def __init__(self, batch_queue, max_queue_size: int = 10000, batch_size: int = 500, flush_interval: float = 1.0):
+        """
+        :param batch_queue: The multiprocessing queue read by the process owning the database writer
+        """
+        super().__init__(None, max_queue_size=max_queue_size, batch_size=batch_size, flush_interval=flush_interval)
+        self.batch_queue = batch_queue
+
+    def _write(self, batch: List[tuple]) -> None:
+        self.batch_queue.put(batch)
+
+    def _close(self) -> None:
+        pass
@@ -0,0 +1,184 @@
+"""
+Delayed and recurring actions of the assistant, persisted in assistant.db so they survive a restart.
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import math
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import SCHEDULED_JOBS
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class JobScheduler:
+    """
+    Keeps the due times of the pending jobs in a min-heap and a single timer task sleeping until the earliest one,
+    instead of a sleeping coroutine per job. Adding a job earlier than all the others wakes the timer up.
+
+    A job is marked done only after it ran, so the jobs missed while the bot was stopped (or interrupted by a crash)
+    are run as soon as the scheduler starts again. A recurring job missed several times runs once, then keeps its
+    period.
+    """
+
+    def __init__(self, storage: Storage, owner: str, execute: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]):
+        """
+        :param storage: The storage of the database
+        :param owner: The account the jobs belong to, several accounts share the database
+        :param execute: Coroutine function running a job, given its row as a dict, and returning a result dict
+        """
+        self.storage = storage
+        self.owner = owner
+        self.execute = execute
+
+        # Pending jobs by id, and (due_at, id) of the pending jobs. Entries of cancelled jobs stay in the heap and
+        # are skipped when they come up.
+        self.jobs: Dict[int, Dict[str, Any]] = {}
+        self._heap: List[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def load(self) -> None:
+        """
+        Loads the pending jobs of the owner, replacing the ones in memory.
+        """
+        rows = self.storage.execute('SELECT id, chat_id, action, arguments, due_at, interval_seconds, runs '
+                                    'FROM scheduled_jobs WHERE owner = ? AND status = ?', (self.owner, 'pending'))
+
+        self.jobs = {row[0]: self._to_job(row) for row in rows}
+        self._heap = [(job['due_at'], job_id) for job_id, job in self.jobs.items()]
+        heapq.heapify(self._heap)
+
+        overdue = sum(due_at <= time.time() for due_at, _ in self._heap)
+        logger.info("Loaded %s scheduled jobs, %s of them overdue", len(self.jobs), overdue)
+
+    @staticmethod
+    def _to_job(row: tuple) -> Dict[str, Any]:
+        return {'id': row[0], 'chat_id': row[1], 'action': row[2], 'arguments': json.loads(row[3]),
+                'due_at': row[4], 'interval_seconds': row[5], 'runs': row[6]}
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the timer and waits for the jobs running. The pending jobs stay in the database.
+        """
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    def add(self, chat_id: Optional[int], action: str, arguments: Dict[str, Any], due_at: float,
+            interval_seconds: Optional[int] = None) -> int:
+        """
+        Persists a job and schedules it.
+
+        :param chat_id: The chat the job was created in
+        :param action: The tool to call
+        :param arguments: The arguments of the tool
+        :param due_at: When the job runs, Unix epoch seconds
+        :param interval_seconds: The period of a recurring job, None for a single run
+        :return: The id of the job
+        """
+        with self.storage.connection() as conn:
+            cursor = conn.execute('INSERT INTO scheduled_jobs (owner, chat_id, action, arguments, due_at, '
+                                  'interval_seconds, status, runs, timestamp_created) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (self.owner, chat_id, action, json.dumps(arguments), math.ceil(due_at),
+                                   interval_seconds, 'pending', 0, int(time.time())))
+
+        job_id = cursor.lastrowid
+        self.jobs[job_id] = {'id': job_id, 'chat_id': chat_id, 'action': action, 'arguments': arguments,
+                             'due_at': math.ceil(due_at), 'interval_seconds': interval_seconds, 'runs': 0}
+        self._push(job_id)
+        return job_id
+
+    def list(self, chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        :param chat_id: Only the jobs of this chat, None for all the jobs
+        :return: The pending jobs, soonest first
+        """
+        jobs = [job for job in self.jobs.values() if chat_id is None or job['chat_id'] == chat_id]
+        return sorted(jobs, key=lambda job: job['due_at'])
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        :return: False if the job is not pending
+        """
+        if self.jobs.pop(job_id, None) is None:
+            return False
+
+        self.storage.execute('UPDATE scheduled_jobs SET status = ? WHERE id = ?', ('cancelled', job_id))
+        SCHEDULED_JOBS.inc(status='cancelled')
+        return True
+
+    def _push(self, job_id: int) -> None:
+        job = self.jobs[job_id]
+        heapq.heappush(self._heap, (job['due_at'], job_id))
+        if self._heap[0][1] == job_id:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due_at, job_id = heapq.heappop(self._heap)
+                job = self.jobs.get(job_id)
+                # Cancelled, or rescheduled with another due time
+                if job is None or job['due_at'] != due_at:
+                    continue
+
+                task = asyncio.create_task(self._run_job(job))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            timer = loop.call_later(self._heap[0][0] - now, self._wakeup.set) if self._heap else None
+            try:
+                await self._wakeup.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        logger.info("Running scheduled job %s: %s %s", job['id'], job['action'], job['arguments'])
+        try:
+            result = await self.execute(job)
+            failed = isinstance(result, dict) and result.get('success') is False
+            error = (result.get('error') or 'failed') if failed else None
+        except Exception as e:
+            error = str(e)
+
+        if error is not None:
+            logger.warning("Scheduled job %s failed: %s", job['id'], error)
+        SCHEDULED_JOBS.inc(status='failed' if error is not None else 'done')
+
+        job['runs'] += 1
+        if job['interval_seconds'] and job['id'] in self.jobs:
+            # The occurrences missed meanwhile are skipped
+            now = time.time()
+            periods = max(1, int((now - job['due_at']) // job['interval_seconds']) + 1)
+            job['due_at'] += periods * job['interval_seconds']
+            self.storage.execute('UPDATE scheduled_jobs SET due_at = ?, runs = ?, last_error = ?, timestamp_run = ? '
+                                 'WHERE id = ?', (job['due_at'], job['runs'], error, int(now), job['id']))
+            self._push(job['id'])
+            return
+
+        self.jobs.pop(job['id'], None)
+        self.storage.execute('UPDATE scheduled_jobs SET status = ?, runs = ?, last_error = ?, timestamp_run = ? '
+                             'WHERE id = ? AND status = ?',
+                             ('failed' if error is not None else 'done', job['runs'], error, int(time.time()),
+                              job['id'], 'pending'))
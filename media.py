@@ -0,0 +1,477 @@
+"""
+Media of the watched groups and of the assistant, stored once per content in MEDIA_FOLDER, with the Telegram handles
+to send them again without uploading them.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import random
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputDocument, InputFile, InputFileBig, InputPhoto
+
+from metrics import MEDIA_BYTES, MEDIA_FILES, QUEUE_DEPTH
+from outbound import TokenBucket
+from storage import Storage
+from telegrambot import raise_flood_waits
+
+logger = logging.getLogger(__name__)
+
+# The largest part of a file transfer allowed by Telegram, in bytes
+PART_SIZE = 512 * 1024
+# Files larger than this are uploaded as big files
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+
+def get_media_info(message) -> Optional[Dict[str, Any]]:
+    """
+    :param message: A Telethon message
+    :return: The kind, Telegram id, size, mime type, name and extension of the attachment of the message, None if it
+    has no photo or document
+    """
+    if message.photo is not None:
+        kind, telegram_file_id = 'photo', message.photo.id
+    elif message.document is not None:
+        kind = ('voice' if message.voice else 'video' if message.video else 'audio' if message.audio
+                else 'document')
+        telegram_file_id = message.document.id
+    else:
+        return None
+
+    return {'kind': kind, 'telegram_file_id': telegram_file_id, 'size': message.file.size,
+            'mime_type': message.file.mime_type, 'file_name': message.file.name, 'ext': message.file.ext or ''}
+
+
+class MediaStore:
+    """
+    Downloads the attachments of the watched groups in the background, a few files at a time, each in parts of
+    512 KB fetched in parallel, all the transfers sharing a bandwidth budget. A file is stored under its SHA-256, so
+    the same file sent to ten groups is stored once, and a file already known by its Telegram id isn't downloaded
+    again.
+
+    The handles Telegram gives for a file are kept per account: the photo or document of a message it was received
+    or sent in, and the parts of its last upload. Sending a stored file again reuses them instead of uploading it.
+    """
+
+    def __init__(self, storage: Storage, folder: str, owner: str, download: bool = True,
+                 max_file_size: int = 20 * 1024 * 1024, bandwidth: float = 1024 * 1024, concurrency: int = 2,
+                 parallel_parts: int = 4, queue_size: int = 1000, upload_ttl: float = 86400.0):
+        """
+        :param storage: The storage of the database
+        :param folder: The folder of the files, MEDIA_FOLDER
+        :param owner: The account the Telegram handles belong to, several accounts share the database
+        :param download: Whether to download the attachments of the watched groups
+        :param max_file_size: The attachments larger than this are not downloaded, in bytes
+        :param bandwidth: The bytes per second of all the downloads and uploads, 0 for no limit
+        :param concurrency: The number of attachments downloaded at the same time
+        :param parallel_parts: The number of parts of a file transferred at the same time
+        :param queue_size: The number of attachments waiting for a download, the next ones are dropped
+        :param upload_ttl: How long the parts of an upload are reused, Telegram drops them after a while, in seconds
+        """
+        self.storage = storage
+        self.folder = folder
+        self.owner = owner
+        self.download = download
+        self.max_file_size = max_file_size
+        self.concurrency = concurrency
+        self.parallel_parts = parallel_parts
+        self.upload_ttl = upload_ttl
+
+        # A burst must hold at least a whole part
+        self.bucket = TokenBucket(bandwidth, max(bandwidth, PART_SIZE)) if bandwidth else None
+        # Monotonic time before which no transfer starts, after a flood wait
+        self.paused_until = 0.0
+
+        self.client = None
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._workers: List[asyncio.Task] = []
+        # Telegram file id -> future of the SHA-256, for the files being downloaded
+        self._downloading: Dict[int, asyncio.Future] = {}
+        self._budget_lock = None
+        # File writes and hashing, off the event loop
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='media-io')
+
+    async def start(self, client) -> None:
+        """
+        :param client: The connected Telethon client
+        """
+        self.client = client
+        self._budget_lock = asyncio.Lock()
+        QUEUE_DEPTH.set_function(self.queue.qsize, queue='media')
+        if self.download and not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """
+        Stops the downloads. The attachments still queued are not downloaded.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self.client = None
+
+    def enqueue(self, message, group_username: str) -> None:
+        """
+        Queues the attachment of a message of a watched group for download, if it has one.
+
+        :param message: The Telethon message
+        :param group_username: The watched group the message was sent in
+        """
+        if not self.download or message.media is None:
+            return
+
+        info = get_media_info(message)
+        if info is None:
+            return
+        if not info['size'] or info['size'] > self.max_file_size:
+            MEDIA_FILES.inc(status='skipped')
+            return
+
+        try:
+            self.queue.put_nowait((message, group_username, info))
+        except asyncio.QueueFull:
+            logger.warning("Media queue full, dropped the %s of message %s in %s", info['kind'], message.id,
+                           group_username)
+            MEDIA_FILES.inc(status='dropped')
+
+    async def _worker(self) -> None:
+        while True:
+            message, group_username, info = await self.queue.get()
+            try:
+                await self._store_message(message, group_username, info)
+            except Exception as e:
+                logger.error("Could not store the %s of message %s in %s: %s", info['kind'], message.id,
+                             group_username, e)
+                MEDIA_FILES.inc(status='failed')
+
+    async def _store_message(self, message, group_username: str, info: Dict[str, Any]) -> None:
+        loop = asyncio.get_running_loop()
+
+        file_id = info['telegram_file_id']
+        rows = self.storage.execute('SELECT sha256 FROM media_messages WHERE telegram_file_id = ? LIMIT 1',
+                                    (file_id,))
+        if rows or file_id in self._downloading:
+            # Forwarded or sent again, Telegram kept the same file
+            sha256 = rows[0][0] if rows else await asyncio.shield(self._downloading[file_id])
+            MEDIA_FILES.inc(status='duplicate')
+        else:
+            future = self._downloading[file_id] = loop.create_future()
+            try:
+                temp_path = await self._download(message.media, info['size'])
+                sha256, created = await loop.run_in_executor(self._io, self._commit, temp_path, info['ext'],
+                                                             info['size'], info['mime_type'])
+            except BaseException as e:
+                future.set_exception(e if isinstance(e, Exception) else ConnectionError("The download was stopped"))
+                # Retrieved here too, no other message may be waiting for it
+                future.exception()
+                raise
+            else:
+                future.set_result(sha256)
+            finally:
+                del self._downloading[file_id]
+            MEDIA_FILES.inc(status='stored' if created else 'duplicate')
+
+        await loop.run_in_executor(self._io, self._record_message, message, group_username, info, sha256)
+
+    async def _download(self, media, size: int) -> str:
+        """
+        Downloads a file in parts, fetched in parallel and written at their offset in a temporary file.
+        :return: The path of the temporary file
+        """
+        loop = asyncio.get_running_loop()
+        temp_folder = os.path.join(self.folder, 'tmp')
+        os.makedirs(temp_folder, exist_ok=True)
+        temp_path = os.path.join(temp_folder, f'{uuid.uuid4().hex}.part')
+
+        async def download_part(index: int) -> None:
+            offset = index * PART_SIZE
+            data = await self._transfer(min(PART_SIZE, size - offset),
+                                        lambda: self._download_part(media, offset, size))
+            await loop.run_in_executor(self._io, self._write_part, file, offset, data)
+            MEDIA_BYTES.inc(len(data), direction='download')
+
+        file = open(temp_path, 'wb')
+        try:
+            await self._run_parts(download_part, math.ceil(size / PART_SIZE))
+        except BaseException:
+            file.close()
+            os.remove(temp_path)
+            raise
+        file.close()
+
+        return temp_path
+
+    async def _download_part(self, media, offset: int, size: int) -> bytes:
+        async for chunk in self.client.iter_download(media, offset=offset, request_size=PART_SIZE, limit=1,
+                                                     file_size=size):
+            return chunk
+        return b''
+
+    @staticmethod
+    def _write_part(file, offset: int, data: bytes) -> None:
+        """
+        Runs in the io thread, the only one writing the file.
+        """
+        file.seek(offset)
+        file.write(data)
+
+    async def _run_parts(self, transfer_part: Callable[[int], Awaitable[None]], parts: int) -> None:
+        """
+        Transfers the parts of a file, parallel_parts at a time. If a part fails, the others are cancelled.
+        """
+        semaphore = asyncio.Semaphore(self.parallel_parts)
+
+        async def run(index: int) -> None:
+            async with semaphore:
+                await transfer_part(index)
+
+        tasks = [asyncio.create_task(run(index)) for index in range(parts)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _transfer(self, size: int, request: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Makes the request of a part within the bandwidth budget. Flood waits pause all the transfers and the request
+        is tried again.
+        """
+        while True:
+            async with self._budget_lock:
+                while True:
+                    now = time.monotonic()
+                    delay = max(self.paused_until - now, self.bucket.delay(now, size) if self.bucket else 0.0)
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                if self.bucket is not None:
+                    self.bucket.take(time.monotonic(), size)
+
+            try:
+                with raise_flood_waits():
+                    return await request()
+            except FloodWaitError as e:
+                logger.warning("Media transfer hit a flood wait of %ss", e.seconds)
+                self.paused_until = max(self.paused_until, time.monotonic() + e.seconds)
+
+    def _commit(self, temp_path: str, ext: str, size: int, mime_type: Optional[str]) -> tuple:
+        """
+        Moves a complete file to its content address, unless the same content is already stored. Runs in the io
+        thread.
+        :return: The SHA-256 of the file, and whether it was new
+        """
+        digest = hashlib.sha256()
+        with open(temp_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+
+        relative_path = os.path.join(sha256[:2], sha256 + ext)
+        path = os.path.join(self.folder, relative_path)
+        created = not os.path.exists(path)
+        if created:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        else:
+            os.remove(temp_path)
+
+        self.storage.execute('INSERT OR IGNORE INTO media_files (sha256, size, mime_type, path, timestamp_stored) '
+                             'VALUES (?, ?, ?, ?, ?)', (sha256, size, mime_type, relative_path, int(time.time())))
+        return sha256, created
+
+    def _record_message(self, message, group_username: str, info: Dict[str, Any], sha256: str) -> None:
+        """
+        Runs in the io thread.
+        """
+        with self.storage.connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO media_messages (chat_id, message_id, group_username, kind, sha256, '
+                         'telegram_file_id, file_name, timestamp_sent) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (message.chat_id, message.id, group_username, info['kind'], sha256, info['telegram_file_id'],
+                          info['file_name'], int(message.date.timestamp())))
+            self._save_message_handle(conn, message, sha256)
+
+    def _save_message_handle(self, conn, message, sha256: str) -> None:
+        """
+        Keeps the photo or document of a message, to send its file again.
+        """
+        media = message.photo if message.photo is not None else message.document
+        if media is None:
+            return
+
+        conn.execute('INSERT OR REPLACE INTO media_handles (owner, sha256, kind, media_id, access_hash, '
+                     'file_reference, parts, name, timestamp_updated) VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)',
+                     (self.owner, sha256, 'photo' if message.photo is not None else 'document', media.id,
+                      media.access_hash, media.file_reference, int(time.time())))
+
+    async def store_file(self, file: Union[str, bytes], ext: str = '') -> str:
+        """
+        Stores a local file, e.g. a profile picture, under its content address.
+
+        :param file: The path or the content of the file
+        :param ext: The extension of the file, taken from the path by default
+        :return: The SHA-256 of the file
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, self._store_file, file, ext)
+
+    def _store_file(self, file: Union[str, bytes], ext: str) -> str:
+        temp_folder = os.path.join(self.folder, 'tmp')
+        os.makedirs(temp_folder, exist_ok=True)
+        temp_path = os.path.join(temp_folder, f'{uuid.uuid4().hex}.part')
+
+        if isinstance(file, bytes):
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(file)
+        else:
+            ext = ext or os.path.splitext(file)[1].lower()
+            shutil.copyfile(file, temp_path)
+
+        sha256, _ = self._commit(temp_path, ext, os.path.getsize(temp_path), None)
+        return sha256
+
+    def get_file(self, sha256: str) -> Optional[Dict[str, Any]]:
+        """
+        :return: The path, size and mime type of a stored file, None if it is unknown
+        """
+        rows = self.storage.execute('SELECT path, size, mime_type FROM media_files WHERE sha256 = ?', (sha256,))
+        if not rows:
+            return None
+        return {'path': os.path.join(self.folder, rows[0][0]), 'size': rows[0][1], 'mime_type': rows[0][2]}
+
+    def _get_handle(self, sha256: str, kind: str):
+        rows = self.storage.execute('SELECT media_id, access_hash, file_reference, parts, name, timestamp_updated '
+                                    'FROM media_handles WHERE owner = ? AND sha256 = ? AND kind = ?',
+                                    (self.owner, sha256, kind))
+        if not rows:
+            return None
+
+        media_id, access_hash, file_reference, parts, name, timestamp_updated = rows[0]
+        if kind == 'photo':
+            return InputPhoto(media_id, access_hash, file_reference)
+        if kind == 'document':
+            return InputDocument(media_id, access_hash, file_reference)
+        if time.time() - timestamp_updated > self.upload_ttl:
+            return None
+        return self._input_file(media_id, parts, name, self.get_file(sha256)['size'])
+
+    @staticmethod
+    def _input_file(file_id: int, parts: int, name: str, size: int):
+        if size > BIG_FILE_SIZE:
+            return InputFileBig(file_id, parts, name)
+        return InputFile(file_id, parts, name, '')
+
+    def _drop_handle(self, sha256: str, kind: str) -> None:
+        self.storage.execute('DELETE FROM media_handles WHERE owner = ? AND sha256 = ? AND kind = ?',
+                             (self.owner, sha256, kind))
+
+    async def upload(self, sha256: str):
+        """
+        Uploads a stored file in parts transferred in parallel, or returns the handle of its last upload.
+        :return: The InputFile or InputFileBig of the file, and whether it came from the cache
+        """
+        handle = self._get_handle(sha256, 'upload')
+        if handle is not None:
+            MEDIA_FILES.inc(status='upload_cached')
+            return handle, True
+
+        stored = self.get_file(sha256)
+        if stored is None:
+            raise ValueError(f"Unknown media {sha256}")
+
+        loop = asyncio.get_running_loop()
+        path, size = stored['path'], stored['size']
+        file_id = random.getrandbits(63)
+        parts = max(1, math.ceil(size / PART_SIZE))
+
+        async def upload_part(index: int) -> None:
+            data = await loop.run_in_executor(self._io, self._read_part, path, index * PART_SIZE)
+            if size > BIG_FILE_SIZE:
+                request = SaveBigFilePartRequest(file_id, index, parts, data)
+            else:
+                request = SaveFilePartRequest(file_id, index, data)
+            await self._transfer(len(data), lambda: self.client(request))
+            MEDIA_BYTES.inc(len(data), direction='upload')
+
+        await self._run_parts(upload_part, parts)
+        MEDIA_FILES.inc(status='uploaded')
+
+        # The name gives Telegram the type of the file
+        name = os.path.basename(path)
+        self.storage.execute('INSERT OR REPLACE INTO media_handles (owner, sha256, kind, media_id, access_hash, '
+                             'file_reference, parts, name, timestamp_updated) VALUES (?, ?, ?, ?, NULL, NULL, ?, ?, ?)',
+                             (self.owner, sha256, 'upload', file_id, parts, name, int(time.time())))
+
+        return self._input_file(file_id, parts, name, size), False
+
+    @staticmethod
+    def _read_part(path: str, offset: int) -> bytes:
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            return file.read(PART_SIZE)
+
+    async def run_with_upload(self, sha256: str, action: Callable[[Any], Awaitable[Any]]) -> Any:
+        """
+        Runs an action needing an uploaded file with the cached upload of a stored file, and with a new upload if
+        Telegram dropped the cached one.
+
+        :param sha256: The stored file
+        :param action: Coroutine function taking the InputFile
+        :return: The result of the action
+        """
+        handle, cached = await self.upload(sha256)
+        try:
+            return await action(handle)
+        except FloodWaitError:
+            raise
+        except Exception as e:
+            if not cached:
+                raise
+            logger.info("The upload of %s expired (%s), uploading it again", sha256, e)
+
+        self._drop_handle(sha256, 'upload')
+        handle, _ = await self.upload(sha256)
+        return await action(handle)
+
+    async def send(self, entity, sha256: str, caption: str = None):
+        """
+        Sends a stored file with the photo or document it was last received or sent as, uploading it only if there
+        is none or they are no longer valid.
+
+        :param entity: The chat to send the file to
+        :param sha256: The stored file
+        :param caption: The text of the message
+        :return: The sent message
+        """
+        for kind in ('photo', 'document'):
+            handle = self._get_handle(sha256, kind)
+            if handle is None:
+                continue
+            try:
+                message = await self.client.send_file(entity, handle, caption=caption)
+                MEDIA_FILES.inc(status='sent_cached')
+                return message
+            except FloodWaitError:
+                raise
+            except Exception as e:
+                # E.g. an expired file reference
+                logger.info("The %s handle of %s is no longer valid: %s", kind, sha256, e)
+                self._drop_handle(sha256, kind)
+
+        message = await self.run_with_upload(sha256, lambda file: self.client.send_file(entity, file,
+                                                                                          caption=caption))
+        with self.storage.connection() as conn:
+            self._save_message_handle(conn, message, sha256)
+        return message
@@ -0,0 +1,135 @@
+"""
+Progressively edit a Telegram message while the assistant's answer is being streamed.
+"""
+
+import asyncio
+import logging
+
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+
+from outbound import PRIORITY_OWNER
+
+logger = logging.getLogger(__name__)
+
+
+class MessageStreamer:
+    """
+    Sends a placeholder reply and keeps editing it as new text arrives. Edits are coalesced: chunks pushed while an
+    edit is pending are merged into the next one, and two edits of the same message are never closer than
+    ``min_interval`` seconds, which keeps the bot inside Telegram's edit limits.
+    """
+
+    # Telegram refuses longer messages, the text continues in a new message
+    MAX_MESSAGE_LENGTH = 4096
+
+    def __init__(self, event, placeholder: str = '...', min_interval: float = 1.0, outbound=None):
+        """
+        :param event: The event to reply to
+        :param placeholder: The text of the message shown before the first token arrives
+        :param min_interval: The minimal delay between two edits, in seconds
+        :param outbound: The OutboundScheduler the sends and edits go through, as replies to the owner. None to make
+        them directly
+        """
+        self.event = event
+        self.placeholder = placeholder
+        self.min_interval = min_interval
+        self.outbound = outbound
+
+        self.text = ''
+        self.message = None
+
+        self._offset = 0  # Position in self.text where the current message starts
+        self._shown = ''  # What the current message displays now
+        self._last_edit = 0.0
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        """
+        Send the placeholder message.
+        """
+        self.message = await self._request(lambda: self.event.respond(self.placeholder), 'reply')
+        self._last_edit = asyncio.get_running_loop().time()
+
+    async def push(self, chunk: str) -> None:
+        """
+        Append a chunk of text. The message is edited later, together with all chunks pushed in the meantime.
+        :param chunk: The new text
+        """
+        self.text += chunk
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def finish(self, text: str = None) -> None:
+        """
+        Show the final text, bypassing the rate limit.
+        :param text: The complete answer, if it differs from the text pushed so far
+        """
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+
+        if text is not None:
+            self.text = text
+
+        if self.message is None:
+            await self.start()
+
+        await self._flush()
+
+    async def _delayed_flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        delay = self._last_edit + self.min_interval - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        await self._flush()
+
+    async def _flush(self) -> None:
+        async with self._lock:
+            # Close the messages that are full and continue in a new one
+            while len(self.text) - self._offset > self.MAX_MESSAGE_LENGTH:
+                end = self._offset + self.MAX_MESSAGE_LENGTH
+                await self._edit(self.text[self._offset:end])
+                self._offset = end
+                self.message = await self._request(lambda: self.event.respond(self.placeholder), 'reply')
+                self._shown = self.placeholder
+
+            await self._edit(self.text[self._offset:] or self.placeholder)
+
+    async def _request(self, action, kind: str):
+        """
+        Makes a request through the outbound scheduler, which keeps it within the rate limits of the chat.
+        :param action: Coroutine function making the request
+        :param kind: The name of the request in the metrics
+        :return: The result of the request
+        """
+        if self.outbound is None:
+            return await action()
+        return await self.outbound.submit(action, key=self.event.chat_id, priority=PRIORITY_OWNER, kind=kind)
+
+    async def _edit(self, text: str) -> None:
+        if text == self._shown:
+            return
+
+        message = self.message
+        try:
+            await self._request(lambda: message.edit(text), 'edit')
+            self._shown = text
+        except MessageNotModifiedError:
+            self._shown = text
+        except FloodWaitError as e:
+            if self.outbound is not None:
+                # The scheduler already waited as long as it allows
+                raise
+            # Wait for Telegram and keep the text, the next flush will send it
+            logger.warning("Flood wait while editing the streamed message: %ss", e.seconds)
+            await asyncio.sleep(e.seconds)
+            await self.message.edit(text)
+            self._shown = text
+
+        self._last_edit = asyncio.get_running_loop().time()
@@ -0,0 +1,269 @@
+"""
+Built-in instrumentation: counters, gauges and latency histograms in the Prometheus text format, and spans
+correlated by chat and run id.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast SQLite write to a long assistant run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Correlation ids of the current span, inherited by the tasks created inside it
+chat_id_var: contextvars.ContextVar = contextvars.ContextVar('chat_id', default=None)
+run_id_var: contextvars.ContextVar = contextvars.ContextVar('run_id', default=None)
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}'] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    A value set directly, or read from a function when the metrics are rendered.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self._functions[self._key(labels)] = function
+
+    def _samples(self) -> List[str]:
+        values = dict(self._values)
+        for key, function in list(self._functions.items()):
+            try:
+                values[key] = function()
+            except Exception:
+                continue
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: counts per bucket (the last one is +Inf), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bucket == float('inf') else f'le="{bucket!r}"'
+                samples.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            samples.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total[0]}')
+            samples.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Modules can be imported several times (e.g. as __main__), keep the first instance
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RUN_PHASE_SECONDS = REGISTRY.register(Histogram(
+    'assistant_run_phase_seconds', 'Duration of each phase of an assistant reply.', ['phase']))
+TOOL_SECONDS = REGISTRY.register(Histogram(
+    'assistant_tool_seconds', 'Duration of each tool call.', ['tool']))
+TOOL_CALLS = REGISTRY.register(Counter(
+    'assistant_tool_calls_total', 'Tool calls by tool and outcome.', ['tool', 'status']))
+DB_WRITE_BATCH_SECONDS = REGISTRY.register(Histogram(
+    'assistant_db_write_batch_seconds', 'Duration of the ingestion batch writes.'))
+DB_WRITE_ROWS = REGISTRY.register(Counter(
+    'assistant_db_write_rows_total', 'Rows written by the ingestion writer.'))
+TELEGRAM_RPC_SECONDS = REGISTRY.register(Histogram(
+    'telegram_rpc_seconds', 'Duration of the Telethon RPCs.', ['method']))
+TELEGRAM_RPC_ERRORS = REGISTRY.register(Counter(
+    'telegram_rpc_errors_total', 'Failed Telethon RPCs.', ['method', 'error']))
+EVENTS = REGISTRY.register(Counter(
+    'telegram_events_total', 'Telegram events handled, by type.', ['type']))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'assistant_queue_depth', 'Items waiting in the internal queues.', ['queue']))
+OUTBOUND_ACTIONS = REGISTRY.register(Counter(
+    'telegram_outbound_actions_total', 'Outbound Telegram actions by kind and outcome.', ['kind', 'status']))
+OUTBOUND_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'telegram_outbound_wait_seconds', 'Time an outbound action waited for the rate limits.', ['kind']))
+SCHEDULED_JOBS = REGISTRY.register(Counter(
+    'assistant_scheduled_jobs_total', 'Scheduled jobs run or cancelled, by outcome.', ['status']))
+BACKFILL_MESSAGES = REGISTRY.register(Counter(
+    'assistant_backfill_messages_total', 'Past messages imported by the history backfills.'))
+RETENTION_ROWS = REGISTRY.register(Counter(
+    'assistant_retention_rows_total', 'Raw messages rolled up by the retention, by action.', ['action']))
+STARTUP_SECONDS = REGISTRY.register(Histogram(
+    'assistant_startup_phase_seconds', 'Duration of each phase of the startup of an account.', ['phase']))
+MEDIA_FILES = REGISTRY.register(Counter(
+    'assistant_media_files_total', 'Media files handled by the media store, by outcome.', ['status']))
+MEDIA_BYTES = REGISTRY.register(Counter(
+    'assistant_media_bytes_total', 'Bytes of media transferred, by direction.', ['direction']))
+RUN_RECOVERIES = REGISTRY.register(Counter(
+    'assistant_run_recoveries_total', 'Runs found stuck on a thread, by the status they were ended with.', ['status']))
+
+
+@contextmanager
+def trace_context(chat_id: Optional[int] = None, run_id: Optional[str] = None) -> Iterator[None]:
+    """
+    Sets the correlation ids logged by the spans opened inside the block, including in the tasks it creates.
+    """
+    tokens = []
+    if chat_id is not None:
+        tokens.append((chat_id_var, chat_id_var.set(chat_id)))
+    if run_id is not None:
+        tokens.append((run_id_var, run_id_var.set(run_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@contextmanager
+def span(phase: str, histogram: Histogram = RUN_PHASE_SECONDS, **labels: str) -> Iterator[None]:
+    """
+    Times a block into a histogram and logs it with the chat and run ids of the current trace context.
+
+    :param phase: The name of the span, used as the "phase" label of the run phase histogram
+    :param histogram: The histogram receiving the duration
+    :param labels: The labels of the histogram, {"phase": phase} by default
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        histogram.observe(duration, **(labels or {'phase': phase}))
+        logger.debug('span=%s chat=%s run=%s duration=%.3fs', phase, chat_id_var.get(), run_id_var.get(), duration)
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server exposing the registry in the Prometheus text format on /metrics.
+    """
+
+    def __init__(self, port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self._server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except Exception as e:
+            logger.debug('Metrics request failed: %s', e)
+        finally:
+            writer.close()
@@ -1,22 +1,40 @@
+import asyncio
 import configparser
 import json
+import logging
 import time
+from typing import Awaitable, Callable, Dict, List
 
-from openai import OpenAI
+from openai import APIError, BadRequestError, OpenAI
+
+from metrics import RUN_RECOVERIES, run_id_var, span
+from tool_output import CHARS_PER_TOKEN
+from tool_registry import load_functions
+
+logger = logging.getLogger(__name__)
+
+INSTRUCTIONS = ("You are a personal assistant bot on Telegram. You can act like a real user and do whatever your "
+                "master asks you to do. Don't make assumptions about what values to plug into functions. "
+                "Ask for clarification if a user request is ambiguous.")
+
+SUMMARY_INSTRUCTIONS = ("Summarize the conversation so far for your own later use: the user's goals, preferences and "
+                        "open requests, the decisions made and the facts learned (names, groups, ids, dates). "
+                        "Be compact, use short bullet points and don't call any function.")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text or '') // CHARS_PER_TOKEN + 1
 
 
 def setup(client):
     # Load the functions from the json file
-    with open('functions.json', 'r') as json_file:
-        functions = json.load(json_file)
-        print(f"Loaded functions: {functions}")
+    functions = load_functions()
+    print(f"Loaded functions: {functions}")
 
     # Create a new assistant and thread
     assistant = client.beta.assistants.create(
         name="Telegram Assistant",
-        instructions="You are a personal assistant bot on Telegram. You can act like a real user and do whatever your "
-                     "master asks you to do. Don't make assumptions about what values to plug into functions. "
-                     "Ask for clarification if a user request is ambiguous.",
+        instructions=INSTRUCTIONS,
         tools=functions,
         model="gpt-4"
     )
@@ -28,86 +46,458 @@ def setup(client):
 
 
 class OpenaiAssistant:
-    def __init__(self, client, assistant_id, thread_id):
+    """
+    Asyncio-native wrapper around the Assistants API. Every call goes through ``AsyncOpenAI`` so a long run
+    never blocks the Telethon event loop.
+    """
+
+    # Statuses after which a run will not change anymore
+    TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled", "incomplete")
+    # Statuses of a run that locks its thread: no message or run can be added until it ends
+    ACTIVE_STATUSES = ("queued", "in_progress", "requires_action", "cancelling")
+    # Policies for the runs found active on a thread
+    STUCK_RUN_POLICIES = ("cancel", "resume")
+
+    # The output given to the tool calls of a recovered run, their actions were lost with the process running them
+    LOST_ACTION_OUTPUT = json.dumps({"success": False, "info": None,
+                                     "error": "Interrupted: the bot restarted while running this action. It may or "
+                                              "may not have been done, check before running it again."})
+
+    def __init__(self, client, assistant_id, thread_id, poll_interval: float = 0.25, max_poll_interval: float = 2.0,
+                 poll_backoff: float = 1.5, run_timeout: float = 120.0, max_run_age: float = 600.0,
+                 stuck_run_policy: str = "cancel", tools: List[Dict] = None):
+        """
+        :param client: An ``AsyncOpenAI`` client
+        :param assistant_id: The id of the OpenAI assistant
+        :param thread_id: The id of the OpenAI thread
+        :param poll_interval: The first delay between two run status checks, in seconds
+        :param max_poll_interval: The upper bound of the delay between two run status checks, in seconds
+        :param poll_backoff: The factor the delay is multiplied by after every check that found the run still busy
+        :param run_timeout: How long to wait for a run before cancelling it, in seconds
+        :param max_run_age: Hard deadline of a run from its creation, tool calls included, in seconds. 0 for none
+        :param stuck_run_policy: What to do with the runs found active on the thread (see recover_active_runs):
+        'cancel' or 'resume'
+        :param tools: The tools sent with every run, the ones of functions.json by default. They override the tools
+        saved on the assistant, so a function added to functions.json is available without updating the assistant
+        """
+        if stuck_run_policy not in self.STUCK_RUN_POLICIES:
+            raise ValueError(f"Unknown stuck run policy {stuck_run_policy}, expected 'cancel' or 'resume'")
+
         self.client = client
         self.assistant_id = assistant_id
         self.thread_id = thread_id
-
-    def add_message_to_thread(self, message: str) -> None:
-        message = self.client.beta.threads.messages.create(
-            thread_id=self.thread_id,
-            role="user",
-            content=message
-        )
-        print(f"Added message to thread {self.thread_id}: {message}")
-
-    def send_command(self, instructions: str = ''):
-        run = self.client.beta.threads.runs.create(
+        self.tools = load_functions() if tools is None else tools
+
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+        self.run_timeout = run_timeout
+        self.max_run_age = max_run_age
+        self.stuck_run_policy = stuck_run_policy
+
+        # Event loop time at which the current run hits max_run_age, None without a run or a max_run_age
+        self.run_deadline = None
+
+        # Size of the thread: the tokens added through this object, estimated from the text, and the context size
+        # reported by the API for the last run (None until measure_context is called after a run)
+        self.approx_tokens = 0
+        self.context_tokens = None
+        # The last completed run that reported its usage, not measured yet
+        self.unmeasured_run_id = None
+
+    @staticmethod
+    async def create_thread(client) -> str:
+        """
+        :param client: An ``AsyncOpenAI`` client
+        :return: The id of a new OpenAI thread
+        """
+        thread = await client.beta.threads.create()
+        return thread.id
+
+    async def add_message_to_thread(self, message: str) -> None:
+        self.approx_tokens += estimate_tokens(message)
+        with span("message_add"):
+            message = await self._unlocked(lambda: self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=message
+            ))
+        logger.info("Added message to thread %s: %s", self.thread_id, message.id)
+
+    async def _unlocked(self, request: Callable[[], Awaitable]):
+        """
+        Makes a request the API refuses while the thread has an active run. If it is refused, the runs stuck on the
+        thread are recovered and the request is made once more.
+        :param request: Coroutine function making the request
+        :return: The result of the request
+        """
+        try:
+            return await request()
+        except BadRequestError as e:
+            if "active" not in str(e):
+                raise
+            logger.warning("Thread %s is locked by an active run: %s", self.thread_id, e)
+
+        await self.recover_active_runs()
+        return await request()
+
+    async def _create_run(self, **kwargs):
+        """
+        Creates a run on the thread and starts its hard deadline.
+        :param kwargs: Passed to the API, besides the thread, the assistant and the tools
+        :return: The run object, or the event stream with stream=True
+        """
+        run = await self._unlocked(lambda: self.client.beta.threads.runs.create(
             thread_id=self.thread_id,
             assistant_id=self.assistant_id,
-            instructions=instructions
-        )
-        print(f"Added command to thread: {self.thread_id} with instructions: {instructions}")
+            tools=self.tools,
+            **kwargs
+        ))
+        self.run_deadline = asyncio.get_running_loop().time() + self.max_run_age if self.max_run_age else None
 
         return run
 
-    def get_response(self, run_id):
+    def _time_left(self) -> float:
+        """
+        :return: How long to wait for the current run: run_timeout, cut short by its hard deadline
+        """
+        if self.run_deadline is None:
+            return self.run_timeout
+        return max(0.0, min(self.run_timeout, self.run_deadline - asyncio.get_running_loop().time()))
 
-        # Check if the run is completed
-        run_status = None
-        while not run_status == "completed":
-            run = self.client.beta.threads.runs.retrieve(
-                thread_id=self.thread_id,
-                run_id=run_id
-            )
-            run_status = run.status
+    async def send_command(self, instructions: str = ''):
+        with span("run_create"):
+            run = await self._create_run(instructions=instructions)
+        run_id_var.set(run.id)
+        logger.info("Created run %s in thread %s", run.id, self.thread_id)
 
-            if run_status in ["failed", "expired", "stopped"]:
-                print(run)
-                raise Exception(f"Run {run_id} failed with status {run_status}")
-
-            if run_status == "requires_action":
-                print(f"Run {run_id} requires action")
+        return run
 
-                print(run.required_action)
+    async def start_run(self, on_delta=None):
+        """
+        Runs the assistant on the thread, polled or streamed.
+        :param on_delta: Optional coroutine function called with every new piece of the answer's text. If set, the
+        run is streamed instead of polled.
+        :return: The same dict as get_response
+        """
+        if on_delta is not None:
+            return await self.stream_command(on_delta)
+
+        run = await self.send_command()
+        return await self.get_response(run.id)
+
+    async def continue_run(self, run_id: str, tool_outputs: List[Dict[str, str]], on_delta=None):
+        """
+        Submits the outputs of the tool calls of a round and waits for the rest of the run.
+        :param run_id: The id of the run waiting for the outputs
+        :param tool_outputs: A list of {"tool_call_id": ..., "output": ...} dicts
+        :param on_delta: Optional coroutine function called with every new piece of the answer's text
+        :return: The same dict as get_response
+        """
+        self.approx_tokens += sum(estimate_tokens(tool_output["output"]) for tool_output in tool_outputs)
+
+        # The tool calls took the rest of the run's time
+        if self.run_deadline is not None and asyncio.get_running_loop().time() >= self.run_deadline:
+            await self.cancel_run(run_id)
+            raise TimeoutError(f"Run {run_id} exceeded its maximal age of {self.max_run_age} seconds")
+
+        if on_delta is not None:
+            return await self.submit_tool_outputs_stream(run_id, tool_outputs, on_delta)
+
+        run = await self.submit_tool_outputs(run_id, tool_outputs)
+        return await self.get_response(run.id)
+
+    async def cancel_run(self, run_id: str) -> None:
+        """
+        Cancel a run, ignoring the error returned when the run has already finished.
+        :param run_id: The id of the run to cancel
+        """
+        try:
+            await self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=run_id)
+            logger.info("Cancelled run %s", run_id)
+        except Exception as e:
+            logger.warning("Could not cancel run %s: %s", run_id, e)
+
+    async def wait_for_run(self, run_id: str, deadline: float = None):
+        """
+        Poll a run until it needs an action or reaches a terminal status. The delay between two checks starts at
+        ``poll_interval`` and grows by ``poll_backoff`` up to ``max_poll_interval``, so short runs are picked up
+        quickly while long runs don't flood the API.
+
+        If the run takes longer than ``run_timeout`` or its ``max_run_age``, or the awaiting task is cancelled, the
+        run is cancelled on the OpenAI side too, so the thread doesn't stay locked.
+
+        :param run_id: The id of the run to wait for
+        :param deadline: Event loop time after which the run is cancelled, instead of the limits of the current run
+        :return: The run object
+        """
+        loop = asyncio.get_running_loop()
+        if deadline is None:
+            deadline = loop.time() + self._time_left()
+        delay = self.poll_interval
+
+        try:
+            while True:
+                run = await self.client.beta.threads.runs.retrieve(
+                    thread_id=self.thread_id,
+                    run_id=run_id
+                )
+
+                if run.status == "requires_action" or run.status in self.TERMINAL_STATUSES:
+                    return run
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"Run {run_id} did not finish in time")
+
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * self.poll_backoff, self.max_poll_interval)
+
+        except (TimeoutError, asyncio.CancelledError):
+            await self.cancel_run(run_id)
+            raise
+
+    async def get_response(self, run_id):
+        with span("completion"):
+            run = await self.wait_for_run(run_id)
+
+        if run.status in ["failed", "expired", "cancelled", "incomplete"]:
+            logger.error("Run %s ended with status %s: %s", run_id, run.status, run.last_error)
+            raise Exception(f"Run {run_id} failed with status {run.status}")
+
+        if run.status == "requires_action":
+            return self._get_action(run)
 
-                if run.required_action.type == "submit_tool_outputs":
-                    # action = run.required_action["submit_tool_outputs"]["tool_calls"][0]["function"]
-                    action = run.required_action.submit_tool_outputs.tool_calls[0].function
-                    call_id = run.required_action.submit_tool_outputs.tool_calls[0].id
+        # Get the message back
+        messages = await self.client.beta.threads.messages.list(
+            thread_id=self.thread_id,
+            run_id=run_id,
+            limit=1
+        )
 
-                    function_name = action.name
-                    function_args = action.arguments
+        logger.info("Got response from thread %s for run %s", self.thread_id, run_id)
 
-                    return {"message": None, "run_id": run_id, "call_id": call_id,
-                            "action": {"function_name": function_name, "function_args": function_args}}
+        message = messages.data[0].content[0].text.value
+        self._record_usage(run, message)
 
-            time.sleep(1)
+        return {"message": message, "run_id": run_id, "tool_calls": None}
 
-        # Get the message back
-        messages = self.client.beta.threads.messages.list(
-            thread_id=self.thread_id
-        )
+    def _record_usage(self, run, message: str) -> None:
+        self.approx_tokens += estimate_tokens(message)
+        if getattr(run, "usage", None) is not None:
+            self.unmeasured_run_id = run.id
 
-        # Print the message content
-        print(f"Got response from thread {self.thread_id}: {messages.data[0].content[0].text.value}")
+    async def measure_context(self) -> None:
+        """
+        Sets context_tokens from the usage of the last run, at the cost of one request. Called by the ThreadManager
+        after the answer is delivered, and only if the threads are rotated.
+        """
+        run_id, self.unmeasured_run_id = self.unmeasured_run_id, None
+        if run_id is None:
+            return
 
-        return {"message": messages.data[0].content[0].text.value, "run": None, "action": None}
+        # run.usage sums the tokens of every step, each step re-reading the thread, so only the last step gives the
+        # size of the thread: its prompt holds the whole thread and its completion is the answer
+        try:
+            steps = await self.client.beta.threads.runs.steps.list(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                order="desc",
+                limit=1
+            )
+        except APIError as e:
+            logger.warning("Could not get the steps of run %s: %s", run_id, e)
+            return
+
+        if steps.data and getattr(steps.data[0], "usage", None) is not None:
+            self.context_tokens = steps.data[0].usage.prompt_tokens + steps.data[0].usage.completion_tokens
+
+    async def summarize(self, instructions: str = SUMMARY_INSTRUCTIONS) -> str:
+        """
+        Asks the assistant for a summary of the thread, without tool calls.
+        :param instructions: What the summary must contain
+        :return: The summary
+        """
+        with span("summary"):
+            run = await self._create_run(additional_instructions=instructions, tool_choice="none")
+            response = await self.get_response(run.id)
+
+        return response["message"]
+
+    @staticmethod
+    def _get_action(run):
+        """
+        Build the response for a run that waits for tool outputs.
+        :param run: The run in the "requires_action" status
+        :return: A dict with the run id and every tool call the model asked for in this round
+        """
+        logger.info("Run %s requires action %s", run.id, run.required_action.type)
+
+        if run.required_action.type == "submit_tool_outputs":
+            tool_calls = [{"call_id": tool_call.id, "function_name": tool_call.function.name,
+                           "function_args": tool_call.function.arguments}
+                          for tool_call in run.required_action.submit_tool_outputs.tool_calls]
+
+            return {"message": None, "run_id": run.id, "tool_calls": tool_calls}
+
+        raise Exception(f"Run {run.id} requires an unsupported action: {run.required_action.type}")
+
+    async def stream_command(self, on_delta, instructions: str = ''):
+        """
+        Create a run and stream its events instead of polling it.
+        :param on_delta: Coroutine function called with every new piece of the answer's text
+        :param instructions: Additional instructions for the run
+        :return: The same dict as get_response
+        """
+        with span("run_create"):
+            stream = await self._create_run(instructions=instructions, stream=True)
+        logger.info("Streaming a run in thread %s", self.thread_id)
+
+        return await self._stream_run(stream, on_delta)
+
+    async def submit_tool_outputs_stream(self, run_id: str, tool_outputs: List[Dict[str, str]], on_delta):
+        """
+        Submit the outputs of all tool calls of a round and stream the rest of the run.
+        :param run_id: The id of the run waiting for the outputs
+        :param tool_outputs: A list of {"tool_call_id": ..., "output": ...} dicts
+        :param on_delta: Coroutine function called with every new piece of the answer's text
+        :return: The same dict as get_response
+        """
+        with span("submit"):
+            stream = await self.client.beta.threads.runs.submit_tool_outputs(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                tool_outputs=tool_outputs,
+                stream=True
+            )
 
-    def submit_tool_outputs(self, run_id: str, call_ids: str, output: str):
-        run = self.client.beta.threads.runs.submit_tool_outputs(
-            thread_id=self.thread_id,
-            run_id=run_id,
-            tool_outputs=[
-                {
-                    "tool_call_id": call_ids,
-                    "output": output,
-                }
-            ]
-        )
+        return await self._stream_run(stream, on_delta, run_id)
+
+    async def _stream_run(self, stream, on_delta, run_id: str = None):
+        """
+        Consume a run event stream within ``run_timeout`` and ``max_run_age``. The run is cancelled if it times out
+        or the awaiting task is cancelled.
+        """
+        state = {"run_id": run_id}
+
+        try:
+            with span("completion"):
+                return await asyncio.wait_for(self._consume_stream(stream, on_delta, state), self._time_left())
+        except asyncio.TimeoutError:
+            if state["run_id"] is not None:
+                await self.cancel_run(state["run_id"])
+            raise TimeoutError(f"Run {state['run_id']} did not finish in time")
+        except asyncio.CancelledError:
+            if state["run_id"] is not None:
+                await self.cancel_run(state["run_id"])
+            raise
+
+    async def _consume_stream(self, stream, on_delta, state: dict):
+        text_parts = []
+
+        async for event in stream:
+            if event.event == "thread.run.created":
+                state["run_id"] = event.data.id
+                run_id_var.set(event.data.id)
+
+            elif event.event == "thread.message.delta":
+                for content in event.data.delta.content or []:
+                    if content.type == "text" and content.text and content.text.value:
+                        text_parts.append(content.text.value)
+                        await on_delta(content.text.value)
+
+            elif event.event == "thread.run.requires_action":
+                return self._get_action(event.data)
+
+            elif event.event == "thread.run.completed":
+                state["run"] = event.data
+
+            elif event.event in ["thread.run.failed", "thread.run.expired", "thread.run.cancelled",
+                                 "thread.run.incomplete"]:
+                logger.error("Run %s ended with status %s: %s", event.data.id, event.data.status,
+                             event.data.last_error)
+                raise Exception(f"Run {event.data.id} failed with status {event.data.status}")
+
+            elif event.event == "error":
+                raise Exception(f"Run {state['run_id']} failed: {event.data}")
+
+        message = "".join(text_parts)
+        logger.info("Got streamed response from thread %s for run %s", self.thread_id, state["run_id"])
+        self._record_usage(state.get("run"), message)
+
+        return {"message": message, "run_id": state["run_id"], "tool_calls": None}
+
+    async def submit_tool_outputs(self, run_id: str, tool_outputs: List[Dict[str, str]]):
+        """
+        Submit the outputs of all tool calls of a round at once.
+        :param run_id: The id of the run waiting for the outputs
+        :param tool_outputs: A list of {"tool_call_id": ..., "output": ...} dicts
+        :return: The run object
+        """
+        with span("submit"):
+            run = await self.client.beta.threads.runs.submit_tool_outputs(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                tool_outputs=tool_outputs
+            )
 
         return run
 
+    async def recover_active_runs(self) -> int:
+        """
+        Ends the runs left active on the thread, by a crash, a restart or an action that never returned, since they
+        keep the thread locked until they expire. With the 'cancel' policy they are cancelled. With the 'resume'
+        policy the runs younger than ``max_run_age`` are let finish, their pending tool calls answered with an error
+        as their actions were lost, and only the older ones are cancelled.
+
+        A cancelled run still locks the thread until the API has stopped it, so this waits until every run is over.
+        Runs that can't be recovered are logged, the next request on the thread fails then.
+
+        :return: The number of runs found active
+        """
+        loop = asyncio.get_running_loop()
+        runs = await self.client.beta.threads.runs.list(thread_id=self.thread_id, limit=10)
+        active = [run for run in runs.data if run.status in self.ACTIVE_STATUSES]
+
+        for run in active:
+            age = time.time() - run.created_at
+            logger.warning("Run %s of thread %s is still %s after %.0f seconds", run.id, self.thread_id, run.status,
+                           age)
+            try:
+                if (self.stuck_run_policy == "resume" and run.status != "cancelling"
+                        and (not self.max_run_age or age < self.max_run_age)):
+                    run = await self._resume_run(run, age)
+                if run.status not in self.TERMINAL_STATUSES:
+                    await self.cancel_run(run.id)
+                    run = await self.wait_for_run(run.id, deadline=loop.time() + self.run_timeout)
+            except Exception as e:
+                logger.error("Could not recover run %s of thread %s: %s", run.id, self.thread_id, e)
+                RUN_RECOVERIES.inc(status="failed")
+                continue
+
+            logger.info("Recovered run %s of thread %s: %s", run.id, self.thread_id, run.status)
+            RUN_RECOVERIES.inc(status=run.status)
+
+        return len(active)
+
+    async def _resume_run(self, run, age: float):
+        """
+        Lets a recovered run finish within the rest of its ``max_run_age``.
+        :return: The run object, still active if it asked for more actions or didn't finish in time
+        """
+        if run.status == "requires_action":
+            tool_calls = run.required_action.submit_tool_outputs.tool_calls
+            run = await self.submit_tool_outputs(run.id, [{"tool_call_id": tool_call.id,
+                                                           "output": self.LOST_ACTION_OUTPUT}
+                                                          for tool_call in tool_calls])
+
+        time_left = self.max_run_age - age if self.max_run_age else self.run_timeout
+        try:
+            return await self.wait_for_run(run.id, deadline=asyncio.get_running_loop().time() + time_left)
+        except TimeoutError:
+            # Cancelled by wait_for_run
+            return await self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id)
+
 
 if __name__ == "__main__":
     # Get the api key from the JSON file
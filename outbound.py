@@ -0,0 +1,274 @@
+"""
+Scheduler of the actions changing something on Telegram (sending, commenting, joining, leaving), within the rate
+limits of the account.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from telethon.errors import FloodWaitError, SlowModeWaitError
+
+from metrics import OUTBOUND_ACTIONS, OUTBOUND_WAIT_SECONDS
+from telegrambot import raise_flood_waits
+
+logger = logging.getLogger(__name__)
+
+# Lower is sooner
+PRIORITY_OWNER = 0
+PRIORITY_ACTION = 1
+PRIORITY_BULK = 2
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` actions per second on average and bursts of up to ``capacity`` actions. An action can also cost
+    several tokens, e.g. the bytes of a transfer, at most ``capacity``.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float, amount: float = 1) -> float:
+        """
+        :return: The time until amount tokens are available, in seconds
+        """
+        self._refill(now)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, now: float, amount: float = 1) -> None:
+        self._refill(now)
+        self.tokens -= amount
+
+
+class OutboundJob:
+    def __init__(self, priority: int, sequence: int, action: Callable[[], Awaitable[Any]], key: Hashable,
+                 kind: str, future: asyncio.Future):
+        self.priority = priority
+        self.sequence = sequence
+        self.action = action
+        self.key = key
+        self.kind = kind
+        self.future = future
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+    def __lt__(self, other: 'OutboundJob') -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class OutboundScheduler:
+    """
+    Every outbound action is queued by priority, the owner's replies first and the bulk sends last, and runs once
+    both the global token bucket and the bucket of its key (the chat it writes to) allow it. Actions of the same key
+    run one at a time, in order. Every key has its own queue, so picking the next action only looks at the first
+    action of each key, however long the backlog of a throttled chat is.
+
+    A FloodWaitError parks every action until the wait is over and a SlowModeWaitError parks the actions of the chat,
+    then the action is tried again, instead of failing and letting the caller retry straight away.
+    """
+
+    def __init__(self, global_rate: float = 1.0, global_burst: int = 5, chat_rate: float = 0.3, chat_burst: int = 3,
+                 key_rates: Dict[Hashable, Tuple[float, int]] = None, max_flood_wait: float = 3600.0,
+                 max_attempts: int = 5):
+        """
+        :param global_rate: The number of actions per second of the account
+        :param global_burst: The number of actions the account can make at once after a quiet period
+        :param chat_rate: The number of actions per second in a single chat
+        :param chat_burst: The number of actions in a single chat at once after a quiet period
+        :param key_rates: (rate, burst) of specific keys, e.g. the joins and leaves
+        :param max_flood_wait: The longest flood wait an action is parked for, it fails beyond, in seconds
+        :param max_attempts: The number of flood waits after which an action fails
+        """
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.key_rates = key_rates or {}
+        self.max_flood_wait = max_flood_wait
+        self.max_attempts = max_attempts
+
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+        # Monotonic time before which nothing runs, globally or by key
+        self.paused_until = 0.0
+        self.key_paused_until: Dict[Hashable, float] = {}
+
+        # Queue of every key, by priority
+        self._heaps: Dict[Hashable, List[OutboundJob]] = {}
+        self._sequence = itertools.count()
+        self._busy_keys = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def schedule(self, action: Callable[[], Awaitable[Any]], key: Hashable = None, priority: int = PRIORITY_ACTION,
+                 kind: str = 'action') -> asyncio.Future:
+        """
+        Queues an action.
+
+        :param action: Coroutine function making the Telegram request, called once per attempt
+        :param key: The chat the action writes to, or another key sharing a rate limit. None for the global limit only
+        :param priority: PRIORITY_OWNER, PRIORITY_ACTION or PRIORITY_BULK
+        :param kind: The name of the action in the metrics
+        :return: A future with the result of the action. Cancelling it drops the action if it hasn't run yet.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+
+        def log_failure(done: asyncio.Future) -> None:
+            # The caller may have stopped waiting (see TelegramAssistant.run_outbound), the failure is logged here
+            if not done.cancelled() and done.exception() is not None:
+                logger.warning("%s to %s failed: %s", kind, key, done.exception())
+
+        future.add_done_callback(log_failure)
+        heapq.heappush(self._heaps.setdefault(key, []),
+                       OutboundJob(priority, next(self._sequence), action, key, kind, future))
+        self._wakeup.set()
+        return future
+
+    async def submit(self, action: Callable[[], Awaitable[Any]], key: Hashable = None,
+                     priority: int = PRIORITY_ACTION, kind: str = 'action') -> Any:
+        """
+        Queues an action and waits for its result.
+        """
+        return await self.schedule(action, key, priority, kind)
+
+    def pending(self) -> int:
+        return sum(len(heap) for heap in self._heaps.values())
+
+    async def stop(self) -> None:
+        """
+        Stops the dispatching. The queued actions fail with a ConnectionError, the ones running are awaited.
+        """
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+        for heap in self._heaps.values():
+            for job in heap:
+                if not job.future.done():
+                    job.future.set_exception(ConnectionError("The client stopped before the action could run"))
+        self._heaps.clear()
+
+    def _get_bucket(self, key: Hashable) -> Optional[TokenBucket]:
+        if key is None:
+            return None
+        if key not in self.buckets:
+            rate, burst = self.key_rates.get(key, (self.chat_rate, self.chat_burst))
+            self.buckets[key] = TokenBucket(rate, burst)
+        return self.buckets[key]
+
+    def _next_job(self, now: float) -> Tuple[Optional[OutboundJob], float]:
+        """
+        Finds the first job by priority that can run now.
+        :return: The job, or None and the time until one might be able to run
+        """
+        global_delay = max(self.paused_until - now, self.global_bucket.delay(now))
+        if global_delay > 0:
+            return None, global_delay
+
+        best = None
+        delay = float('inf')
+        for key, heap in list(self._heaps.items()):
+            while heap and heap[0].future.cancelled():
+                heapq.heappop(heap)
+            if not heap:
+                del self._heaps[key]
+                continue
+            if key in self._busy_keys:
+                continue
+
+            bucket = self._get_bucket(key)
+            key_delay = max(self.key_paused_until.get(key, 0.0) - now, bucket.delay(now) if bucket else 0.0)
+            if key_delay > 0:
+                delay = min(delay, key_delay)
+            elif best is None or heap[0] < best[0]:
+                best = heap
+
+        if best is None:
+            return None, delay
+        return heapq.heappop(best), 0.0
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            job, delay = self._next_job(now)
+            if job is None:
+                # Woken up earlier by a new job or a finished one
+                timer = None
+                if delay != float('inf'):
+                    timer = asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                continue
+
+            self.global_bucket.take(now)
+            bucket = self._get_bucket(job.key)
+            if bucket is not None:
+                bucket.take(now)
+
+            if job.key is not None:
+                self._busy_keys.add(job.key)
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job: OutboundJob) -> None:
+        job.attempts += 1
+        OUTBOUND_WAIT_SECONDS.observe(time.monotonic() - job.queued, kind=job.kind)
+        try:
+            # Flood waits are parked here, Telethon must not sleep through them holding the key
+            with raise_flood_waits():
+                result = await job.action()
+        except (FloodWaitError, SlowModeWaitError) as e:
+            self._park(job, e)
+        except Exception as e:
+            OUTBOUND_ACTIONS.inc(kind=job.kind, status='error')
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            OUTBOUND_ACTIONS.inc(kind=job.kind, status='ok')
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._busy_keys.discard(job.key)
+            self._wakeup.set()
+
+    def _park(self, job: OutboundJob, error: Exception) -> None:
+        """
+        Puts a job hit by a flood wait back in the queue, behind the wait.
+        """
+        if error.seconds > self.max_flood_wait or job.attempts >= self.max_attempts:
+            OUTBOUND_ACTIONS.inc(kind=job.kind, status='flood_wait')
+            if not job.future.done():
+                job.future.set_exception(error)
+            return
+
+        until = time.monotonic() + error.seconds
+        if isinstance(error, SlowModeWaitError) and job.key is not None:
+            self.key_paused_until[job.key] = max(self.key_paused_until.get(job.key, 0.0), until)
+        else:
+            self.paused_until = max(self.paused_until, until)
+
+        logger.warning("%s to %s hit a flood wait of %ss, retrying it then", job.kind, job.key, error.seconds)
+        OUTBOUND_ACTIONS.inc(kind=job.kind, status='parked')
+        heapq.heappush(self._heaps.setdefault(job.key, []), job)
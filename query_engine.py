@@ -0,0 +1,124 @@
+"""
+Bounded, read-only execution of the SQL queries written by the assistant.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Sequence
+
+from storage import Storage
+
+
+class QueryTimeoutError(Exception):
+    pass
+
+
+class QueryEngine:
+    """
+    Runs queries in worker threads on read-only connections, so a slow query never blocks the event loop and the
+    assistant can't modify the database. Every query gets a wall-clock budget enforced by SQLite's progress handler,
+    and the rows are fetched incrementally until the row or byte cap is reached.
+    """
+
+    # Number of SQLite virtual machine instructions between two checks of the budget
+    PROGRESS_STEPS = 1000
+    FETCH_SIZE = 100
+
+    def __init__(self, storage: Storage, time_budget: float = 5.0, max_rows: int = 200, max_bytes: int = 16000,
+                 max_workers: int = 2):
+        """
+        :param storage: The storage of the database
+        :param time_budget: The maximal duration of a query, in seconds
+        :param max_rows: The maximal number of rows returned
+        :param max_bytes: The maximal size of the returned rows, serialized as JSON
+        :param max_workers: The number of queries that can run at the same time
+        """
+        self.storage = storage
+        self.time_budget = time_budget
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+
+        # Created on the first query, so the engine can be used again after close()
+        self._executor = None
+        self._local = threading.local()
+
+    async def run(self, query: str, params: Sequence[Any] = ()) -> Dict[str, Any]:
+        """
+        Executes a query.
+        :param query: A single SQL statement
+        :param params: The values of its placeholders
+        :return: A dict with the column names, the rows, whether the rows were truncated and the approximate number
+        of tokens of the rows
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='query-engine')
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._execute, query, params)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_connection(self):
+        # One read-only connection per worker thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.storage.connect(read_only=True)
+            conn.execute('PRAGMA query_only = ON')
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, query: str, params: Sequence[Any] = ()) -> Dict[str, Any]:
+        conn = self._get_connection()
+        deadline = time.monotonic() + self.time_budget
+
+        # Returning a true value aborts the running statement
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, self.PROGRESS_STEPS)
+
+        try:
+            cursor = conn.execute(query, params)
+            columns = [column[0] for column in cursor.description or []]
+
+            rows = []
+            size = 0
+            truncated = False
+
+            while not truncated:
+                batch = cursor.fetchmany(self.FETCH_SIZE)
+                if not batch:
+                    break
+
+                for row in batch:
+                    row_size = len(json.dumps(row, default=str, ensure_ascii=False))
+                    if len(rows) >= self.max_rows or size + row_size > self.max_bytes:
+                        truncated = True
+                        break
+
+                    rows.append(row)
+                    size += row_size
+
+            cursor.close()
+
+        except Exception as e:
+            if time.monotonic() > deadline:
+                raise QueryTimeoutError(f"The query did not finish within {self.time_budget} seconds") from e
+            raise
+
+        finally:
+            conn.set_progress_handler(None, 0)
+            if conn.in_transaction:
+                conn.rollback()
+
+        return {
+            'columns': columns,
+            'rows': rows,
+            'row_count': len(rows),
+            'truncated': truncated,
+            # Roughly 4 characters per token
+            'approx_tokens': size // 4 + 1,
+        }
@@ -0,0 +1,256 @@
+"""
+Retention of the messages captured in the watched groups: old raw messages are rolled up into daily aggregates per
+group, then archived or deleted, and the freed pages are given back to the file system with incremental vacuum.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from metrics import RETENTION_ROWS
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+WORD_PATTERN = re.compile(r'\b\w{4,30}\b', re.UNICODE)
+
+# Frequent words that would fill the top terms of every group
+STOPWORDS = {
+    'about', 'after', 'also', 'been', 'before', 'being', 'both', 'could', 'does', 'doing', 'down', 'each', 'even',
+    'from', 'have', 'having', 'here', 'http', 'https', 'into', 'just', 'like', 'more', 'most', 'much', 'only',
+    'other', 'over', 'same', 'should', 'some', 'such', 'than', 'that', 'their', 'them', 'then', 'there', 'these',
+    'they', 'this', 'those', 'very', 'were', 'what', 'when', 'where', 'which', 'while', 'will', 'with', 'would',
+    'your', 'yours',
+}
+
+ARCHIVE_SCHEMA = '''CREATE TABLE IF NOT EXISTS archive.messages
+    (id INTEGER PRIMARY KEY, from_id INTEGER, group_username TEXT, message TEXT, timestamp_sent INTEGER,
+     chat_id INTEGER, message_id INTEGER)'''
+
+
+class RetentionManager:
+    """
+    Applies the retention policies periodically in a background thread. A policy is the number of days the raw
+    messages of a group are kept, 0 to keep them forever.
+
+    The messages older than their policy are processed a day and a group at a time, in chunks: each chunk is added to
+    message_rollups_daily (message count, top terms) and message_rollup_senders (active senders), then archived or
+    deleted, in a single short transaction. A crash never counts a message twice, and the pause between two chunks
+    lets the ingestion writer in.
+    """
+
+    def __init__(self, storage: Storage, default_keep_days: int = 0, group_keep_days: Dict[str, int] = None,
+                 archive_path: Optional[str] = None, chunk_size: int = 1000, chunk_pause: float = 0.05,
+                 interval: float = 3600.0, vacuum_pages: int = 1000, top_terms: int = 30):
+        """
+        :param storage: The storage of the database
+        :param default_keep_days: The number of days the messages of the groups without a policy are kept, 0 forever
+        :param group_keep_days: The number of days the messages are kept, by group username
+        :param archive_path: The SQLite database the removed messages are copied to, None to delete them
+        :param chunk_size: The maximal number of messages removed in a single transaction
+        :param chunk_pause: The pause between two chunks, in seconds
+        :param interval: The delay between two runs, in seconds
+        :param vacuum_pages: The maximal number of free pages released at once by the incremental vacuum
+        :param top_terms: The number of terms kept in the rollup of a day
+        """
+        self.storage = storage
+        self.default_keep_days = default_keep_days
+        self.group_keep_days = {group.lower(): days for group, days in (group_keep_days or {}).items()}
+        self.archive_path = archive_path
+        self.chunk_size = chunk_size
+        self.chunk_pause = chunk_pause
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.top_terms = top_terms
+
+        self._executor = None
+        self._task = None
+        self._vacuum_warned = False
+
+    def get_keep_days(self, group_username: str) -> int:
+        return self.group_keep_days.get((group_username or '').lower(), self.default_keep_days)
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='retention')
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+        # Waits for the chunk in progress
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                stats = await loop.run_in_executor(self._executor, self.run_once)
+                logger.info("Retention: %s", stats)
+            except Exception as e:
+                logger.error("Retention failed: %s", e)
+
+            await asyncio.sleep(self.interval)
+
+    def run_once(self) -> Dict[str, Any]:
+        """
+        Applies the policies once, then releases the free pages. Runs in the calling thread.
+
+        :return: The number of messages rolled up, whether they were archived or deleted, the pages released
+        """
+        conn = self.storage.connect()
+        try:
+            if self.archive_path:
+                conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+                conn.execute(ARCHIVE_SCHEMA)
+
+            removed = 0
+            for group_username, day in self._expired_days(conn):
+                removed += self._compact_day(conn, group_username, day)
+
+            return {'rolled_up': removed, 'action': 'archived' if self.archive_path else 'deleted',
+                    'released_pages': self._incremental_vacuum(conn)}
+        finally:
+            conn.close()
+
+    def _expired_days(self, conn: sqlite3.Connection) -> List[tuple]:
+        """
+        :return: The (group_username, day) with raw messages older than the policy of the group, oldest first
+        """
+        now = int(time.time())
+        today = now - now % SECONDS_PER_DAY
+
+        expired = []
+        groups = [row[0] for row in conn.execute('SELECT DISTINCT group_username FROM messages')]
+        for group_username in groups:
+            keep_days = self.get_keep_days(group_username)
+            if keep_days <= 0:
+                continue
+
+            # Whole days only: a day is processed once all its messages are expired
+            cutoff = today - keep_days * SECONDS_PER_DAY
+            rows = conn.execute(f'SELECT DISTINCT timestamp_sent - timestamp_sent % {SECONDS_PER_DAY} FROM messages '
+                                'WHERE group_username IS ? AND timestamp_sent < ? ORDER BY 1',
+                                (group_username, cutoff))
+            expired.extend((group_username, row[0]) for row in rows)
+
+        return expired
+
+    def _compact_day(self, conn: sqlite3.Connection, group_username: str, day: int) -> int:
+        """
+        Rolls up and removes the messages of a group and a day, a chunk per transaction.
+        :return: The number of messages removed
+        """
+        removed = 0
+        while True:
+            with conn:
+                rows = conn.execute('SELECT id, chat_id, from_id, message FROM messages WHERE group_username IS ? '
+                                    'AND timestamp_sent >= ? AND timestamp_sent < ? ORDER BY id LIMIT ?',
+                                    (group_username, day, day + SECONDS_PER_DAY, self.chunk_size)).fetchall()
+                if not rows:
+                    return removed
+
+                self._roll_up(conn, group_username, day, rows)
+
+                ids = [row[0] for row in rows]
+                placeholders = ', '.join('?' * len(ids))
+                if self.archive_path:
+                    conn.execute('INSERT OR IGNORE INTO archive.messages (id, from_id, group_username, message, '
+                                 'timestamp_sent, chat_id, message_id) SELECT id, from_id, group_username, message, '
+                                 f'timestamp_sent, chat_id, message_id FROM messages WHERE id IN ({placeholders})', ids)
+                conn.execute(f'DELETE FROM messages WHERE id IN ({placeholders})', ids)
+
+            removed += len(rows)
+            RETENTION_ROWS.inc(len(rows), action='archived' if self.archive_path else 'deleted')
+            time.sleep(self.chunk_pause)
+
+    def _roll_up(self, conn: sqlite3.Connection, group_username: str, day: int, rows: List[tuple]) -> None:
+        conn.executemany('INSERT OR IGNORE INTO message_rollup_senders (group_username, day, from_id) '
+                         'VALUES (?, ?, ?)', {(group_username, day, row[2]) for row in rows if row[2] is not None})
+
+        previous = conn.execute('SELECT message_count, top_terms FROM message_rollups_daily '
+                                'WHERE group_username IS ? AND day = ?', (group_username, day)).fetchone()
+
+        terms = Counter(json.loads(previous[1])) if previous and previous[1] else Counter()
+        for row in rows:
+            terms.update(word for word in WORD_PATTERN.findall((row[3] or '').lower())
+                         if word not in STOPWORDS and not word.isdigit())
+
+        message_count = (previous[0] if previous else 0) + len(rows)
+        active_senders = conn.execute('SELECT COUNT(*) FROM message_rollup_senders WHERE group_username IS ? '
+                                      'AND day = ?', (group_username, day)).fetchone()[0]
+        chat_id = next((row[1] for row in rows if row[1] is not None), None)
+
+        conn.execute('INSERT OR REPLACE INTO message_rollups_daily (group_username, day, chat_id, message_count, '
+                     'active_senders, top_terms) VALUES (?, ?, ?, ?, ?, ?)',
+                     (group_username, day, chat_id, message_count, active_senders,
+                      json.dumps(dict(terms.most_common(self.top_terms)), ensure_ascii=False)))
+
+    def _incremental_vacuum(self, conn: sqlite3.Connection) -> int:
+        """
+        Releases the free pages in steps of vacuum_pages, if the database uses incremental auto-vacuum.
+        :return: The number of pages released
+        """
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            if not self._vacuum_warned:
+                logger.warning("The database doesn't use incremental auto-vacuum, the freed pages are reused but the "
+                               "file doesn't shrink. Run `python retention.py --enable-incremental-vacuum` once.")
+                self._vacuum_warned = True
+            return 0
+
+        released = 0
+        while True:
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if free_pages == 0:
+                return released
+
+            conn.execute(f'PRAGMA incremental_vacuum({min(free_pages, self.vacuum_pages)})').fetchall()
+            released += min(free_pages, self.vacuum_pages)
+            time.sleep(self.chunk_pause)
+
+
+def enable_incremental_vacuum(storage: Storage) -> None:
+    """
+    Switches an existing database to incremental auto-vacuum. This rebuilds the whole file with VACUUM, so it must
+    run while the bot is stopped.
+    """
+    conn = storage.connect()
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Message retention of the Telegram Assistant database.')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Convert the database to incremental auto-vacuum (stop the bot first)')
+    args = parser.parse_args()
+
+    storage_ = Storage()
+    storage_.migrate()
+
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(storage_)
+        print("The database now uses incremental auto-vacuum")
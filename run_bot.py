@@ -3,14 +3,37 @@ Run the virtual assistant as the Telegram user bot.
 """
 
 import asyncio
+import logging
 
+from metrics import MetricsServer
 from telegram_assistant import TelegramAssistant
 from data import *
 
 if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
     group = os.getenv('GROUP')
     bot = TelegramAssistant(SESSION_FILE, SESSIONS_FOLDER, API_ID, API_HASH, [group], group, ASSISTANT_ID,
-                            THREAD_ID)
+                            THREAD_ID, stream_responses=STREAM_RESPONSES, max_action_rounds=MAX_ACTION_ROUNDS,
+                            tool_timeout=TOOL_TIMEOUT, engine=ENGINE, chat_model=CHAT_MODEL,
+                            max_history_messages=MAX_HISTORY_MESSAGES, max_thread_tokens=MAX_THREAD_TOKENS,
+                            outbound_global_rate=OUTBOUND_GLOBAL_RATE, outbound_chat_rate=OUTBOUND_CHAT_RATE,
+                            backfill_concurrency=BACKFILL_CONCURRENCY, backfill_rpc_rate=BACKFILL_RPC_RATE,
+                            max_run_age=MAX_RUN_AGE, stuck_run_policy=STUCK_RUN_POLICY, openai_api_key=OPENAI_API_KEY,
+                            media_folder=MEDIA_FOLDER, media_download=MEDIA_DOWNLOAD,
+                            media_max_file_size=int(MEDIA_MAX_FILE_SIZE_MB * 1024 * 1024),
+                            media_bandwidth=MEDIA_BANDWIDTH_KBPS * 1024, media_concurrency=MEDIA_CONCURRENCY)
+
+    if METRICS_PORT:
+        asyncio.get_event_loop().run_until_complete(MetricsServer(METRICS_PORT).start())
+
+    if RETENTION_KEEP_DAYS or RETENTION_GROUPS:
+        from retention import RetentionManager
+
+        retention = RetentionManager(bot.storage, RETENTION_KEEP_DAYS, RETENTION_GROUPS,
+                                     archive_path=RETENTION_ARCHIVE_PATH, chunk_size=RETENTION_CHUNK_SIZE,
+                                     interval=RETENTION_INTERVAL)
+        asyncio.get_event_loop().run_until_complete(retention.start())
 
     asyncio.get_event_loop().run_until_complete(bot.start(IP, PORT, USERNAME, PASSWORD))
 
@@ -0,0 +1,317 @@
+"""
+SQLite storage shared by the assistant: long-lived connections in WAL mode and versioned schema migrations.
+"""
+
+import logging
+import queue
+import sqlite3
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Applied in order to bring a database to the latest version, the version is kept in PRAGMA user_version.
+# Never edit a migration that has been released, add a new one instead.
+MIGRATIONS = [
+    # 1: The original schema. Databases created before the migrations already have these tables.
+    [
+        '''CREATE TABLE IF NOT EXISTS joined_groups
+           (id INTEGER PRIMARY KEY, entity TEXT, access_hash TEXT, timestamp_joined INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS messages
+           (id INTEGER PRIMARY KEY, from_id INTEGER, group_username TEXT, message TEXT, timestamp_sent INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS groups_to_watch
+           (id INTEGER PRIMARY KEY, group_username TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS chat_threads
+           (chat_id INTEGER PRIMARY KEY, thread_id TEXT, timestamp_created INTEGER)''',
+    ],
+    # 2: Telegram ids, epoch timestamps instead of the CURRENT_TIMESTAMP text, and indexes for the common queries
+    [
+        'ALTER TABLE messages ADD COLUMN chat_id INTEGER',
+        'ALTER TABLE messages ADD COLUMN message_id INTEGER',
+        'ALTER TABLE joined_groups ADD COLUMN chat_id INTEGER',
+        '''UPDATE messages SET timestamp_sent = CAST(strftime('%s', timestamp_sent) AS INTEGER)
+           WHERE typeof(timestamp_sent) = 'text' ''',
+        '''UPDATE joined_groups SET timestamp_joined = CAST(strftime('%s', timestamp_joined) AS INTEGER)
+           WHERE typeof(timestamp_joined) = 'text' ''',
+        '''CREATE INDEX IF NOT EXISTS messages_group_username_timestamp_sent
+           ON messages (group_username, timestamp_sent)''',
+        'CREATE INDEX IF NOT EXISTS messages_from_id ON messages (from_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS messages_chat_id_message_id ON messages (chat_id, message_id)',
+        'CREATE INDEX IF NOT EXISTS joined_groups_entity ON joined_groups (entity)',
+    ],
+    # 3: Full-text index of the messages, kept in sync by triggers
+    [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5
+           (message, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+           INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+           INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+           END''',
+        # Index the messages stored before this migration
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ],
+    # 4: Conversations of the Chat Completions engine, by thread id
+    [
+        '''CREATE TABLE IF NOT EXISTS conversation_messages
+           (id INTEGER PRIMARY KEY, thread_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT, tool_calls TEXT,
+            tool_call_id TEXT, timestamp_created INTEGER)''',
+        'CREATE INDEX IF NOT EXISTS conversation_messages_thread_id ON conversation_messages (thread_id, id)',
+    ],
+    # 5: Size of the threads and the rotations to a fresh thread, facts carried over to the new threads
+    [
+        '''CREATE TABLE IF NOT EXISTS thread_state
+           (thread_id TEXT PRIMARY KEY, approx_tokens INTEGER NOT NULL DEFAULT 0, replaced_by TEXT, summary TEXT,
+            timestamp_rotated INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS pinned_facts
+           (id INTEGER PRIMARY KEY, chat_id INTEGER, fact TEXT NOT NULL, timestamp_created INTEGER)''',
+        'CREATE INDEX IF NOT EXISTS pinned_facts_chat_id ON pinned_facts (chat_id)',
+    ],
+    # 6: Daily aggregates of the messages removed by the retention, with the senders counted once per day
+    [
+        '''CREATE TABLE IF NOT EXISTS message_rollups_daily
+           (group_username TEXT NOT NULL, day INTEGER NOT NULL, chat_id INTEGER,
+            message_count INTEGER NOT NULL DEFAULT 0, active_senders INTEGER NOT NULL DEFAULT 0, top_terms TEXT,
+            PRIMARY KEY (group_username, day))''',
+        '''CREATE TABLE IF NOT EXISTS message_rollup_senders
+           (group_username TEXT NOT NULL, day INTEGER NOT NULL, from_id INTEGER NOT NULL,
+            PRIMARY KEY (group_username, day, from_id)) WITHOUT ROWID''',
+    ],
+    # 7: Delayed and recurring actions of the assistant, by account
+    [
+        '''CREATE TABLE IF NOT EXISTS scheduled_jobs
+           (id INTEGER PRIMARY KEY, owner TEXT NOT NULL, chat_id INTEGER, action TEXT NOT NULL, arguments TEXT,
+            due_at INTEGER NOT NULL, interval_seconds INTEGER, status TEXT NOT NULL, runs INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT, timestamp_created INTEGER, timestamp_run INTEGER)''',
+        'CREATE INDEX IF NOT EXISTS scheduled_jobs_owner_status ON scheduled_jobs (owner, status)',
+    ],
+    # 8: Progress of the history backfills, checkpoint_id is the oldest message id imported so far
+    [
+        '''CREATE TABLE IF NOT EXISTS backfill_state
+           (group_username TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL,
+            checkpoint_id INTEGER NOT NULL DEFAULT 0, messages_fetched INTEGER NOT NULL DEFAULT 0,
+            max_messages INTEGER NOT NULL, oldest_date INTEGER, error TEXT, timestamp_started INTEGER,
+            timestamp_updated INTEGER)''',
+    ],
+    # 9: Dialogs of each account at its last full scan, for the membership checks while the next scan runs
+    [
+        '''CREATE TABLE IF NOT EXISTS dialog_snapshot
+           (owner TEXT NOT NULL, peer_id INTEGER NOT NULL, usernames TEXT NOT NULL,
+            PRIMARY KEY (owner, peer_id)) WITHOUT ROWID''',
+    ],
+    # 10: Media stored by content in MEDIA_FOLDER, the messages they were sent in, and the Telegram handles of each
+    # account to send them again (kind 'photo' or 'document' from a message, 'upload' for the parts of an upload)
+    [
+        '''CREATE TABLE IF NOT EXISTS media_files
+           (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, mime_type TEXT, path TEXT NOT NULL,
+            timestamp_stored INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS media_messages
+           (chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, group_username TEXT, kind TEXT NOT NULL,
+            sha256 TEXT NOT NULL, telegram_file_id INTEGER, file_name TEXT, timestamp_sent INTEGER,
+            PRIMARY KEY (chat_id, message_id))''',
+        'CREATE INDEX IF NOT EXISTS media_messages_telegram_file_id ON media_messages (telegram_file_id)',
+        'CREATE INDEX IF NOT EXISTS media_messages_sha256 ON media_messages (sha256)',
+        '''CREATE TABLE IF NOT EXISTS media_handles
+           (owner TEXT NOT NULL, sha256 TEXT NOT NULL, kind TEXT NOT NULL, media_id INTEGER NOT NULL,
+            access_hash INTEGER, file_reference BLOB, parts INTEGER, name TEXT, timestamp_updated INTEGER,
+            PRIMARY KEY (owner, sha256, kind)) WITHOUT ROWID''',
+    ],
+    # 11: Group usernames in lower case, as normalize_username stores them: the rows written under the configured
+    # spelling join the newer ones. The rollups of a day split between two spellings are merged, keeping the top terms
+    # of one of them.
+    [
+        'UPDATE messages SET group_username = lower(group_username) WHERE group_username != lower(group_username)',
+        '''UPDATE groups_to_watch SET group_username = lower(group_username)
+           WHERE group_username != lower(group_username)''',
+        '''UPDATE media_messages SET group_username = lower(group_username)
+           WHERE group_username != lower(group_username)''',
+        '''INSERT OR IGNORE INTO message_rollup_senders (group_username, day, from_id)
+           SELECT lower(group_username), day, from_id FROM message_rollup_senders
+           WHERE group_username != lower(group_username)''',
+        'DELETE FROM message_rollup_senders WHERE group_username != lower(group_username)',
+        '''UPDATE message_rollups_daily SET message_count = message_count + (
+               SELECT SUM(other.message_count) FROM message_rollups_daily AS other
+               WHERE lower(other.group_username) = message_rollups_daily.group_username
+               AND other.group_username != message_rollups_daily.group_username
+               AND other.day = message_rollups_daily.day)
+           WHERE group_username = lower(group_username) AND EXISTS (
+               SELECT 1 FROM message_rollups_daily AS other
+               WHERE lower(other.group_username) = message_rollups_daily.group_username
+               AND other.group_username != message_rollups_daily.group_username
+               AND other.day = message_rollups_daily.day)''',
+        '''INSERT OR IGNORE INTO message_rollups_daily (group_username, day, chat_id, message_count, active_senders,
+                                                       top_terms)
+           SELECT lower(group_username), day, MAX(chat_id), SUM(message_count), 0, MAX(top_terms)
+           FROM message_rollups_daily WHERE group_username != lower(group_username)
+           GROUP BY lower(group_username), day''',
+        'DELETE FROM message_rollups_daily WHERE group_username != lower(group_username)',
+        '''UPDATE message_rollups_daily SET active_senders = (
+               SELECT COUNT(*) FROM message_rollup_senders AS senders
+               WHERE senders.group_username = message_rollups_daily.group_username
+               AND senders.day = message_rollups_daily.day)''',
+    ],
+    # 12: Backfill progress by account and group, each account that shares the database backfills on its own
+    [
+        '''CREATE TABLE backfill_state_new
+           (owner TEXT NOT NULL, group_username TEXT NOT NULL, status TEXT NOT NULL,
+            checkpoint_id INTEGER NOT NULL DEFAULT 0, messages_fetched INTEGER NOT NULL DEFAULT 0,
+            max_messages INTEGER NOT NULL, oldest_date INTEGER, error TEXT, timestamp_started INTEGER,
+            timestamp_updated INTEGER, PRIMARY KEY (owner, group_username))''',
+        '''INSERT INTO backfill_state_new (owner, group_username, status, checkpoint_id, messages_fetched, max_messages,
+                                          oldest_date, error, timestamp_started, timestamp_updated)
+           SELECT owner, group_username, status, checkpoint_id, messages_fetched, max_messages, oldest_date, error,
+                  timestamp_started, timestamp_updated FROM backfill_state''',
+        'DROP TABLE backfill_state',
+        'ALTER TABLE backfill_state_new RENAME TO backfill_state',
+    ],
+    # 13: Threads and pinned facts by account, the accounts sharing the database each keep their own conversation
+    # with the same chat. The rows written before have no owner (''), the first account to load its threads takes
+    # them over (see ThreadManager.load).
+    [
+        '''CREATE TABLE chat_threads_new
+           (owner TEXT NOT NULL, chat_id INTEGER NOT NULL, thread_id TEXT, timestamp_created INTEGER,
+            PRIMARY KEY (owner, chat_id))''',
+        '''INSERT INTO chat_threads_new (owner, chat_id, thread_id, timestamp_created)
+           SELECT '', chat_id, thread_id, timestamp_created FROM chat_threads''',
+        'DROP TABLE chat_threads',
+        'ALTER TABLE chat_threads_new RENAME TO chat_threads',
+        'CREATE INDEX IF NOT EXISTS chat_threads_owner_thread_id ON chat_threads (owner, thread_id)',
+        '''CREATE TABLE thread_state_new
+           (owner TEXT NOT NULL, thread_id TEXT NOT NULL, approx_tokens INTEGER NOT NULL DEFAULT 0, replaced_by TEXT,
+            summary TEXT, timestamp_rotated INTEGER, PRIMARY KEY (owner, thread_id))''',
+        '''INSERT INTO thread_state_new (owner, thread_id, approx_tokens, replaced_by, summary, timestamp_rotated)
+           SELECT '', thread_id, approx_tokens, replaced_by, summary, timestamp_rotated FROM thread_state''',
+        'DROP TABLE thread_state',
+        'ALTER TABLE thread_state_new RENAME TO thread_state',
+        "ALTER TABLE pinned_facts ADD COLUMN owner TEXT NOT NULL DEFAULT ''",
+        'DROP INDEX IF EXISTS pinned_facts_chat_id',
+        'CREATE INDEX IF NOT EXISTS pinned_facts_owner_chat_id ON pinned_facts (owner, chat_id)',
+    ],
+    # 14: A group is watched once, the spellings merged by migration 11 left duplicates
+    [
+        '''DELETE FROM groups_to_watch WHERE id NOT IN
+           (SELECT MIN(id) FROM groups_to_watch GROUP BY group_username)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS groups_to_watch_group_username ON groups_to_watch (group_username)',
+    ],
+]
+
+PRAGMAS = [
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA busy_timeout = 5000',
+]
+
+
+class Storage:
+    """
+    Owns a small pool of long-lived connections to the database. Each connection is used by one caller at a time,
+    so the pool can be shared between the event loop and worker threads.
+    """
+
+    def __init__(self, db_path: str = 'assistant.db', pool_size: int = 4):
+        """
+        :param db_path: The path of the SQLite database
+        :param pool_size: The number of connections kept open
+        """
+        self.db_path = db_path
+        self.pool_size = pool_size
+
+        self._pool: queue.Queue = queue.Queue()
+
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """
+        Opens a new tuned connection. Used for the connections that must live in a given thread, like the writer's.
+        :param read_only: Open the database in read-only mode
+        :return: The connection
+        """
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrows a connection from the pool. The transaction is committed when the block exits, or rolled back if it
+        raises.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+
+        try:
+            with conn:
+                yield conn
+        finally:
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(conn)
+            else:
+                conn.close()
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        """
+        Executes a statement in its own transaction.
+        :return: The rows returned by the statement
+        """
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql: str, rows: Iterable[Sequence[Any]]) -> None:
+        """
+        Executes a statement for every row in a single transaction.
+        """
+        with self.connection() as conn:
+            conn.executemany(sql, rows)
+
+    def get_version(self) -> int:
+        """
+        :return: The schema version of the database
+        """
+        return self.execute('PRAGMA user_version')[0][0]
+
+    def migrate(self) -> None:
+        """
+        Applies the migrations the database doesn't have yet, each one in its own transaction.
+        """
+        with self.connection() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version == 0 and not conn.execute('SELECT 1 FROM sqlite_master').fetchall():
+                # Only possible on an empty database, VACUUM applies it as WAL already wrote the header. The pages
+                # freed by the retention can then be released in small steps (see retention.py).
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+
+        for number, statements in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+
+            logger.info("Migrating the database to version %s", number)
+            with self.connection() as conn:
+                conn.execute('BEGIN')
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+
+    def close(self) -> None:
+        """
+        Closes the connections of the pool.
+        """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,345 @@
+"""
+Run many Telegram Assistant accounts: the sessions found in SESSIONS_FOLDER are sharded across worker processes,
+each running all its accounts in a single event loop. The supervisor process owns the only database writer.
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from data import *
+from ingestion import IngestionWriter, RemoteIngestionWriter
+from metrics import MetricsServer
+from retention import RetentionManager
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s %(processName)s %(levelname)s %(name)s: %(message)s'
+
+
+def discover_sessions(sessions_folder: str) -> List[Dict[str, Any]]:
+    """
+    Finds the Telethon session files of a folder. A {session}.json file next to a session can set its own proxy
+    (proxy_ip, proxy_port, proxy_username, proxy_password), API credentials (app_id, app_hash), OpenAI thread
+    (thread_id) and service group (service_group). The values from config.ini are used otherwise.
+
+    :param sessions_folder: The folder with the .session files
+    :return: The list of the session settings
+    """
+    sessions = []
+    for session_path in sorted(glob.glob(os.path.join(sessions_folder, '*.session'))):
+        session_file = os.path.basename(session_path)
+
+        overrides = {}
+        json_path = os.path.join(sessions_folder, f'{session_file}.json')
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as json_file:
+                overrides = json.load(json_file)
+
+        sessions.append({
+            'session_file': session_file,
+            'api_id': overrides.get('app_id', API_ID),
+            'api_hash': overrides.get('app_hash', API_HASH),
+            'proxy': (overrides.get('proxy_ip', IP), overrides.get('proxy_port', PORT),
+                      overrides.get('proxy_username', USERNAME), overrides.get('proxy_password', PASSWORD)),
+            'thread_id': overrides.get('thread_id'),
+            'service_group': overrides.get('service_group', os.getenv('GROUP')),
+        })
+
+    return sessions
+
+
+def shard_sessions(sessions: List[Dict[str, Any]], workers: int) -> List[List[Dict[str, Any]]]:
+    """
+    Splits the sessions round-robin between the workers, dropping the empty shards.
+    """
+    shards = [sessions[index::workers] for index in range(workers)]
+    return [shard for shard in shards if shard]
+
+
+class AccountRunner:
+    """
+    Keeps one account connected: the assistant is started again with an exponential backoff every time it
+    disconnects or fails, and its health is available for reporting.
+    """
+
+    def __init__(self, session: Dict[str, Any], ingestion_writer: IngestionWriter, max_backoff: float = 300.0):
+        """
+        :param session: The session settings from discover_sessions
+        :param ingestion_writer: The writer shared by all the accounts of the process
+        :param max_backoff: The maximal delay before a reconnection, in seconds
+        """
+        self.session = session
+        self.ingestion_writer = ingestion_writer
+        self.max_backoff = max_backoff
+
+        self.bot = None
+        self.status = 'created'
+        self.restarts = 0
+        self.last_error = None
+        self.connected_since = None
+
+    async def run(self) -> None:
+        # Imported here, the supervisor process doesn't need Telethon
+        from telegram_assistant import TelegramAssistant
+
+        session = self.session
+        self.bot = TelegramAssistant(session['session_file'], SESSIONS_FOLDER, session['api_id'], session['api_hash'],
+                                     [session['service_group']], session['service_group'], ASSISTANT_ID,
+                                     session['thread_id'], stream_responses=STREAM_RESPONSES,
+                                     max_action_rounds=MAX_ACTION_ROUNDS, tool_timeout=TOOL_TIMEOUT,
+                                     ingestion_writer=self.ingestion_writer, engine=ENGINE, chat_model=CHAT_MODEL,
+                                     max_history_messages=MAX_HISTORY_MESSAGES,
+                                     max_thread_tokens=MAX_THREAD_TOKENS, outbound_global_rate=OUTBOUND_GLOBAL_RATE,
+                                     outbound_chat_rate=OUTBOUND_CHAT_RATE, backfill_concurrency=BACKFILL_CONCURRENCY,
+                                     backfill_rpc_rate=BACKFILL_RPC_RATE, max_run_age=MAX_RUN_AGE,
+                                     stuck_run_policy=STUCK_RUN_POLICY, openai_api_key=OPENAI_API_KEY,
+                                     media_folder=MEDIA_FOLDER, media_download=MEDIA_DOWNLOAD,
+                                     media_max_file_size=int(MEDIA_MAX_FILE_SIZE_MB * 1024 * 1024),
+                                     media_bandwidth=MEDIA_BANDWIDTH_KBPS * 1024, media_concurrency=MEDIA_CONCURRENCY)
+
+        backoff = 1.0
+        while True:
+            try:
+                self.status = 'connecting'
+                await self.bot.start(*session['proxy'])
+
+                self.status = 'running'
+                self.connected_since = time.time()
+                backoff = 1.0
+
+                await self.bot.run()
+                self.last_error = 'disconnected'
+            except asyncio.CancelledError:
+                self.status = 'stopped'
+                await self.bot.disconnect()
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                # The handlers of the old connection must not process events anymore
+                await self.bot.disconnect()
+
+            self.status = 'reconnecting'
+            self.connected_since = None
+            self.restarts += 1
+            logger.warning("%s: %s, reconnecting in %.0fs", session['session_file'], self.last_error, backoff)
+
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            'status': self.status,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+            'uptime': time.time() - self.connected_since if self.connected_since else 0.0,
+        }
+
+
+async def run_shard(sessions: List[Dict[str, Any]], batch_queue, health_queue, health_interval: float,
+                    metrics_port: int = 0) -> None:
+    """
+    Runs the accounts of a worker process concurrently and reports their health every health_interval seconds.
+    The metrics of the worker are served on metrics_port, if set.
+    """
+    writer = RemoteIngestionWriter(batch_queue)
+    await writer.start()
+
+    metrics_server = MetricsServer(metrics_port) if metrics_port else None
+    if metrics_server is not None:
+        await metrics_server.start()
+
+    runners = [AccountRunner(session, writer) for session in sessions]
+    tasks = [asyncio.create_task(runner.run()) for runner in runners]
+
+    try:
+        while True:
+            await asyncio.sleep(health_interval)
+            health_queue.put({
+                'pid': os.getpid(),
+                'accounts': {runner.session['session_file']: runner.health() for runner in runners},
+                'ingestion': writer.stats(),
+            })
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await writer.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+
+
+def worker_main(sessions: List[Dict[str, Any]], batch_queue, health_queue, health_interval: float,
+                metrics_port: int = 0) -> None:
+    """
+    Entry point of a worker process.
+    """
+    # Spawned processes don't inherit the logging configuration
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    # Telethon proxies need a selector loop
+    loop = asyncio.SelectorEventLoop()
+    asyncio.set_event_loop(loop)
+
+    main = loop.create_task(run_shard(sessions, batch_queue, health_queue, health_interval, metrics_port))
+    try:
+        loop.run_until_complete(main)
+    except KeyboardInterrupt:
+        # Disconnect the accounts and send the queued messages to the supervisor
+        main.cancel()
+        loop.run_until_complete(asyncio.gather(main, return_exceptions=True))
+    finally:
+        loop.close()
+
+
+class Supervisor:
+    """
+    Starts the worker processes, restarts the ones that die, writes the messages they capture and collects their
+    health reports.
+    """
+
+    def __init__(self, sessions: List[Dict[str, Any]], workers: int, health_interval: float = 30.0,
+                 metrics_port: int = 0):
+        """
+        :param sessions: The session settings from discover_sessions
+        :param workers: The number of worker processes
+        :param health_interval: The delay between two health reports of a worker, in seconds
+        :param metrics_port: The port of the supervisor's metrics, worker i serves its own on metrics_port + 1 + i.
+        0 disables the metrics endpoints.
+        """
+        self.shards = shard_sessions(sessions, workers)
+        self.health_interval = health_interval
+        self.metrics_port = metrics_port
+
+        self.context = multiprocessing.get_context('spawn')
+        self.batch_queue = self.context.Queue()
+        self.health_queue = self.context.Queue()
+        self.processes: List[Any] = [None] * len(self.shards)
+
+        # Latest health report of every account
+        self.health: Dict[str, Dict[str, Any]] = {}
+
+        self.storage = Storage()
+        self.writer = IngestionWriter(self.storage)
+        self.retention = RetentionManager(self.storage, RETENTION_KEEP_DAYS, RETENTION_GROUPS,
+                                          archive_path=RETENTION_ARCHIVE_PATH, chunk_size=RETENTION_CHUNK_SIZE,
+                                          interval=RETENTION_INTERVAL)
+
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='supervisor')
+        self._stopping = False
+
+    def start_worker(self, index: int) -> None:
+        process = self.context.Process(target=worker_main, name=f'assistant-worker-{index}', daemon=True,
+                                       args=(self.shards[index], self.batch_queue, self.health_queue,
+                                             self.health_interval,
+                                             self.metrics_port + 1 + index if self.metrics_port else 0))
+        process.start()
+        self.processes[index] = process
+        logger.info("Started worker %s (pid %s) with %s accounts", index, process.pid, len(self.shards[index]))
+
+    async def run(self) -> None:
+        # Migrate once, before the workers open the database
+        self.storage.migrate()
+        await self.writer.start()
+        if RETENTION_KEEP_DAYS or RETENTION_GROUPS:
+            await self.retention.start()
+
+        metrics_server = MetricsServer(self.metrics_port) if self.metrics_port else None
+        if metrics_server is not None:
+            await metrics_server.start()
+
+        for index in range(len(self.shards)):
+            self.start_worker(index)
+
+        tasks = [asyncio.create_task(self._pump_batches()), asyncio.create_task(self._collect_health())]
+        try:
+            while True:
+                await asyncio.sleep(5)
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logger.warning("Worker %s exited with code %s, restarting it", index, process.exitcode)
+                        self.start_worker(index)
+        finally:
+            await self._stop_workers()
+            await self.retention.stop()
+
+            # The workers are gone, write what is left in the queue and stop
+            self._stopping = True
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.writer.stop()
+            self._executor.shutdown(wait=True)
+            if metrics_server is not None:
+                await metrics_server.stop()
+            logger.info("Ingestion stats: %s", self.writer.stats())
+
+    async def _stop_workers(self, timeout: float = 10.0) -> None:
+        """
+        Interrupts the workers so they flush their messages, and kills the ones that don't exit within timeout.
+        The batches keep being written meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        processes = [process for process in self.processes if process is not None]
+
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+
+        for process in processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+    async def _read(self, source, drain: bool = False):
+        """
+        Reads from a multiprocessing queue without blocking the loop, None on timeout.
+        """
+        try:
+            if drain:
+                return source.get_nowait()
+            return await asyncio.get_running_loop().run_in_executor(self._executor, source.get, True, 1.0)
+        except queue.Empty:
+            return None
+
+    async def _pump_batches(self) -> None:
+        while True:
+            batch = await self._read(self.batch_queue, drain=self._stopping)
+            if batch is None:
+                if self._stopping:
+                    return
+                continue
+
+            for row in batch:
+                await self.writer.put(row)
+
+    async def _collect_health(self) -> None:
+        while not self._stopping:
+            report = await self._read(self.health_queue)
+            if report is None:
+                continue
+
+            self.health.update(report['accounts'])
+            running = sum(1 for account in self.health.values() if account['status'] == 'running')
+            logger.debug("Worker %s: %s", report['pid'], report['accounts'])
+            logger.info("%s/%s accounts running, database writer: %s", running, len(self.health), self.writer.stats())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    sessions_ = discover_sessions(SESSIONS_FOLDER)
+    logger.info("Found %s sessions in %s", len(sessions_), SESSIONS_FOLDER)
+
+    supervisor = Supervisor(sessions_, SUPERVISOR_WORKERS, SUPERVISOR_HEALTH_INTERVAL, METRICS_PORT)
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:
+        pass
@@ -1,16 +1,70 @@
-import configparser
+import asyncio
 import json
+import logging
 import os
+import re
 import sqlite3
-from datetime import timedelta
-from typing import List, Union, Dict, Any
-from telethon import events
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Union, Dict, Any, Optional
+from telethon import events, utils
 from telethon.tl.functions.channels import JoinChannelRequest, LeaveChannelRequest
 from telethon.tl.functions.photos import DeletePhotosRequest, UploadProfilePhotoRequest
 from telethon.tl.types import InputPhoto
 from telegrambot import TelegramBot
-from openai_assistant import OpenaiAssistant
-from openai import OpenAI
+from thread_manager import ThreadManager
+from ingestion import IngestionWriter
+from storage import Storage
+from dialog_index import DialogIndex, normalize_username
+from user_cache import LRUCache
+from tool_registry import ToolRegistry, validate
+from tool_output import ToolOutputEncoder
+from get_db_schema import get_schema
+from query_engine import QueryEngine
+from outbound import OutboundScheduler, PRIORITY_ACTION, PRIORITY_OWNER
+from job_scheduler import JobScheduler
+from backfill import BackfillManager
+from media import MediaStore
+from metrics import (EVENTS, RUN_PHASE_SECONDS, STARTUP_SECONDS, TOOL_CALLS, TOOL_SECONDS, chat_id_var, span,
+                     trace_context)
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Joins and leaves share a much stricter limit than the messages: 1 per minute, 3 at once
+JOIN_LEAVE_KEY = 'join_leave'
+JOIN_LEAVE_RATE = (1 / 60, 3)
+
+# Tools the assistant can schedule, and ask_assistant which sends a message to the assistant itself when it is due
+SCHEDULABLE_ACTIONS = ['send_message', 'add_comment', 'send_media', 'join_channel', 'leave_channel',
+                       'add_group_to_watchlist', 'remove_group_from_watchlist', 'ask_assistant']
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    Parses an ISO 8601 date or datetime written by the assistant, UTC if it has no timezone.
+    """
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def parse_timedelta(value: Union[str, int, float, timedelta]) -> timedelta:
+    """
+    Parses a delay written by the assistant: a number of seconds or units like '1d', '2h30m', '45s'.
+    """
+    if isinstance(value, timedelta):
+        return value
+    if isinstance(value, (int, float)) or value.strip().isdigit():
+        return timedelta(seconds=float(value))
+
+    parts = re.findall(r'(\d+(?:\.\d+)?)\s*([wdhms])', value.lower())
+    if not parts:
+        raise ValueError(f"Invalid delay: {value}")
+
+    units = {'w': 'weeks', 'd': 'days', 'h': 'hours', 'm': 'minutes', 's': 'seconds'}
+    return timedelta(**{units[unit]: float(number) for number, unit in parts})
 
 
 class TelegramAssistant(TelegramBot):
@@ -19,101 +73,396 @@ class TelegramAssistant(TelegramBot):
     """
 
     def __init__(self, session_file: str, sessions_folder: str, api_id: int, api_hash: str,
-                 whitelist_users_list: List[str], service_group_username: str, assistant_id: str, thread_id: str):
+                 whitelist_users_list: List[str], service_group_username: str, assistant_id: str, thread_id: str,
+                 stream_responses: bool = False, max_action_rounds: int = 10, tool_timeout: float = 30.0,
+                 ingestion_writer: IngestionWriter = None, engine: str = 'assistants', chat_model: str = 'gpt-4o',
+                 max_history_messages: int = 50, max_thread_tokens: int = 100000, outbound_global_rate: float = 1.0,
+                 outbound_chat_rate: float = 0.3, outbound_wait: float = 10.0, backfill_concurrency: int = 3,
+                 backfill_rpc_rate: float = 2.0, max_run_age: float = 600.0, stuck_run_policy: str = 'cancel',
+                 openai_api_key: str = None, media_folder: str = None, media_download: bool = True,
+                 media_max_file_size: int = 20 * 1024 * 1024, media_bandwidth: float = 1024 * 1024,
+                 media_concurrency: int = 2):
         """
         Initializes the Telegram Assistant with the provided API id, hash, bot token,
         list of whitelisted users, and service group username.
+
+        If stream_responses is True, the answer is shown while it is generated by editing a single reply.
+        max_action_rounds caps the number of tool call rounds in a single run, and tool_timeout is the time given to
+        each tool call, in seconds.
+        ingestion_writer can be shared between several assistants, it is then started and stopped by its owner.
+        engine selects how the answers are generated: 'assistants' uses OpenAI threads and runs, 'chat' uses Chat
+        Completions with chat_model and keeps the last max_history_messages messages of every chat in the database.
+        A thread larger than max_thread_tokens (100000 by default, as MAX_THREAD_TOKENS) is replaced by a new one seeded
+        with a summary, 0 to never rotate.
+        The messages, comments, joins and leaves are rate limited to outbound_global_rate actions per second and
+        outbound_chat_rate per chat. A tool waits outbound_wait seconds for its action, then reports it as queued.
+        The history of the groups added to the watchlist is imported backfill_concurrency groups at a time, within
+        backfill_rpc_rate history requests per second.
+        A run is cancelled max_run_age seconds after it was created. The runs found active on a thread, left by a
+        crash or a restart, are cancelled or resumed according to stuck_run_policy, 'cancel' or 'resume'.
+        openai_api_key defaults to the key of config.ini.
+        The files are stored by content in media_folder, None to store nothing. If media_download is True, the
+        attachments of the watched groups up to media_max_file_size bytes are downloaded media_concurrency at a time,
+        and the transfers are limited to media_bandwidth bytes per second.
+
+        Nothing is read from the database here, start() prepares it while the client logs in.
         """
         # self.client = TelegramClient('assistant', api_id, api_hash).start(bot_token=bot_token)
 
         # proxy_ip = None
         super().__init__(session_file, api_id, api_hash, sessions_folder=sessions_folder)
-        print(f'Created new bot! Phone: {session_file}')
+        logger.info('Created new bot! Phone: %s', session_file)
 
         self.whitelist_users_list = whitelist_users_list
+        self.whitelist_users = {normalize_username(user) for user in whitelist_users_list if user}
         self.service_group_username = service_group_username
-
-        # Load the groups to watch from the db
-        self.groups_to_watch = self.get_groups_to_watch()['info']
-        print(f"Groups to watch: {self.groups_to_watch}")
-
-        self.initialize_database()
+        self.service_group_id = None
+        self.stream_responses = stream_responses
+        self.max_action_rounds = max_action_rounds
+        self.tool_timeout = tool_timeout
+
+        # Long-lived connections to assistant.db
+        self.storage = Storage()
+
+        # Loaded from the db by prepare_storage
+        self.groups_to_watch = []
+        self.storage_ready = False
+
+        # Chat id -> group username of the watched groups, filled once the dialogs are indexed
+        self.dialog_index = None
+        self.dialog_refresh = None
+        self.watched_chats = {}
+        # Username -> peer id of the service group and the watched groups, resolved without the index on a first start
+        self.resolved_peers: Dict[str, int] = {}
+        self.handlers_registered = False
 
         script_dir = os.path.dirname(__file__)
         session_file_path = os.path.join(script_dir, f'{sessions_folder}/{self.session_file}')
 
         self.json_file_path = os.path.join(script_dir, f'{sessions_folder}/{self.session_file}.json')
-        print(session_file_path)
+        logger.debug(session_file_path)
+
+        if openai_api_key is None:
+            # Parsed once per process, by the first import
+            from data import OPENAI_API_KEY as openai_api_key
+        openai_client = AsyncOpenAI(api_key=openai_api_key)
+
+        # Every chat gets its own OpenAI thread, the configured thread is kept for the service group
+        if engine == 'chat':
+            from chat_completions import ChatCompletionsAssistant
+
+            self.thread_manager = ThreadManager(openai_client, assistant_id, self.storage, default_thread_id=thread_id,
+                                                assistant_class=ChatCompletionsAssistant,
+                                                max_thread_tokens=max_thread_tokens, owner=session_file,
+                                                conversation_storage=self.storage,
+                                                model=chat_model, max_history_messages=max_history_messages)
+        elif engine == 'assistants':
+            self.thread_manager = ThreadManager(openai_client, assistant_id, self.storage, default_thread_id=thread_id,
+                                                max_thread_tokens=max_thread_tokens, owner=session_file,
+                                                max_run_age=max_run_age, stuck_run_policy=stuck_run_policy)
+        else:
+            raise ValueError(f"Unknown engine {engine}, expected 'assistants' or 'chat'")
+
+        # Users seen in the events and in the conversation histories
+        self.user_cache = LRUCache(max_size=10000, ttl=3600)
+
+        # Queries written by the assistant run read-only, off the event loop and with a time budget
+        self.query_engine = QueryEngine(self.storage)
+
+        # Tools declared in functions.json, with argument validation and result caching
+        self.tool_registry = self.register_tools()
 
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        openai_client = OpenAI(api_key=config['OPENAI']['OPENAI_API_KEY'])
+        # Tool results are sent back as compact JSON within a token budget per tool
+        self.tool_output_encoder = ToolOutputEncoder(default_budget=1500, budgets={
+            'get_conversation_history': 3000,
+            'get_data_from_db': 3000,
+            'search_messages': 2000,
+        }, cursors={'get_conversation_history': self._history_cursor})
 
-        self.openai_assistant = OpenaiAssistant(openai_client, assistant_id, thread_id)
+        # Messages of the watched groups are written in batches by a background thread
+        self.owns_ingestion_writer = ingestion_writer is None
+        self.ingestion_writer = ingestion_writer or IngestionWriter(self.storage)
 
-        print("Connecting...")
+        # Every action changing something on Telegram goes through the rate limits of the account
+        self.outbound = OutboundScheduler(global_rate=outbound_global_rate, chat_rate=outbound_chat_rate,
+                                          key_rates={JOIN_LEAVE_KEY: JOIN_LEAVE_RATE})
+        self.outbound_wait = outbound_wait
+
+        # Delayed and recurring actions, loaded when the client runs
+        self.job_scheduler = JobScheduler(self.storage, session_file, self.run_scheduled_job)
+
+        # Past messages of the groups added to the watchlist, imported in the background
+        self.backfill = BackfillManager(self.storage, session_file, concurrency=backfill_concurrency,
+                                        rpc_rate=backfill_rpc_rate)
+
+        # Attachments of the watched groups and files sent by the assistant, started when the client runs
+        self.media = MediaStore(self.storage, media_folder, session_file, download=media_download,
+                                max_file_size=media_max_file_size, bandwidth=media_bandwidth,
+                                concurrency=media_concurrency) if media_folder else None
 
     async def start(self, proxy_ip: str = None, proxy_port: int = None, proxy_username: str = None,
                     proxy_password: str = None):
+        """
+        Logs in while the database is prepared, finds the service group and the watched groups in the snapshot of the
+        dialogs, and registers the handlers before the dialogs are indexed, so the messages received during the rest of
+        the startup are handled. Then indexes the dialogs and joins the service group. The duration of every phase is
+        logged.
+        """
+        phases = {}
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        try:
+            # The login and the database don't depend on each other
+            results = await asyncio.gather(
+                self._timed(phases, 'login', self.login_telethon(proxy_ip, proxy_port, proxy_username, proxy_password)),
+                self._timed(phases, 'database', loop.run_in_executor(None, self.prepare_storage)),
+                return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+            if self.owns_ingestion_writer:
+                await self.ingestion_writer.start()
+
+            # Membership checks are local lookups in the index, kept current by the chat actions
+            self.dialog_index = DialogIndex(self.client, self.storage, self.session_file)
+            self.dialog_index.on_change = self.rebuild_watch_filter
+            from_snapshot = self.dialog_index.load_snapshot()
+            if not from_snapshot:
+                # First start: the chats the handlers route are resolved one by one instead of waiting for the scan
+                await self._timed(phases, 'resolve', self.resolve_peers())
+
+            self.update_service_group()
+            self.rebuild_watch_filter()
+            self.register_handlers()
+            await self._timed(phases, 'dialogs', self.load_dialogs(from_snapshot))
+            # The index is complete or loaded from the snapshot, it is the only source of the peer ids from now on
+            self.resolved_peers.clear()
+
+            # Check if the bot is in the service group and if not, join it
+            if not (await self.is_bot_in_group(self.service_group_username))['info']:
+                await self._timed(phases, 'service_group', self.join_channel(self.service_group_username))
+
+            self.update_service_group()
+            self.rebuild_watch_filter()
+        except BaseException:
+            # The next start() begins with a new client, nothing of this one must keep running
+            await self._abort_start()
+            raise
+
+        logger.info("Started in %.2fs (%s)", time.perf_counter() - started,
+                    ', '.join(f'{phase}: {duration:.2f}s' for phase, duration in phases.items()))
+
+    async def _abort_start(self) -> None:
+        """
+        Stops what a failed start() already started: the dialog scan, the ingestion writer and the client with its
+        handlers.
+        """
+        self.handlers_registered = False
+        if self.dialog_refresh is not None:
+            self.dialog_refresh.cancel()
+            self.dialog_refresh = None
+
+        if self.owns_ingestion_writer:
+            await self.ingestion_writer.stop()
+
+        if self.client is not None:
+            await self.disconnect()
+
+    @staticmethod
+    async def _timed(phases: Dict[str, float], phase: str, awaitable):
+        """
+        Awaits a phase of the startup and records its duration in phases.
+        """
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            phases[phase] = time.perf_counter() - started
+            STARTUP_SECONDS.observe(phases[phase], phase=phase)
+
+    def prepare_storage(self) -> None:
+        """
+        Migrates the database and loads the watchlist and the threads of the chats, once. Runs in a worker thread
+        during the login.
+        """
+        if self.storage_ready:
+            return
+
+        self.initialize_database()
+
+        self.groups_to_watch = self.get_groups_to_watch()['info']
+        logger.info("Groups to watch: %s", self.groups_to_watch)
+
+        self.thread_manager.load()
+        self.storage_ready = True
+
+    def register_handlers(self) -> None:
+        """
+        Registers the command, watch and chat action handlers on the client.
+        """
+        self.client.add_event_handler(self.command_handler,
+                                      events.NewMessage(incoming=True, func=self.is_command_event))
+        self._add_watch_handler()
+        self.client.add_event_handler(self.dialog_index.on_chat_action, events.ChatAction())
+        self.handlers_registered = True
+
+    async def resolve_peers(self) -> None:
+        """
+        Resolves the peer ids of the service group and the watched groups without the dialog index, from the entity
+        cache of the session or with one request each.
+        """
+        usernames = [group for group in [self.service_group_username] + list(self.groups_to_watch or [])
+                     if group and not group.lstrip('-').isdigit()]
+        results = await asyncio.gather(*(self.client.get_peer_id(username) for username in usernames),
+                                       return_exceptions=True)
+
+        for username, result in zip(usernames, results):
+            if isinstance(result, BaseException):
+                logger.warning("Could not resolve %s before the dialogs are indexed: %s", username, result)
+            else:
+                self.resolved_peers[normalize_username(username)] = result
+
+    def get_peer_id(self, entity: str) -> Optional[int]:
+        """
+        :param entity: The username or link of a chat
+        :return: The peer id of the chat from the dialog index, or as resolved by resolve_peers, None if unknown
+        """
+        peer_id = self.dialog_index.get_peer_id(entity) if self.dialog_index is not None else None
+        if peer_id is None:
+            peer_id = self.resolved_peers.get(normalize_username(entity))
+        return peer_id
+
+    def update_service_group(self) -> None:
+        """
+        Looks up the chat id of the service group and keeps its existing conversation.
+        """
+        self.service_group_id = self.get_peer_id(self.service_group_username)
+        if self.service_group_id is not None:
+            self.thread_manager.set_default(self.service_group_id)
+
+    async def load_dialogs(self, from_snapshot: bool) -> None:
+        """
+        Scans the dialogs in the background if the index was loaded from the snapshot of the last scan, otherwise now.
+        :param from_snapshot: Whether the index was loaded from the snapshot
+        """
+        if not from_snapshot:
+            await self.dialog_index.refresh()
+            return
 
-        # Login
-        await self.login_telethon(proxy_ip, proxy_port, proxy_username, proxy_password)
+        async def refresh():
+            try:
+                await self.dialog_index.refresh()
+            except Exception as e:
+                # The snapshot stays in use
+                logger.warning("Could not scan the dialogs: %s", e)
 
-        # Check if the bot is in the service group and if not, join it
-        if not await self.is_bot_in_group(self.service_group_username):
-            await self.join_channel(self.service_group_username)
+        self.dialog_refresh = asyncio.create_task(refresh())
 
     def initialize_database(self) -> None:
         """
         Initializes the SQLite database with tables for storing information about
-        groups/channels and messages.
+        groups/channels and messages, migrating an existing database to the latest schema.
         """
-        with sqlite3.connect('assistant.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS joined_groups
-                           (id INTEGER PRIMARY KEY, entity TEXT, access_hash TEXT, timestamp_joined INTEGER)''')
+        self.storage.migrate()
 
-            cursor.execute('''CREATE TABLE IF NOT EXISTS messages
-                           (id INTEGER PRIMARY KEY, from_id INTEGER, group_username TEXT, 
-                           message TEXT, timestamp_sent INTEGER)''')
+    async def get_response(self, message, on_delta=None, chat_id: int = None):
+        """
+        Gets the assistant's answer to a message, running the action it asks for. Messages of the same chat are
+        answered one at a time, messages of different chats in parallel.
+
+        :param message: The message to send to the assistant.
+        :param on_delta: Optional coroutine function called with every new piece of the answer. If set, the run is
+        streamed instead of polled.
+        :param chat_id: The chat the message comes from, which selects the OpenAI thread. None for the default thread.
+        :return: The answer of the assistant.
+        """
+        queued = time.perf_counter()
 
-            cursor.execute('''CREATE TABLE IF NOT EXISTS groups_to_watch
-                           (id INTEGER PRIMARY KEY, group_username TEXT)''')
-            conn.commit()
+        async def job(openai_assistant):
+            # Time spent behind the previous messages of the same chat
+            RUN_PHASE_SECONDS.observe(time.perf_counter() - queued, phase='queue_wait')
+            with trace_context(chat_id=chat_id):
+                return await self.run_conversation(openai_assistant, message, on_delta)
 
-    async def get_response(self, message):
-        self.openai_assistant.add_message_to_thread(message)
-        run = self.openai_assistant.send_command()
+        return await self.thread_manager.run_in_thread(chat_id, job)
 
-        response = self.openai_assistant.get_response(run.id)
+    async def run_conversation(self, openai_assistant, message, on_delta=None):
+        """
+        Sends a message to the thread of openai_assistant and runs the actions until the assistant answers.
+
+        :param openai_assistant: The OpenaiAssistant or ChatCompletionsAssistant bound to the thread.
+        :param message: The message to send to the assistant.
+        :param on_delta: Optional coroutine function called with every new piece of the answer.
+        :return: The answer of the assistant.
+        """
+        await openai_assistant.add_message_to_thread(message)
+        response = await openai_assistant.start_run(on_delta)
+
+        # Keep running the actions until the assistant answers
+        for _ in range(self.max_action_rounds):
+            if response['message'] is not None:
+                return response['message']
+
+            run_id = response['run_id']
+            try:
+                with span('tool_execution'):
+                    tool_outputs = await self.run_tool_calls(response['tool_calls'])
+            except BaseException:
+                # Otherwise the run waits for the outputs until it expires, and the thread stays locked
+                await openai_assistant.cancel_run(run_id)
+                raise
+
+            # Submit the action outputs and get the bot response
+            response = await openai_assistant.continue_run(run_id, tool_outputs, on_delta)
 
         if response['message'] is not None:
             return response['message']
-        else:
-            action = response['action']
-            run_id = response['run_id']
-            call_id = response['call_id']
 
-            # Run the action
-            function = action['function_name']
-            args = json.loads(action['function_args'])
+        await openai_assistant.cancel_run(response['run_id'])
+        raise Exception(f"The bot failed to respond after {self.max_action_rounds} rounds of actions.")
 
-            print(f"Running action {function} with args {args}")
+    async def run_tool_calls(self, tool_calls: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Runs all the tool calls of a round concurrently.
 
-            action_output = await self.call_action(function, args)
+        :param tool_calls: The tool calls returned by the assistant.
+        :return: The list of tool outputs to submit, in the same order as the tool calls.
+        """
+        outputs = await asyncio.gather(*[self.run_tool_call(tool_call) for tool_call in tool_calls])
 
-            print(f"Action output: {action_output}")
+        return [{'tool_call_id': tool_call['call_id'], 'output': output}
+                for tool_call, output in zip(tool_calls, outputs)]
 
-            # Submit the action output
-            run = self.openai_assistant.submit_tool_outputs(run_id, str(call_id), action_output)
+    async def run_tool_call(self, tool_call: Dict[str, str]) -> str:
+        """
+        Runs a single tool call within tool_timeout. Errors are returned to the assistant as the tool output
+        instead of failing the whole run.
 
-            # Get the bot response
-            response = self.openai_assistant.get_response(run.id)
+        :param tool_call: A tool call returned by the assistant.
+        :return: The output of the action.
+        """
+        function = tool_call['function_name']
 
-            if response['message'] is not None:
-                return response['message']
-            else:
-                raise Exception("The bot failed to respond to the action.")
+        try:
+            args = json.loads(tool_call['function_args'] or '{}')
+
+            logger.info("Running action %s with args %s", function, args)
+
+            with TOOL_SECONDS.time(tool=function):
+                action_output = await asyncio.wait_for(self.call_action(function, args), self.tool_timeout)
+        except asyncio.TimeoutError:
+            TOOL_CALLS.inc(tool=function, status='timeout')
+            error = f'{function} did not finish within {self.tool_timeout} seconds'
+            action_output = self.tool_output_encoder.encode(function, {'success': False, 'info': None, 'error': error})
+        except Exception as e:
+            TOOL_CALLS.inc(tool=function, status='error')
+            action_output = self.tool_output_encoder.encode(function, {'success': False, 'info': None, 'error': str(e)})
+
+        logger.debug("Action output: %s", action_output)
+
+        return action_output
 
     async def call_action(self, function: str, kwargs: Dict[str, str]) -> str:
         """
@@ -121,72 +470,173 @@ class TelegramAssistant(TelegramBot):
 
         :param function: The name of the function to call.
         :param kwargs: A dictionary containing the arguments to pass to the function.
-        :return: The output of the function.
-        """
-        if function == "get_data_from_db":
-            return str(self.get_data_from_db(**kwargs))
-        elif function == "is_bot_in_group":
-            return str(await self.is_bot_in_group(**kwargs))
-        elif function == "join_channel":
-            return str(await self.join_channel(**kwargs))
-        elif function == "leave_channel":
-            return str(await self.leave_channel(**kwargs))
-        elif function == "send_message":
-            return str(await self.send_message(**kwargs))
-        elif function == "get_conversation_history":
-            return str(await self.get_conversation_history(**kwargs))
-        elif function == "get_groups_to_watch":
-            return str(self.get_groups_to_watch())
-        elif function == "add_group_to_watchlist":
-            return str(self.add_group_to_watchlist(**kwargs))
+        :return: The output of the function, encoded as JSON within the tool's token budget.
+        """
+        result = await self.tool_registry.call(function, kwargs)
+
+        failed = isinstance(result, dict) and result.get('success') is False
+        TOOL_CALLS.inc(tool=function, status='failed' if failed else 'ok')
+
+        return self.tool_output_encoder.encode(function, result)
+
+    def register_tools(self) -> ToolRegistry:
+        """
+        Builds the registry of the tools declared in functions.json. Read-only tools get a ttl, tools that modify
+        something drop the cached results depending on them.
+
+        :return: The tool registry.
+        """
+        registry = ToolRegistry()
+
+        registry.register('get_data_from_db', self.get_data_from_db)
+        registry.register('search_messages', self.search_messages)
+        registry.register('get_db_schema', self.get_db_schema, ttl=300)
+        registry.register('get_conversation_history', self.get_conversation_history)
+
+        # The dialog index follows the joins and leaves as they happen, a cached answer could only be older
+        registry.register('is_bot_in_group', self.is_bot_in_group)
+        registry.register('join_channel', self.join_channel)
+        registry.register('leave_channel', self.leave_channel)
+
+        registry.register('get_groups_to_watch', self.get_groups_to_watch, ttl=60)
+        registry.register('add_group_to_watchlist', self.add_group_to_watchlist, invalidates=['get_groups_to_watch'])
+        registry.register('remove_group_from_watchlist', self.remove_group_from_watchlist,
+                          invalidates=['get_groups_to_watch'])
+        registry.register('get_backfill_progress', self.get_backfill_progress)
+
+        registry.register('send_message', self.send_message)
+        registry.register('add_comment', self.add_comment)
+        registry.register('send_media', self.send_media)
+
+        # The pinned facts depend on the current chat, which is not part of the cache key: never cached
+        registry.register('pin_fact', self.pin_fact)
+        registry.register('get_pinned_facts', self.get_pinned_facts)
+        registry.register('unpin_fact', self.unpin_fact)
+
+        registry.register('schedule_action', self.schedule_action)
+        registry.register('list_scheduled_actions', self.list_scheduled_actions)
+        registry.register('cancel_scheduled_action', self.cancel_scheduled_action)
+
+        if registry.missing():
+            logger.warning("Functions without a handler: %s", registry.missing())
+
+        return registry
+
+    def is_command_event(self, event) -> bool:
+        """
+        Cheap check run by Telethon for every incoming message: only private messages and messages in the service
+        group can be commands. The sender is not needed here.
+
+        :param event: The event to check.
+        """
+        return event.is_private or (self.service_group_id is not None and event.chat_id == self.service_group_id)
 
     async def event_handler(self, event) -> None:
         """
-        Handles incoming events and dispatches commands based on the event content.
+        Handles incoming events and dispatches commands based on the event content. run() registers command_handler
+        and watch_handler directly with Telethon filters, this dispatcher applies the same filters itself.
 
         :param event: The event to handle.
         """
-        print(event.raw_text)
-        # print(event)
+        if self.is_command_event(event):
+            await self.command_handler(event)
 
-        event_sender = await event.get_sender()
-        # print(f"Event sender: {event_sender}")
-        # print(f"Event chat username: {event.chat.username}")
-        # Check if the sender is in the whitelist and if the message is from the service group or a private message
-        if (event_sender.username in self.whitelist_users_list) and event.is_private:
-            print("Received a command in a DM!")
+        elif event.chat_id in self.watched_chats:
+            await self.watch_handler(event)
 
-            response = await self.get_response(event.raw_text)
+    async def command_handler(self, event) -> None:
+        """
+        Handles a command in a DM or in the service group.
 
-            # Respond
-            await event.respond(response)
+        :param event: The event to handle.
+        """
+        if event.is_private:
+            # Check if the sender is in the whitelist, the only path that needs the sender
+            event_sender = await self.get_sender(event)
+            if event_sender is None or (event_sender.username or '').lower() not in self.whitelist_users:
+                return
+
+            EVENTS.inc(type='command_dm')
+            logger.info("Received a command in a DM!")
+        else:
+            EVENTS.inc(type='command_group')
+            logger.info("Received a command in the service group!")
 
-        elif event.chat:
-            # Command in the service group
-            if event.chat.username == self.service_group_username:
-                print("Received a command in the service group!")
+        # Get the text and handle it with The OpenAI API
+        await self.reply(event)
 
-                # Get the text and handle it with The OpenAI API
+    async def watch_handler(self, event) -> None:
+        """
+        Stores a message received in a watched group or channel.
 
-                # Get the response from the OpenAI API
-                response = await self.get_response(event.raw_text)
+        :param event: The event to handle.
+        """
+        group_username = self.watched_chats.get(event.chat_id)
+        if group_username is None:
+            return
 
-                # Respond
-                await event.respond(response)
+        EVENTS.inc(type='watched')
+        timestamp_sent = int(event.message.date.timestamp())
+        await self.ingestion_writer.put((event.chat_id, event.message.id, event.sender_id, group_username,
+                                         event.raw_text, timestamp_sent))
 
-            # Message in a group or channel
-            elif event.chat.username in self.groups_to_watch:
-                print("Received a message in a group or channel!")
+        if self.media is not None:
+            self.media.enqueue(event.message, group_username)
 
-                # group_id = event.message.peer_id.channel_id
-                group_username = event.chat.username
-                from_id = event.message.from_id
-                with sqlite3.connect('assistant.db') as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        'INSERT INTO messages (from_id, group_username, message, timestamp_sent) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
-                        (from_id, group_username, event.raw_text))
-                    conn.commit()
+    def rebuild_watch_filter(self) -> None:
+        """
+        Recomputes the chat ids of the watched groups from the watchlist and the dialog index, and registers
+        watch_handler again with the new chats filter. Called whenever the watchlist or the dialogs change.
+        """
+        watched_chats = {}
+        for group in self.groups_to_watch or []:
+            if group.lstrip('-').isdigit():
+                watched_chats[int(group)] = group
+                continue
+
+            peer_id = self.get_peer_id(group)
+            if peer_id is not None:
+                watched_chats[peer_id] = normalize_username(group)
+
+        self.watched_chats = watched_chats
+
+        if self.handlers_registered:
+            self.client.remove_event_handler(self.watch_handler)
+            self._add_watch_handler()
+
+    def _add_watch_handler(self) -> None:
+        # Telethon drops the events of the other chats with a set lookup, before any handler code runs
+        if self.watched_chats:
+            self.client.add_event_handler(self.watch_handler,
+                                          events.NewMessage(incoming=True, chats=list(self.watched_chats)))
+
+    async def reply(self, event) -> None:
+        """
+        Answers a command, streaming the answer into a single message if stream_responses is enabled.
+
+        :param event: The event containing the command.
+        """
+        if not self.stream_responses:
+            # Get the response from the OpenAI API
+            response = await self.get_response(event.raw_text, chat_id=event.chat_id)
+
+            # Respond
+            await self.outbound.submit(lambda: event.respond(response), key=event.chat_id, priority=PRIORITY_OWNER,
+                                       kind='reply')
+            return
+
+        from message_streamer import MessageStreamer
+
+        streamer = MessageStreamer(event, outbound=self.outbound)
+        await streamer.start()
+
+        try:
+            response = await self.get_response(event.raw_text, on_delta=streamer.push, chat_id=event.chat_id)
+        except Exception as e:
+            await streamer.finish(f"Error: {e}")
+            raise
+
+        await streamer.finish(response)
 
     async def is_bot_in_group(self, entity: str) -> dict[str, Union[str, bool, None]]:
         """
@@ -198,14 +648,10 @@ class TelegramAssistant(TelegramBot):
         otherwise error contains the error message.
         """
         try:
-            async for dialog in self.client.iter_dialogs():
-                print(dialog.entity.username)
-                if dialog.entity.username == entity:
-                    return {'success': True, 'info': True, 'error': None}
-
-            return {'success': True, 'info': False, 'error': None}
+            await self.dialog_index.ensure_loaded()
+            return {'success': True, 'info': entity in self.dialog_index, 'error': None}
         except Exception as e:
-            print(e)
+            logger.warning("Could not check the membership of %s: %s", entity, e)
             return {'success': False, 'info': None, 'error': str(e)}
 
     async def change_profilepic(self, pic):
@@ -217,6 +663,12 @@ class TelegramAssistant(TelegramBot):
         the error message.
         """
         try:
+            if self.media is not None:
+                # Setting a picture used before reuses its upload
+                sha256 = await self.media.store_file(pic)
+                await self.media.run_with_upload(sha256, lambda file: self.client(UploadProfilePhotoRequest(file=file)))
+                return {'success': True, 'info': None, 'error': None}
+
             await self.client(UploadProfilePhotoRequest(
                 file=await self.client.upload_file(pic)
             ))
@@ -232,7 +684,7 @@ class TelegramAssistant(TelegramBot):
         the error message.
         """
         try:
-            print("Deleting the old profile photo...")
+            logger.info("Deleting the old profile photo...")
             p = await self.client.get_profile_photos('me')
             p = p[-1]
             await self.client(DeletePhotosRequest(
@@ -256,20 +708,24 @@ class TelegramAssistant(TelegramBot):
         the error message.
         """
         try:
-            print("Joining the channel...")
-            await self.client(JoinChannelRequest(entity))
-            entity_obj = await self.client.get_entity(entity)
-            with sqlite3.connect('assistant.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    'INSERT INTO joined_groups (entity, access_hash, timestamp_joined) VALUES (?, ?, CURRENT_TIMESTAMP)',
-                    (entity_obj.username, str(entity_obj.access_hash)))
-                conn.commit()
-
-            return {'success': True, 'info': None, 'error': None}
+            await self.dialog_index.ensure_loaded()
+            if entity in self.dialog_index:
+                return {'success': True, 'info': 'Already in the channel or group', 'error': None}
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
 
+        async def join():
+            logger.info("Joining %s", entity)
+            updates = await self.client(JoinChannelRequest(entity))
+            # The joined channel comes with the updates, no need to resolve it again
+            entity_obj = updates.chats[0] if getattr(updates, 'chats', None) else await self.client.get_entity(entity)
+            self.dialog_index.add(entity_obj)
+            self.storage.execute(
+                'INSERT INTO joined_groups (entity, access_hash, timestamp_joined, chat_id) VALUES (?, ?, ?, ?)',
+                (entity_obj.username, str(entity_obj.access_hash), int(time.time()), utils.get_peer_id(entity_obj)))
+
+        return await self.run_outbound(join, JOIN_LEAVE_KEY, 'join')
+
     async def leave_channel(self, entity: str) -> dict[str, Union[str, bool, None]]:
         """
         Leaves a channel or group and removes it from the database.
@@ -280,99 +736,307 @@ class TelegramAssistant(TelegramBot):
         the error message.
         """
         try:
-            await self.client(LeaveChannelRequest(entity))
-            with sqlite3.connect('assistant.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM joined_groups WHERE entity = ?', (entity,))
-                conn.commit()
-
-            return {'success': True, 'info': None, 'error': None}
+            await self.dialog_index.ensure_loaded()
+            peer_id = self.dialog_index.get_peer_id(entity)
+            if peer_id is None:
+                return {'success': True, 'info': 'Not in the channel or group', 'error': None}
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
 
-    async def send_message(self, entity: str, message: str, schedule: timedelta = None) -> dict[
+        async def leave():
+            # The chats loaded from the dialog snapshot have no entity yet, Telethon resolves the id
+            await self.client(LeaveChannelRequest(self.dialog_index.get(peer_id) or peer_id))
+            self.dialog_index.remove(peer_id)
+            self.storage.execute('DELETE FROM joined_groups WHERE chat_id = ? OR entity = ?', (peer_id, entity))
+
+        return await self.run_outbound(leave, JOIN_LEAVE_KEY, 'leave')
+
+    async def send_message(self, entity: str, message: str, schedule: Union[timedelta, str] = None) -> dict[
         str, Union[str, bool, None]]:
         """
         Sends a message to a specified group or channel.
 
         :param entity: The username or ID of the channel or group to send the message to.
         :param message: The message to send.
-        :param schedule: The time to wait before sending the message.
+        :param schedule: The time to wait before sending the message, a timedelta or a delay like '1h' or '2h30m'.
         :return: A dictionary containing the result of the query, info == True if the message was sent successfully,
         otherwise info == False, and error == None if the query was successful, otherwise error contains the error
         message.
         """
         try:
-            await self.client.send_message(entity, message, schedule=schedule)
-            return {'success': True, 'info': None, 'error': None}
+            if schedule is not None:
+                schedule = parse_timedelta(schedule)
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
 
+        async def send():
+            await self.client.send_message(entity, message, schedule=schedule)
+
+        return await self.run_outbound(send, self.get_outbound_key(entity), 'send_message')
+
     async def add_comment(self, entity: str, message: str,
-                          comment_to_message_id: int, schedule: timedelta = None) -> dict[str, Union[str, bool, None]]:
+                          comment_to_message_id: int,
+                          schedule: Union[timedelta, str] = None) -> dict[str, Union[str, bool, None]]:
         """
         Adds a comment to a specified group or channel.
 
         :param entity: The username or ID of the channel or group to send the message to.
         :param message: The message to send.
         :param comment_to_message_id: The message to reply to.
-        :param schedule: The time to wait before sending the message.
+        :param schedule: The time to wait before sending the message, a timedelta or a delay like '1h' or '2h30m'.
         :return: A dictionary containing the result of the query, info == True if the message was sent successfully,
         otherwise info == False, and error == None if the query was successful, otherwise error contains the error
         message.
         """
         try:
-            comment = await self.client.send_message(entity=entity, message=message, comment_to=comment_to_message_id,
-                                                     schedule=schedule)
+            if schedule is not None:
+                schedule = parse_timedelta(schedule)
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+        async def comment():
+            sent = await self.client.send_message(entity=entity, message=message, comment_to=comment_to_message_id,
+                                                  schedule=schedule)
+            logger.info("Sent comment %s to %s", sent.id, entity)
+
+        return await self.run_outbound(comment, self.get_outbound_key(entity), 'add_comment')
+
+    async def send_media(self, entity: str, sha256: str, caption: str = None) -> dict[str, Union[str, bool, None]]:
+        """
+        Sends a stored media file to a group, channel or user, reusing its Telegram handles to skip the upload.
+
+        :param entity: The username or ID of the chat to send the file to.
+        :param sha256: The SHA-256 of the file, from media_messages or media_files.
+        :param caption: The text sent with the file.
+        :return: A dictionary containing the result of the query, info == True if the file was sent successfully,
+        otherwise info == False, and error == None if the query was successful, otherwise error contains the error
+        message.
+        """
+        if self.media is None:
+            return {'success': False, 'info': None, 'error': 'The media store is disabled'}
+        if self.media.get_file(sha256) is None:
+            return {'success': False, 'info': None, 'error': f'No stored media file with the SHA-256 {sha256}'}
+
+        async def send():
+            await self.media.send(entity, sha256, caption)
+
+        return await self.run_outbound(send, self.get_outbound_key(entity), 'send_media')
 
-            print(comment)
+    def get_outbound_key(self, entity: Union[str, int]) -> Union[str, int]:
+        """
+        :return: The rate limit key of a chat, its peer id when it is known so a username and an id share it
+        """
+        peer_id = self.dialog_index.get_peer_id(entity) if self.dialog_index is not None else None
+        if peer_id is not None:
+            return peer_id
+        return normalize_username(entity) if isinstance(entity, str) else entity
+
+    async def run_outbound(self, action, key, kind: str, priority: int = PRIORITY_ACTION) -> dict[
+        str, Union[str, bool, None]]:
+        """
+        Runs an outbound action through the rate limits and waits outbound_wait seconds for it. An action still
+        waiting for the limits (or a flood wait) stays queued and is reported as such.
+
+        :param action: Coroutine function doing the action
+        :param key: The rate limit key, see get_outbound_key
+        :param kind: The name of the action in the logs and metrics
+        :param priority: The priority of the action
+        :return: A dictionary containing the result of the action, info describes it when it is still queued
+        """
+        future = self.outbound.schedule(action, key=key, priority=priority, kind=kind)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.outbound_wait)
             return {'success': True, 'info': None, 'error': None}
+        except asyncio.TimeoutError:
+            return {'success': True, 'info': f'Queued behind the rate limits with {self.outbound.pending()} other '
+                                             'actions, it will be done automatically', 'error': None}
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
 
-    async def get_conversation_history(self, entity: str, limit: int = 20) -> dict[str, Union[None, bool, list[Any]]]:
+    async def get_sender(self, event):
+        """
+        Gets the sender of an event, from the user cache when possible.
+
+        :param event: A NewMessage event or a message.
+        :return: The sender entity, or None if it can't be resolved.
+        """
+        sender = self.user_cache.get(event.sender_id)
+        if sender is None:
+            sender = await event.get_sender()
+            if sender is not None:
+                self.user_cache.put(event.sender_id, sender)
+        return sender
+
+    async def get_conversation_history(self, entity: str, limit: int = 20, offset_id: int = 0,
+                                       since: str = None) -> dict[str, Union[None, bool, dict[str, Any]]]:
         """
-        Gets the conversation history for a specified group, channel or user.
+        Gets the conversation history for a specified group, channel or user, newest messages first.
+
+        The senders come with the batches of messages returned by Telegram, so they are not fetched one by one.
 
         :param entity: The username or ID of the channel, group or user to get the conversation history for.
         :param limit: The number of messages to retrieve. Defaults to 20.
-        :return: A dictionary containing the result of the query, info contains the list of the messages if successful,
-        otherwise info is None, success == True if the query was successful, otherwise success == False, and error
-        contains the error message if the query failed, otherwise error is None.
+        :param offset_id: Only retrieve the messages older than this message id, to get the next page.
+        :param since: Only retrieve the messages sent at or after this ISO 8601 date or datetime.
+        :return: A dictionary containing the result of the query, info contains the list of the messages and the
+        offset_id of the next page (None if there are no more messages) if successful, otherwise info is None,
+        success == True if the query was successful, otherwise success == False, and error contains the error message
+        if the query failed, otherwise error is None.
         """
         try:
+            since_date = parse_datetime(since) if since else None
+
             messages = []
-            async for message in self.client.iter_messages(entity, limit=limit):
-                # print(message)
-                sender = await message.get_sender()
-                messages.append(
-                    {'id': message.id, 'sender': sender.username, 'text': message.text, 'date': message.date})
-            return {'success': True, 'info': messages, 'error': None}
+            reached_since = False
+            async for message in self.client.iter_messages(entity, limit=limit, offset_id=offset_id):
+                if since_date is not None and message.date < since_date:
+                    reached_since = True
+                    break
+
+                sender = message.sender
+                if sender is not None:
+                    self.user_cache.put(message.sender_id, sender)
+                else:
+                    sender = self.user_cache.get(message.sender_id)
+
+                messages.append({'id': message.id, 'sender_id': message.sender_id,
+                                 'sender': (sender.username or utils.get_display_name(sender)) if sender else None,
+                                 'text': message.text, 'date': message.date})
+
+            next_offset_id = messages[-1]['id'] if messages and len(messages) == limit and not reached_since else None
+
+            return {'success': True, 'info': {'messages': messages, 'next_offset_id': next_offset_id}, 'error': None}
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
 
-    async def run(self) -> None:
+    @staticmethod
+    def _history_cursor(result: dict, omitted: Dict[str, int]) -> None:
         """
-        Starts the Telegram client and listens for events.
+        Points the next page of a history cut by the tool output encoder at the last message kept, the omitted
+        messages are older and are fetched again with the next page.
         """
-        self.client.add_event_handler(self.event_handler, events.NewMessage(incoming=True))
-        print("Running Telegram Assistant...")
-        await self.client.run_until_disconnected()
+        if 'info.messages' in omitted:
+            info = result['info']
+            info['next_offset_id'] = info['messages'][-1]['id']
 
-    def get_data_from_db(self, query: str) -> dict[str, Union[None, bool, list[Any]]]:
+    async def run(self) -> None:
+        """
+        Listens for events until the client disconnects. The handlers were registered by start().
+        """
+        # The jobs missed while the client was down run now
+        self.job_scheduler.load()
+        await self.job_scheduler.start()
+        await self.backfill.start(self.client)
+        if self.media is not None:
+            await self.media.start(self.client)
+
+        # The runs a crash left on the default thread are ended before its next message, the other threads are
+        # checked before their first run
+        recovery = asyncio.create_task(self.thread_manager.recover())
+
+        logger.info("Running Telegram Assistant...")
+        try:
+            await self.client.run_until_disconnected()
+        finally:
+            # A new client is created by the next start()
+            self.handlers_registered = False
+
+            recovery.cancel()
+            if self.dialog_refresh is not None:
+                self.dialog_refresh.cancel()
+
+            await self.job_scheduler.stop()
+            await self.backfill.stop()
+            if self.media is not None:
+                await self.media.stop()
+            await self.outbound.stop()
+
+            # Write the messages still in the queue
+            if self.owns_ingestion_writer:
+                await self.ingestion_writer.stop()
+                logger.info("Ingestion stats: %s", self.ingestion_writer.stats())
+            self.query_engine.close()
+
+    async def get_data_from_db(self, query: str) -> dict[str, Union[None, bool, dict[str, Any]]]:
         """
         Use this function to get the data from the database. Input should be a fully formed SQL query.
+        The query runs on a read-only connection in a worker thread, within a time budget and with a cap on the
+        number and size of the returned rows.
 
         :param query: The query to execute.
-        :return: A dictionary containing the result of the query, info contains the result of the query if successful,
-        otherwise info is None, success == True if the query was successful, otherwise success == False, and error
-        contains the error message if the query failed, otherwise error is None.
+        :return: A dictionary containing the result of the query, info contains the column names, the rows, whether
+        the rows were truncated and their approximate number of tokens if successful, otherwise info is None,
+        success == True if the query was successful, otherwise success == False, and error contains the error message
+        if the query failed, otherwise error is None.
+        """
+        try:
+            return {'success': True, 'info': await self.query_engine.run(query), 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    async def search_messages(self, query: str, group_username: str = None, since: str = None, until: str = None,
+                              limit: int = 20) -> dict[str, Union[None, bool, list[dict[str, Any]]]]:
+        """
+        Searches the stored messages with the full-text index, best matches first. The search runs in the query
+        engine, like get_data_from_db, so a broad query can't block the event loop and stops at its time budget.
+
+        :param query: The words to search for, FTS5 query syntax (OR, NOT, "phrases", prefix*) is supported.
+        :param group_username: Only search the messages of this group.
+        :param since: Only search the messages sent at or after this ISO 8601 date or datetime (UTC if no timezone).
+        :param until: Only search the messages sent before this ISO 8601 date or datetime (UTC if no timezone).
+        :param limit: The maximal number of messages to return. Defaults to 20.
+        :return: A dictionary containing the result of the query, info contains the list of the matching messages with
+        a snippet of their text if successful, otherwise info is None, success == True if the query was successful,
+        otherwise success == False, and error contains the error message if the query failed, otherwise error is None.
         """
         try:
-            with sqlite3.connect('assistant.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute(query)
-                return {'success': True, 'info': cursor.fetchall(), 'error': None}
+            sql = ("SELECT m.id, m.group_username, m.from_id, m.timestamp_sent, "
+                   "snippet(messages_fts, 0, '[', ']', '...', 16) "
+                   "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                   "WHERE messages_fts MATCH ?")
+            params = []
+
+            if group_username:
+                sql += ' AND m.group_username = ?'
+                params.append(normalize_username(group_username))
+            if since:
+                sql += ' AND m.timestamp_sent >= ?'
+                params.append(int(parse_datetime(since).timestamp()))
+            if until:
+                sql += ' AND m.timestamp_sent < ?'
+                params.append(int(parse_datetime(until).timestamp()))
+
+            sql += ' ORDER BY bm25(messages_fts) LIMIT ?'
+            params.append(limit)
+
+            try:
+                rows = (await self.query_engine.run(sql, [query] + params))['rows']
+            except sqlite3.OperationalError:
+                # Not a valid FTS5 query, search for the words as plain terms
+                terms = ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+                rows = (await self.query_engine.run(sql, [terms] + params))['rows']
+
+            messages = [{'id': row[0], 'group_username': row[1], 'from_id': row[2],
+                         'date': datetime.fromtimestamp(row[3], timezone.utc).isoformat() if row[3] else None,
+                         'snippet': row[4]} for row in rows]
+
+            return {'success': True, 'info': messages, 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def get_db_schema(self) -> dict[str, Union[None, bool, str]]:
+        """
+        Gets the schema of the database.
+
+        :return: A dictionary containing the result of the query, info contains the tables and their columns as text
+        if successful, otherwise info is None, success == True if the query was successful, otherwise success == False,
+        and error contains the error message if the query failed, otherwise error is None.
+        """
+        try:
+            with self.storage.connection() as conn:
+                return {'success': True, 'info': get_schema(conn), 'error': None}
 
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
@@ -386,38 +1050,52 @@ class TelegramAssistant(TelegramBot):
         contains the error message if the query failed, otherwise error is None.
         """
         try:
-            with sqlite3.connect('assistant.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT group_username FROM groups_to_watch')
+            groups_to_watch = []
+            for group in self.storage.execute('SELECT group_username FROM groups_to_watch'):
+                groups_to_watch.append(normalize_username(group[0]))
 
-                groups_to_watch = []
-                for group in cursor.fetchall():
-                    groups_to_watch.append(group[0].replace('@', '').replace('https://t.me/', ''))
-
-                return {'success': True, 'info': groups_to_watch, 'error': None}
+            return {'success': True, 'info': groups_to_watch, 'error': None}
 
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
 
-    def add_group_to_watchlist(self, group_username: str) -> dict[str, Union[None, bool, str]]:
+    def add_group_to_watchlist(self, group_username: str, backfill_messages: int = 1000) -> dict[
+        str, Union[None, bool, str]]:
         """
-        Adds a group to the watchlist.
+        Adds a group to the watchlist and starts importing its past messages.
 
         :param group_username: The group to add to the watchlist.
+        :param backfill_messages: The number of past messages to import, 0 for none.
         :return: A dictionary containing the result of the query, info contains the result of the query if successful,
         otherwise info is None, success == True if the query was successful, otherwise success == False, and error
         contains the error message if the query failed, otherwise error is None.
         """
         try:
-            with sqlite3.connect('assistant.db') as conn:
-                cursor = conn.cursor()
+            group_username = normalize_username(group_username)
+            # Adding a watched group again only extends its backfill
+            self.storage.execute('INSERT OR IGNORE INTO groups_to_watch (group_username) VALUES (?)',
+                                 (group_username,))
 
-                group_username = group_username.replace('@', '').replace('https://t.me/', '')
-                cursor.execute('INSERT INTO groups_to_watch (group_username) VALUES (?)', (group_username,))
-                conn.commit()
+            self.groups_to_watch = self.get_groups_to_watch()['info']
+            self.rebuild_watch_filter()
 
-                self.groups_to_watch = self.get_groups_to_watch()['info']
-                return {'success': True, 'info': None, 'error': None}
+            if backfill_messages > 0:
+                self.backfill.add(group_username, backfill_messages)
+            return {'success': True, 'info': None, 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def get_backfill_progress(self) -> dict[str, Union[None, bool, list[dict[str, Any]]]]:
+        """
+        Gets the progress of the imports of past messages.
+
+        :return: A dictionary containing the result of the query, info contains the state of every import if
+        successful, otherwise info is None, success == True if the query was successful, otherwise success == False,
+        and error contains the error message if the query failed, otherwise error is None.
+        """
+        try:
+            return {'success': True, 'info': self.backfill.progress(), 'error': None}
 
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
@@ -432,15 +1110,162 @@ class TelegramAssistant(TelegramBot):
         contains the error message if the query failed, otherwise error is None.
         """
         try:
-            with sqlite3.connect('assistant.db') as conn:
-                cursor = conn.cursor()
+            group_username = normalize_username(group_username)
+            self.storage.execute('DELETE FROM groups_to_watch WHERE group_username = ?', (group_username,))
 
-                group_username = group_username.replace('@', '').replace('https://t.me/', '')
-                cursor.execute('DELETE FROM groups_to_watch WHERE group_username = ?', (group_username,))
-                conn.commit()
+            self.groups_to_watch = self.get_groups_to_watch()['info']
+            self.rebuild_watch_filter()
+            return {'success': True, 'info': None, 'error': None}
 
-                self.groups_to_watch = self.get_groups_to_watch()['info']
-                return {'success': True, 'info': None, 'error': None}
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def pin_fact(self, fact: str, all_chats: bool = False) -> dict[str, Union[None, bool, int]]:
+        """
+        Pins a fact for the chat of the current conversation. The pinned facts are added to the summary that seeds a
+        new thread when the old one is rotated.
+
+        :param fact: The fact to remember.
+        :param all_chats: Pin the fact for every chat instead of only the current one.
+        :return: A dictionary containing the result of the query, info contains the id of the fact if successful,
+        otherwise info is None, success == True if the query was successful, otherwise success == False, and error
+        contains the error message if the query failed, otherwise error is None.
+        """
+        try:
+            chat_id = None if all_chats else chat_id_var.get()
+            with self.storage.connection() as conn:
+                cursor = conn.execute('INSERT INTO pinned_facts (owner, chat_id, fact, timestamp_created) '
+                                      'VALUES (?, ?, ?, ?)', (self.session_file, chat_id, fact, int(time.time())))
+            return {'success': True, 'info': cursor.lastrowid, 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def get_pinned_facts(self) -> dict[str, Union[None, bool, list[dict[str, Any]]]]:
+        """
+        Gets the facts pinned for the chat of the current conversation and for every chat.
+
+        :return: A dictionary containing the result of the query, info contains the list of the facts with their id
+        if successful, otherwise info is None, success == True if the query was successful, otherwise
+        success == False, and error contains the error message if the query failed, otherwise error is None.
+        """
+        try:
+            chat_id = chat_id_var.get()
+            facts = self.thread_manager.get_pinned_facts([chat_id] if chat_id is not None else [])
+            return {'success': True, 'info': [{'id': fact_id, 'fact': fact} for fact_id, fact in facts],
+                    'error': None}
 
         except Exception as e:
             return {'success': False, 'info': None, 'error': str(e)}
+
+    def unpin_fact(self, fact_id: int) -> dict[str, Union[None, bool, str]]:
+        """
+        Unpins a fact.
+
+        :param fact_id: The id of the fact.
+        :return: A dictionary containing the result of the query, info is None, success == True if the query was
+        successful, otherwise success == False, and error contains the error message if the query failed, otherwise
+        error is None.
+        """
+        try:
+            self.storage.execute('DELETE FROM pinned_facts WHERE id = ? AND owner = ?', (fact_id, self.session_file))
+            return {'success': True, 'info': None, 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def schedule_action(self, action: str, arguments: Dict[str, Any], delay: str = None, at: str = None,
+                        repeat_every: str = None) -> dict[str, Union[None, bool, int]]:
+        """
+        Schedules an action for later, once or periodically. The job is stored in the database and survives a
+        restart.
+
+        :param action: One of SCHEDULABLE_ACTIONS.
+        :param arguments: The arguments of the action, as for the tool itself. ask_assistant takes {"message": ...}.
+        :param delay: The time to wait before the first run, like '1h' or '2h30m'.
+        :param at: The time of the first run, ISO 8601, UTC if there is no offset. Used when delay is not set.
+        :param repeat_every: The period of a recurring action, like '1d'. None to run it once.
+        :return: A dictionary containing the result of the query, info contains the id of the job if successful,
+        otherwise info is None, success == True if the query was successful, otherwise success == False, and error
+        contains the error message if the query failed, otherwise error is None.
+        """
+        try:
+            if action not in SCHEDULABLE_ACTIONS:
+                raise ValueError(f"{action} can't be scheduled, expected one of {SCHEDULABLE_ACTIONS}")
+
+            # Invalid arguments are reported now rather than when the job runs
+            if action == 'ask_assistant':
+                errors = validate(arguments, {'type': 'object', 'properties': {'message': {'type': 'string'}},
+                                              'required': ['message']})
+            else:
+                errors = validate(arguments, self.tool_registry.tools[action].parameters)
+            if errors:
+                raise ValueError(f'Invalid arguments for {action}: {"; ".join(errors)}')
+
+            if delay is not None:
+                due_at = time.time() + parse_timedelta(delay).total_seconds()
+            elif at is not None:
+                due = datetime.fromisoformat(at)
+                due_at = (due if due.tzinfo else due.replace(tzinfo=timezone.utc)).timestamp()
+            else:
+                raise ValueError("Either delay or at is required")
+
+            interval = int(parse_timedelta(repeat_every).total_seconds()) if repeat_every is not None else None
+            if interval is not None and interval < 60:
+                raise ValueError("repeat_every must be at least 1 minute")
+
+            job_id = self.job_scheduler.add(chat_id_var.get(), action, arguments, due_at, interval)
+            return {'success': True, 'info': job_id, 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def list_scheduled_actions(self) -> dict[str, Union[None, bool, list[dict[str, Any]]]]:
+        """
+        Lists the pending scheduled actions of the account.
+
+        :return: A dictionary containing the result of the query, info contains the list of the jobs if successful,
+        otherwise info is None, success == True if the query was successful, otherwise success == False, and error
+        contains the error message if the query failed, otherwise error is None.
+        """
+        try:
+            jobs = [{'id': job['id'], 'action': job['action'], 'arguments': job['arguments'],
+                     'due_at': datetime.fromtimestamp(job['due_at'], timezone.utc).isoformat(),
+                     'repeat_every_seconds': job['interval_seconds'], 'runs': job['runs'], 'chat_id': job['chat_id']}
+                    for job in self.job_scheduler.list()]
+            return {'success': True, 'info': jobs, 'error': None}
+
+        except Exception as e:
+            return {'success': False, 'info': None, 'error': str(e)}
+
+    def cancel_scheduled_action(self, job_id: int) -> dict[str, Union[None, bool, str]]:
+        """
+        Cancels a pending scheduled action.
+
+        :param job_id: The id of the job.
+        :return: A dictionary containing the result of the query, info is None, success == True if the job was
+        cancelled, otherwise success == False, and error contains the error message, otherwise error is None.
+        """
+        if not self.job_scheduler.cancel(job_id):
+            return {'success': False, 'info': None, 'error': f'No pending scheduled action with id {job_id}'}
+        return {'success': True, 'info': None, 'error': None}
+
+    async def run_scheduled_job(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Runs a due job of the job scheduler, in the context of the chat it was created in.
+
+        :param job: The job, see JobScheduler.
+        :return: The result of the action.
+        """
+        chat_id = job['chat_id']
+        with trace_context(chat_id=chat_id):
+            if job['action'] != 'ask_assistant':
+                return await self.tool_registry.call(job['action'], job['arguments'])
+
+            answer = await self.get_response(job['arguments']['message'], chat_id=chat_id)
+            target = chat_id if chat_id is not None else self.service_group_id
+            if target is None:
+                return {'success': False, 'info': None, 'error': 'No chat to send the answer to'}
+
+            return await self.run_outbound(lambda: self.client.send_message(target, answer), target,
+                                           'scheduled_answer')
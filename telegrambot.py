@@ -4,13 +4,57 @@ import os
 from telethon import TelegramClient as TelegramClientTelethon
 
 import asyncio
+import contextvars
 import logging
+from contextlib import contextmanager
+
 import socks
 
+from metrics import TELEGRAM_RPC_ERRORS, TELEGRAM_RPC_SECONDS
+
 SCRIPT_DIR = os.path.dirname(__file__)
 
 class_logger = logging.getLogger(__name__)
 
+# Flood wait threshold of the requests made in the current context, None for the one of the client
+flood_sleep_threshold_var = contextvars.ContextVar('flood_sleep_threshold', default=None)
+
+
+@contextmanager
+def raise_flood_waits():
+    """
+    Makes the requests of the block raise every FloodWaitError instead of Telethon sleeping through the short ones.
+    For the callers that handle the flood waits themselves: the outbound scheduler, the backfill and the media
+    transfers.
+    """
+    token = flood_sleep_threshold_var.set(0)
+    try:
+        yield
+    finally:
+        flood_sleep_threshold_var.reset(token)
+
+
+class InstrumentedTelegramClient(TelegramClientTelethon):
+    """
+    Telethon client timing every RPC, including the ones made by the high-level methods (send_message,
+    iter_messages...), by request type.
+    """
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        method = type(request).__name__ if not isinstance(request, list) else 'batch'
+        try:
+            with TELEGRAM_RPC_SECONDS.time(method=method):
+                return await super().__call__(request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+        except Exception as e:
+            TELEGRAM_RPC_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        # Every request goes through here, also the downloads from other data centers that don't use __call__
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = flood_sleep_threshold_var.get()
+        return await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
 
 class TelegramBot:
     def __init__(self, session_file: str, api_id: int, api_hash: str, sessions_folder: str = "sessions") -> None:
@@ -20,10 +64,14 @@ class TelegramBot:
         :param session_file: Session file path, can be .session file for Telethon or tdata folder for Opentele
         :param sessions_folder: folder with .session or tdata files
         """
-        print(f'Created a new bot! Session: {session_file}')
+        class_logger.info(f'Created a new bot! Session: {session_file}')
 
-        # Change it to make the proxies work
-        asyncio.set_event_loop(asyncio.SelectorEventLoop())
+        # Change it to make the proxies work. Bots created inside a running loop (several accounts in one process)
+        # keep the running loop, which must be a selector loop too.
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.set_event_loop(asyncio.SelectorEventLoop())
 
         self.session_file = session_file
         self.api_id = api_id
@@ -40,13 +88,12 @@ class TelegramBot:
         """
         try:
             await self.client.disconnect()
-            print("Disconnected!")
+            class_logger.info(f'{self.session_file}: Disconnected!')
         except Exception as e1:
             class_logger.error(f'{self.session_file}: ERROR DISCONNECTING! :{e1}')
-            print("ERROR DISCONNECTING!")
 
     async def connect(self) -> None:
-        print("Connecting...")
+        class_logger.info(f'{self.session_file}: Connecting...')
         await asyncio.wait_for(self.client.connect(), 20)
 
         class_logger.debug(f'{self.session_file}: Connected!')
@@ -61,14 +108,14 @@ class TelegramBot:
         :param proxy_password: Proxy password (optional)
         """
         # self.client = TelegramClient(session_file_path, api_id, api_hash)
-        print(self.session_file_path)
+        class_logger.debug(self.session_file_path)
 
         if all([proxy_ip, proxy_port, proxy_username, proxy_password]):
-            print(f'Connecting with proxy: {proxy_ip}:{proxy_port}')
+            class_logger.info(f'Connecting with proxy: {proxy_ip}:{proxy_port}')
             proxy = (socks.HTTP, proxy_ip, proxy_port, True, proxy_username, proxy_password)
-            self.client = TelegramClientTelethon(self.session_file_path, api_id=self.api_id, api_hash=self.api_hash,
-                                                 timeout=20, proxy=proxy)
+            self.client = InstrumentedTelegramClient(self.session_file_path, api_id=self.api_id,
+                                                     api_hash=self.api_hash, timeout=20, proxy=proxy)
         else:
-            self.client = TelegramClientTelethon(self.session_file_path, api_id=self.api_id, api_hash=self.api_hash,
-                                                 timeout=20)
+            self.client = InstrumentedTelegramClient(self.session_file_path, api_id=self.api_id,
+                                                     api_hash=self.api_hash, timeout=20)
         await self.connect()
@@ -0,0 +1,303 @@
+"""
+Map every Telegram chat to its own OpenAI thread, serialize the runs of each thread and rotate the threads that grew
+too large.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from openai_assistant import OpenaiAssistant
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadManager:
+    """
+    Keeps one OpenAI thread per Telegram chat, persisted in the database. The API refuses a new run on a thread
+    that already has an active run, so the jobs of a thread go through a FIFO queue consumed by a single worker,
+    while jobs of different threads run in parallel.
+
+    Every run re-reads the whole thread, so the approximate size of each thread is tracked, and a thread larger than
+    max_thread_tokens is replaced by a fresh one seeded with a summary of the old one and the pinned facts of its
+    chats. The rotation happens in the worker between two jobs, the queued jobs continue on the new thread.
+
+    Several accounts share the database, every row is kept by owner: the same chat (e.g. the owner's DM) has its own
+    thread on each account.
+    """
+
+    def __init__(self, client, assistant_id: str, storage: Storage, default_thread_id: str = None,
+                 assistant_class: type = OpenaiAssistant, max_thread_tokens: int = 0, owner: str = '',
+                 **assistant_kwargs):
+        """
+        :param client: An ``AsyncOpenAI`` client
+        :param assistant_id: The id of the OpenAI assistant
+        :param storage: The storage of the database
+        :param default_thread_id: The thread used for messages without a chat (and the chat set with set_default)
+        :param assistant_class: The engine bound to each thread, OpenaiAssistant or ChatCompletionsAssistant
+        :param max_thread_tokens: The approximate size in tokens after which a thread is rotated, 0 to never rotate
+        :param owner: The account the threads belong to
+        :param assistant_kwargs: Passed to every assistant (polling and timeout settings)
+        """
+        self.client = client
+        self.assistant_id = assistant_id
+        self.default_thread_id = default_thread_id
+        self.storage = storage
+        self.assistant_class = assistant_class
+        self.max_thread_tokens = max_thread_tokens
+        self.owner = owner
+        self.assistant_kwargs = assistant_kwargs
+
+        self.chat_threads: Dict[int, str] = {}
+        self.thread_tokens: Dict[str, int] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        # Threads checked for runs left active by a previous process, or created by this one
+        self.recovered_threads = set()
+
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._creation_locks: Dict[int, asyncio.Lock] = {}
+
+    def load(self) -> None:
+        """
+        Loads the mapping of chats to threads of the owner from the database, taking over the rows written before the
+        threads were kept by owner.
+        """
+        with self.storage.connection() as conn:
+            for table in ('chat_threads', 'thread_state', 'pinned_facts'):
+                conn.execute(f"UPDATE {table} SET owner = ? WHERE owner = ''", (self.owner,))
+
+        self.chat_threads = dict(self.storage.execute('SELECT chat_id, thread_id FROM chat_threads WHERE owner = ?',
+                                                      (self.owner,)))
+        self.thread_tokens = dict(self.storage.execute('SELECT thread_id, approx_tokens FROM thread_state '
+                                                       'WHERE owner = ?', (self.owner,)))
+
+        # The configured thread may have been rotated since
+        if self.default_thread_id:
+            self.default_thread_id = self._resolve(self.default_thread_id)
+
+    def _resolve(self, thread_id: str) -> str:
+        """
+        :return: The thread that replaced a thread, following the successive rotations
+        """
+        seen = {thread_id}
+        while True:
+            rows = self.storage.execute('SELECT replaced_by FROM thread_state WHERE owner = ? AND thread_id = ?',
+                                        (self.owner, thread_id))
+            if not rows or rows[0][0] is None or rows[0][0] in seen:
+                return thread_id
+            thread_id = rows[0][0]
+            seen.add(thread_id)
+
+    def _save_thread(self, chat_id: int, thread_id: str) -> None:
+        self.storage.execute("INSERT OR REPLACE INTO chat_threads (owner, chat_id, thread_id, timestamp_created) "
+                             "VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))",
+                             (self.owner, chat_id, thread_id))
+
+        self.chat_threads[chat_id] = thread_id
+
+    def set_default(self, chat_id: int) -> None:
+        """
+        Maps a chat to the default thread if it has no thread yet, so it keeps the existing conversation.
+        :param chat_id: The id of the chat
+        """
+        if self.default_thread_id and chat_id not in self.chat_threads:
+            self._save_thread(chat_id, self.default_thread_id)
+
+    async def get_thread_id(self, chat_id: Optional[int]) -> str:
+        """
+        Returns the thread of a chat, creating it on the first message.
+        :param chat_id: The id of the chat, None for the default thread
+        :return: The id of the OpenAI thread
+        """
+        if chat_id is None:
+            return self.default_thread_id
+
+        if chat_id in self.chat_threads:
+            return self.chat_threads[chat_id]
+
+        lock = self._creation_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            # Another message of the chat may have created the thread while we were waiting
+            if chat_id not in self.chat_threads:
+                thread_id = await self.assistant_class.create_thread(self.client)
+                logger.info("Created thread %s for chat %s", thread_id, chat_id)
+                self.recovered_threads.add(thread_id)
+                self._save_thread(chat_id, thread_id)
+
+        self._creation_locks.pop(chat_id, None)
+
+        return self.chat_threads[chat_id]
+
+    def get_assistant(self, thread_id: str) -> OpenaiAssistant:
+        """
+        :param thread_id: The id of the OpenAI thread
+        :return: An assistant of assistant_class bound to the thread
+        """
+        return self.assistant_class(self.client, self.assistant_id, thread_id, **self.assistant_kwargs)
+
+    async def run_in_thread(self, chat_id: Optional[int], job: Callable[[OpenaiAssistant], Awaitable[Any]]) -> Any:
+        """
+        Queues a job on the thread of a chat and waits for its result. Jobs of the same thread run one at a time
+        in the order they were queued.
+
+        :param chat_id: The id of the chat, None for the default thread
+        :param job: Coroutine function taking the OpenaiAssistant bound to the thread
+        :return: The result of the job
+        """
+        thread_id = await self.get_thread_id(chat_id)
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(thread_id, asyncio.Queue())
+        queue.put_nowait((job, future))
+
+        worker = self._workers.get(thread_id)
+        if worker is None or worker.done():
+            self._workers[thread_id] = asyncio.create_task(self._worker(thread_id))
+
+        return await future
+
+    async def recover(self, chat_id: Optional[int] = None) -> None:
+        """
+        Ends the runs left active on the thread of a chat by a previous process, through the queue of the thread so
+        it doesn't race with the messages. Every thread is also checked this way before its first job.
+        :param chat_id: The id of the chat, None for the default thread
+        """
+        async def nothing(assistant):
+            return None
+
+        if chat_id is not None or self.default_thread_id:
+            await self.run_in_thread(chat_id, nothing)
+
+    async def _recover(self, thread_id: str, assistant) -> None:
+        try:
+            await assistant.recover_active_runs()
+        except Exception as e:
+            # The jobs run anyway, their requests fail if the thread is still locked
+            logger.error("Could not check thread %s for active runs: %s", thread_id, e)
+        self.recovered_threads.add(thread_id)
+
+    async def _worker(self, thread_id: str) -> None:
+        queue = self._queues[thread_id]
+        lock = self.locks.setdefault(thread_id, asyncio.Lock())
+        assistant = self.get_assistant(thread_id)
+
+        if thread_id not in self.recovered_threads:
+            async with lock:
+                await self._recover(thread_id, assistant)
+
+        # The worker exits when the queue is empty and is started again by the next job
+        while not queue.empty():
+            job, future = queue.get_nowait()
+            if future.cancelled():
+                continue
+
+            async with lock:
+                try:
+                    result = await job(assistant)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+
+                # The worker must go on with the next jobs, they would wait forever otherwise
+                try:
+                    # The answer is delivered already, measuring the thread doesn't delay it
+                    if self.max_thread_tokens:
+                        await assistant.measure_context()
+                    self._update_size(thread_id, assistant)
+
+                    if self.max_thread_tokens and self.thread_tokens.get(thread_id, 0) > self.max_thread_tokens:
+                        new_assistant = await self.rotate(thread_id, assistant)
+                        if new_assistant is not None:
+                            # The queue, the lock and this worker now serve the new thread
+                            self._queues[new_assistant.thread_id] = self._queues.pop(thread_id)
+                            self._workers[new_assistant.thread_id] = self._workers.pop(thread_id)
+                            self.locks[new_assistant.thread_id] = self.locks.pop(thread_id)
+                            thread_id, assistant = new_assistant.thread_id, new_assistant
+                except Exception as e:
+                    logger.error("Could not update the size of thread %s after a job: %s", thread_id, e)
+
+        self._workers.pop(thread_id, None)
+
+    def _update_size(self, thread_id: str, assistant) -> None:
+        """
+        Updates the size of a thread from what its assistant saw during the last job.
+        """
+        if assistant.context_tokens is not None:
+            size = assistant.context_tokens + assistant.approx_tokens
+        else:
+            size = self.thread_tokens.get(thread_id, 0) + assistant.approx_tokens
+        assistant.approx_tokens = 0
+        assistant.context_tokens = None
+
+        self.thread_tokens[thread_id] = size
+        self.storage.execute('INSERT INTO thread_state (owner, thread_id, approx_tokens) VALUES (?, ?, ?) '
+                             'ON CONFLICT (owner, thread_id) DO UPDATE SET approx_tokens = excluded.approx_tokens',
+                             (self.owner, thread_id, size))
+
+    def get_chats(self, thread_id: str) -> List[int]:
+        """
+        :return: The chats using a thread
+        """
+        return [chat_id for chat_id, chat_thread_id in self.chat_threads.items() if chat_thread_id == thread_id]
+
+    def get_pinned_facts(self, chat_ids: List[int]) -> List[tuple]:
+        """
+        :return: The (id, fact) of the facts of the owner pinned in the given chats or for all chats, oldest first
+        """
+        placeholders = ', '.join('?' * len(chat_ids))
+        condition = f'(chat_id IS NULL OR chat_id IN ({placeholders}))' if chat_ids else 'chat_id IS NULL'
+        return self.storage.execute(f'SELECT id, fact FROM pinned_facts WHERE owner = ? AND {condition} ORDER BY id',
+                                    [self.owner] + list(chat_ids))
+
+    async def rotate(self, thread_id: str, assistant):
+        """
+        Replaces a thread by a new one seeded with a summary of the old one and the pinned facts, and maps the chats
+        of the old thread to the new one. The caller must hold the lock of the thread.
+
+        :param thread_id: The thread to replace
+        :param assistant: The assistant bound to the thread
+        :return: The assistant bound to the new thread, None if the rotation failed (the old thread is kept)
+        """
+        try:
+            summary = await assistant.summarize()
+            facts = self.get_pinned_facts(self.get_chats(thread_id))
+
+            seed = f"Summary of our previous conversation:\n{summary}"
+            if facts:
+                seed += "\n\nPinned facts:\n" + "\n".join(f"[{fact_id}] {fact}" for fact_id, fact in facts)
+
+            new_thread_id = await self.assistant_class.create_thread(self.client)
+            self.recovered_threads.add(new_thread_id)
+            new_assistant = self.get_assistant(new_thread_id)
+            await new_assistant.add_message_to_thread(seed)
+        except Exception as e:
+            logger.error("Could not rotate thread %s: %s", thread_id, e)
+            return None
+
+        # Switch every chat at once, with nothing awaited in between
+        with self.storage.connection() as conn:
+            conn.execute('UPDATE chat_threads SET thread_id = ? WHERE owner = ? AND thread_id = ?',
+                         (new_thread_id, self.owner, thread_id))
+            conn.execute('INSERT INTO thread_state (owner, thread_id, approx_tokens, replaced_by, summary, '
+                         'timestamp_rotated) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (owner, thread_id) DO UPDATE SET '
+                         'replaced_by = excluded.replaced_by, summary = excluded.summary, '
+                         'timestamp_rotated = excluded.timestamp_rotated',
+                         (self.owner, thread_id, self.thread_tokens.get(thread_id, 0), new_thread_id, summary,
+                          int(time.time())))
+
+        for chat_id in self.get_chats(thread_id):
+            self.chat_threads[chat_id] = new_thread_id
+        if self.default_thread_id == thread_id:
+            self.default_thread_id = new_thread_id
+
+        self._update_size(new_thread_id, new_assistant)
+        logger.info("Rotated thread %s (%s tokens) to %s", thread_id, self.thread_tokens.get(thread_id),
+                    new_thread_id)
+
+        return new_assistant
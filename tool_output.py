@@ -0,0 +1,154 @@
+"""
+Compact, token-budgeted serialization of the tool outputs sent back to the assistant.
+"""
+
+import base64
+import json
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Roughly 4 characters per token for English text and JSON
+CHARS_PER_TOKEN = 4
+
+# Room left for the "truncated" and "omitted_items" markers of a reduced result
+MARKERS_LENGTH = 100
+
+
+def json_default(obj: Any) -> Any:
+    """
+    Converts the values json can't serialize: datetimes, timedeltas, bytes, tuples and sets, and any other object
+    as its string.
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode('ascii')
+    if isinstance(obj, (tuple, set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def dumps(data: Any) -> str:
+    return json.dumps(data, default=json_default, ensure_ascii=False, separators=(',', ':'))
+
+
+class ToolOutputEncoder:
+    """
+    Encodes tool results as compact JSON within a token budget per tool. Results over budget are reduced step by
+    step: long texts are clipped, then the longest lists are cut (the first items are kept, which are the newest
+    messages for the history tools), and the number of omitted items is reported. A reduced result is marked with
+    "truncated": true. Tools that page through their results can have a cursor hook fixing up their paging cursor
+    once lists were cut, so the next page starts right after the last item kept.
+    """
+
+    def __init__(self, default_budget: int = 1500, budgets: Dict[str, int] = None, max_text_length: int = 1000,
+                 min_text_length: int = 200, cursors: Dict[str, Callable[[Any, Dict[str, int]], None]] = None):
+        """
+        :param default_budget: The token budget of the tools without a specific budget
+        :param budgets: The token budget of each tool, by name
+        :param max_text_length: The length long texts are clipped to first
+        :param min_text_length: The length long texts are clipped to when cutting lists wasn't enough
+        :param cursors: The cursor hook of each tool, by name, called with the reduced result and the omitted items
+            by path when lists were cut, to update the paging cursor of the result in place
+        """
+        self.default_budget = default_budget
+        self.budgets = budgets or {}
+        self.max_text_length = max_text_length
+        self.min_text_length = min_text_length
+        self.cursors = cursors or {}
+
+    def get_budget(self, tool_name: str) -> int:
+        return self.budgets.get(tool_name, self.default_budget)
+
+    def encode(self, tool_name: Optional[str], result: Any) -> str:
+        """
+        :param tool_name: The name of the tool, selecting the budget
+        :param result: The result of the tool
+        :return: The JSON text to submit as the tool output
+        """
+        budget = self.get_budget(tool_name) * CHARS_PER_TOKEN
+
+        text = dumps(result)
+        if len(text) <= budget:
+            return text
+
+        # Work on a JSON-compatible copy, tuples become lists and can be cut
+        data = json.loads(text)
+        omitted: Dict[str, int] = {}
+
+        data = self._clip_texts(data, self.max_text_length)
+        text = dumps(data)
+
+        while len(text) + MARKERS_LENGTH > budget:
+            path, items = self._find_longest_list(data)
+            if items is None or len(items) <= 1:
+                break
+
+            # Keep the share of the items that should fit, at least one and always fewer than before
+            keep = max(1, min(len(items) - 1, len(items) * (budget - MARKERS_LENGTH) // len(text)))
+            omitted[path] = omitted.get(path, 0) + len(items) - keep
+            del items[keep:]
+            text = dumps(data)
+
+        if omitted and tool_name in self.cursors:
+            self.cursors[tool_name](data, omitted)
+
+        if len(text) + MARKERS_LENGTH > budget:
+            data = self._clip_texts(data, self.min_text_length)
+
+        if isinstance(data, dict):
+            data['truncated'] = True
+            if omitted:
+                data['omitted_items'] = omitted
+        else:
+            data = {'result': data, 'truncated': True, 'omitted_items': omitted}
+
+        text = dumps(data)
+        if len(text) > budget:
+            # Nothing left to cut structurally
+            text = dumps({'truncated': True, 'partial_result': text[:budget]})
+
+        return text
+
+    def _clip_texts(self, data: Any, max_length: int) -> Any:
+        if isinstance(data, str):
+            if len(data) > max_length:
+                return data[:max_length] + f'... [{len(data) - max_length} more characters]'
+            return data
+        if isinstance(data, dict):
+            return {key: self._clip_texts(value, max_length) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self._clip_texts(value, max_length) for value in data]
+        return data
+
+    def _find_longest_list(self, data: Any) -> Tuple[str, Optional[List[Any]]]:
+        """
+        :return: The path and the list with the longest serialization among the lists of more than one record
+        """
+        candidates = []
+        self._collect_lists(data, '', None, candidates)
+        if not candidates:
+            return '', None
+
+        _, path, items = max(candidates, key=lambda candidate: candidate[0])
+        return path, items
+
+    def _collect_lists(self, data: Any, path: str, key: Optional[str], candidates: List[tuple]) -> None:
+        """
+        Collects the lists that can be cut: the lists of records (objects or rows), except the column names of a
+        table. Cutting a row or the columns would misalign the values and their names, cutting a list of values
+        would change its meaning.
+        """
+        if isinstance(data, list):
+            if len(data) > 1 and key != 'columns' and all(isinstance(item, (dict, list)) for item in data):
+                candidates.append((len(dumps(data)), path, data))
+            children = [(f'{path}[{index}]', None, value) for index, value in enumerate(data)]
+        elif isinstance(data, dict):
+            children = [(f'{path}.{name}' if path else name, name, value) for name, value in data.items()]
+        else:
+            return
+
+        for child_path, child_key, child in children:
+            self._collect_lists(child, child_path, child_key, candidates)
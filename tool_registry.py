@@ -0,0 +1,177 @@
+"""
+Registry of the tools the assistant can call, built from functions.json.
+"""
+
+import functools
+import inspect
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# JSON schema types and the Python types they accept. bool is a subclass of int, so it is excluded explicitly.
+JSON_TYPES = {
+    'string': (str,),
+    'integer': (int,),
+    'number': (int, float),
+    'boolean': (bool,),
+    'object': (dict,),
+    'array': (list,),
+    'null': (type(None),),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load_functions(functions_path: str = 'functions.json') -> List[Dict[str, Any]]:
+    """
+    Parses a functions file once, every assistant and registry shares the list. It must not be modified.
+
+    :param functions_path: The path of the JSON file with the function definitions
+    :return: The tools in the format of the OpenAI API
+    """
+    with open(functions_path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def validate(value: Any, schema: Dict[str, Any], path: str = 'arguments') -> List[str]:
+    """
+    Validates a value against the subset of JSON schema used in functions.json: type, properties, required,
+    additionalProperties, items, enum, minimum and maximum.
+
+    :param value: The value to validate
+    :param schema: The JSON schema
+    :param path: The name of the value in the error messages
+    :return: The list of errors, empty if the value is valid
+    """
+    errors = []
+
+    expected = schema.get('type')
+    if expected is not None:
+        types = expected if isinstance(expected, list) else [expected]
+        valid = any(isinstance(value, JSON_TYPES[name])
+                    and not (isinstance(value, bool) and name in ('integer', 'number'))
+                    for name in types if name in JSON_TYPES)
+        if not valid:
+            return [f"{path} must be of type {' or '.join(types)}, got {type(value).__name__}"]
+
+    if 'enum' in schema and value not in schema['enum']:
+        errors.append(f"{path} must be one of {schema['enum']}")
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if 'minimum' in schema and value < schema['minimum']:
+            errors.append(f"{path} must be >= {schema['minimum']}")
+        if 'maximum' in schema and value > schema['maximum']:
+            errors.append(f"{path} must be <= {schema['maximum']}")
+
+    if isinstance(value, dict):
+        properties = schema.get('properties', {})
+        for name in schema.get('required', []):
+            if name not in value:
+                errors.append(f"{path}.{name} is required")
+        for name, item in value.items():
+            if name in properties:
+                errors.extend(validate(item, properties[name], f'{path}.{name}'))
+            elif not schema.get('additionalProperties', False):
+                # Unknown arguments can't be passed to the handler, so they are rejected by default
+                errors.append(f"{path}.{name} is not a known parameter")
+
+    if isinstance(value, list) and 'items' in schema:
+        for index, item in enumerate(value):
+            errors.extend(validate(item, schema['items'], f'{path}[{index}]'))
+
+    return errors
+
+
+class Tool:
+    def __init__(self, name: str, parameters: Dict[str, Any], handler: Callable, ttl: Optional[float] = None,
+                 invalidates: Iterable[str] = ()):
+        """
+        :param name: The name of the function in functions.json
+        :param parameters: The JSON schema of the arguments
+        :param handler: The function or coroutine function running the tool
+        :param ttl: How long a successful result is reused for the same arguments, in seconds. None for tools that
+        must run every time.
+        :param invalidates: The tools whose cached results are dropped after this tool runs
+        """
+        self.name = name
+        self.parameters = parameters
+        self.handler = handler
+        self.ttl = ttl
+        self.invalidates = list(invalidates)
+
+
+class ToolRegistry:
+    """
+    Dispatches the tool calls of the assistant. The arguments are validated against the schema declared in
+    functions.json before the handler runs, so the model gets a precise error instead of a failed call. Results of
+    read-only tools are memoized for their ttl, and the tools that modify something drop the dependent entries.
+    """
+
+    def __init__(self, functions_path: str = 'functions.json'):
+        """
+        :param functions_path: The path of the JSON file with the function definitions
+        """
+        self.definitions: Dict[str, Dict[str, Any]] = {}
+        for function in load_functions(functions_path):
+            definition = function['function']
+            self.definitions[definition['name']] = definition
+
+        self.tools: Dict[str, Tool] = {}
+        self._cache: Dict[str, Dict[str, tuple]] = {}
+
+    def register(self, name: str, handler: Callable, ttl: Optional[float] = None,
+                 invalidates: Iterable[str] = ()) -> None:
+        """
+        Registers the handler of a function declared in functions.json.
+        """
+        if name not in self.definitions:
+            raise ValueError(f"The function {name} is not declared in functions.json")
+
+        parameters = self.definitions[name].get('parameters', {'type': 'object', 'properties': {}})
+        self.tools[name] = Tool(name, parameters, handler, ttl, invalidates)
+
+    def missing(self) -> List[str]:
+        """
+        :return: The functions declared in functions.json without a handler
+        """
+        return [name for name in self.definitions if name not in self.tools]
+
+    def invalidate(self, *names: str) -> None:
+        """
+        Drops the cached results of the given tools.
+        """
+        for name in names:
+            self._cache.pop(name, None)
+
+    async def call(self, name: str, args: Dict[str, Any]) -> Any:
+        """
+        Validates the arguments and runs a tool, or returns its cached result.
+
+        :param name: The name of the tool
+        :param args: The arguments sent by the model
+        :return: The result of the tool, or an error dict if the tool is unknown or the arguments are invalid
+        """
+        tool = self.tools.get(name)
+        if tool is None:
+            return {'success': False, 'info': None, 'error': f'Unknown function {name}'}
+
+        errors = validate(args, tool.parameters)
+        if errors:
+            return {'success': False, 'info': None, 'error': f'Invalid arguments for {name}: {"; ".join(errors)}'}
+
+        key = json.dumps(args, sort_keys=True)
+        if tool.ttl is not None:
+            cached = self._cache.get(name, {}).get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+
+        result = tool.handler(**args)
+        if inspect.isawaitable(result):
+            result = await result
+
+        if tool.ttl is not None and (not isinstance(result, dict) or result.get('success')):
+            self._cache.setdefault(name, {})[key] = (result, time.monotonic() + tool.ttl)
+
+        if tool.invalidates:
+            self.invalidate(*tool.invalidates)
+
+        return result
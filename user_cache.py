@@ -0,0 +1,64 @@
+"""
+LRU cache with expiry for the Telegram users seen by the assistant.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Keeps at most max_size entries, evicting the least recently used one, and forgets entries older than ttl seconds.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        """
+        :param max_size: The maximal number of entries
+        :param ttl: The time after which an entry expires, in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        """
+        :return: The cached value, or default if it is missing or expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None